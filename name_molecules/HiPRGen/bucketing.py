@@ -1,6 +1,7 @@
 from HiPRGen.mol_entry import MoleculeEntry
-from itertools import combinations_with_replacement
+import numpy as np
 import sqlite3
+import os
 
 """
 Phase 2: bucketing pairs of species input: filtered list of species
@@ -14,101 +15,304 @@ within reach
 """
 
 
+class BucketArrays:
+    """
+    read only, array based copy of a bucket db. The complexes are
+    stored as one contiguous (species_1, species_2) int32 array sorted
+    by composition and group, with species_2 = -1 for single species.
+    The complexes in group g of composition c are
 
-def bucket(
-        mol_entries,
-        bucket_db,
-        commit_freq=2000,
-        group_size=1000):
-
-    con = sqlite3.connect(bucket_db)
-    cur = con.cursor()
-    cur.execute(
-        "CREATE TABLE complexes (species_1, species_2, composition_id, group_id)")
+      complexes[group_offsets[k]:group_offsets[k+1]]
 
-    # we create an index on (composition, group_id) so worker processes
-    # during reaction filtering can read their work batch faster
+    where k = composition_group_start[c] + g, so composition c has
+    composition_group_start[c+1] - composition_group_start[c] groups.
+    Within a group, complexes are in the same order as in the bucket
+    db. The arrays are memory mapped, so processes on the same node
+    share one copy.
+    """
 
-    cur.execute(
-        "CREATE INDEX composition_index ON complexes (composition_id, group_id)")
+    array_names = ["complexes", "group_offsets", "composition_group_start"]
 
-    group_counts = {}
-    bucket_counts = {}
-    composition_ids = {}
-    commit_count = 0
-    composition_count = 0
+    def __init__(self, complexes, group_offsets, composition_group_start):
+        self.complexes = complexes
+        self.group_offsets = group_offsets
+        self.composition_group_start = composition_group_start
 
-    for m in mol_entries:
-        composition = '_'.join(sorted(m.species))
+    @classmethod
+    def load(cls, path, mmap_mode='r'):
+        return cls(*[
+            np.load(os.path.join(path, name + ".npy"), mmap_mode=mmap_mode)
+            for name in cls.array_names])
 
-        if composition not in group_counts:
-            group_counts[composition] = 0
-            bucket_counts[composition] = 0
-            composition_ids[composition] = composition_count
-            composition_count += 1
+    def save(self, path):
+        os.makedirs(path, exist_ok=True)
+        for name in self.array_names:
+            np.save(os.path.join(path, name + ".npy"), getattr(self, name))
 
-        data = (m.ind, -1, composition_ids[composition], group_counts[composition])
-        cur.execute("INSERT INTO complexes VALUES (?, ?, ?, ?)", data)
+    def group(self, composition_id, group_id):
+        k = self.composition_group_start[composition_id] + group_id
+        return self.complexes[self.group_offsets[k]:self.group_offsets[k+1]]
 
-        commit_count += 1
-        if commit_count % commit_freq == 0:
-            con.commit()
+    def group_counts(self):
+        """
+        (composition_id, number of groups) pairs, like the group_counts table
+        """
+        return list(enumerate(np.diff(self.composition_group_start).tolist()))
 
-        bucket_counts[composition] += 1
-        if bucket_counts[composition] % group_size == 0:
-            group_counts[composition] += 1
+    def group_size(self, composition_id, group_id):
+        k = self.composition_group_start[composition_id] + group_id
+        return int(self.group_offsets[k+1] - self.group_offsets[k])
 
 
-    for (m1, m2) in combinations_with_replacement(mol_entries, 2):
-        composition = '_'.join(sorted(m1.species + m2.species))
+def write_bucket_arrays(bucket_db, bucket_arrays_dir, chunk_size=1000000):
+    """
+    export the complexes table of a bucket db as BucketArrays
+    """
+    con = sqlite3.connect(bucket_db)
+    cur = con.cursor()
 
-        if composition not in group_counts:
-            group_counts[composition] = 0
-            bucket_counts[composition] = 0
-            composition_ids[composition] = composition_count
-            composition_count += 1
+    group_counts = np.array(
+        [count for (_, count) in cur.execute(
+            "SELECT * FROM group_counts ORDER BY composition_id")],
+        dtype=np.int64)
+    composition_group_start = np.zeros(group_counts.shape[0] + 1, dtype=np.int64)
+    np.cumsum(group_counts, out=composition_group_start[1:])
 
+    number_of_complexes = list(cur.execute("SELECT COUNT(*) FROM complexes"))[0][0]
+    complexes = np.zeros((number_of_complexes, 2), dtype=np.int32)
+    group_indices = np.zeros(number_of_complexes, dtype=np.int64)
 
-        data = (
-            m1.ind,
-            m2.ind,
-            composition_ids[composition],
-            group_counts[composition])
+    cur.execute(
+        "SELECT species_1, species_2, composition_id, group_id FROM complexes "
+        "ORDER BY composition_id, group_id, rowid")
+    position = 0
+    while True:
+        rows = cur.fetchmany(chunk_size)
+        if len(rows) == 0:
+            break
+
+        chunk = np.array(rows, dtype=np.int64)
+        end = position + chunk.shape[0]
+        complexes[position:end] = chunk[:, 0:2]
+        group_indices[position:end] = (
+            composition_group_start[chunk[:, 2]] + chunk[:, 3])
+        position = end
 
-        cur.execute("INSERT INTO complexes VALUES (?, ?, ?, ?)", data)
+    con.close()
 
-        commit_count += 1
-        if commit_count % commit_freq == 0:
-            con.commit()
+    group_offsets = np.zeros(composition_group_start[-1] + 1, dtype=np.int64)
+    np.cumsum(
+        np.bincount(group_indices, minlength=composition_group_start[-1]),
+        out=group_offsets[1:])
+
+    bucket_arrays = BucketArrays(complexes, group_offsets, composition_group_start)
+    bucket_arrays.save(bucket_arrays_dir)
+    return bucket_arrays
+
+
+def composition_string(elements, counts):
+    """
+    the same string as '_'.join(sorted(species)) for a species list
+    with counts[k] copies of elements[k], elements being sorted.
+    """
+    return '_'.join(
+        element
+        for element, count in zip(elements, counts)
+        for _ in range(count))
+
+
+class BucketWriter:
+    """
+    assigns composition ids and group ids to chunks of complexes in
+    the order they are emitted and streams them into the complexes
+    table. A composition gets its id when it is first emitted and the
+    k-th complex with a given composition goes into group k // group_size.
+    """
+
+    def __init__(self, con, number_of_keys, group_size, commit_freq):
+        self.con = con
+        self.group_size = group_size
+        self.commit_freq = commit_freq
+        self.key_to_id = np.full(number_of_keys, -1, dtype=np.int64)
+        self.id_to_key = []
+        # indexed by composition id, not key
+        self.bucket_counts = np.zeros(number_of_keys, dtype=np.int64)
+        self.rows_since_commit = 0
+
+    def emit(self, keys, species_1, species_2):
+        if keys.shape[0] == 0:
+            return
+
+        unassigned = self.key_to_id[keys] == -1
+        new_keys, first_index = np.unique(keys[unassigned], return_index=True)
+        for key in new_keys[np.argsort(first_index, kind='stable')].tolist():
+            self.key_to_id[key] = len(self.id_to_key)
+            self.id_to_key.append(key)
+
+        composition_ids = self.key_to_id[keys]
+
+        # position of each complex among the complexes in this chunk
+        # with the same composition
+        order = np.argsort(composition_ids, kind='stable')
+        sorted_ids = composition_ids[order]
+        run_starts = np.searchsorted(sorted_ids, sorted_ids, side='left')
+        positions = np.empty_like(order)
+        positions[order] = np.arange(order.shape[0]) - run_starts
+
+        group_ids = (self.bucket_counts[composition_ids] + positions) // self.group_size
+        self.bucket_counts += np.bincount(
+            composition_ids, minlength=self.bucket_counts.shape[0])
+
+        self.con.executemany(
+            "INSERT INTO complexes VALUES (?, ?, ?, ?)",
+            zip(species_1.tolist(),
+                species_2.tolist(),
+                composition_ids.tolist(),
+                group_ids.tolist()))
+
+        self.rows_since_commit += keys.shape[0]
+        if self.rows_since_commit >= self.commit_freq:
+            self.con.commit()
+            self.rows_since_commit = 0
 
-        bucket_counts[composition] += 1
-        if bucket_counts[composition] % group_size == 0:
-            group_counts[composition] += 1
 
+def bucket(
+        mol_entries,
+        bucket_db,
+        commit_freq=2000,
+        group_size=1000,
+        prune_singletons=False,
+        bucket_arrays_dir=None):
+
+    """
+    species are grouped by composition first, so the composition of a
+    pair is looked up from the pair of groups rather than built and
+    sorted for every pair of species. Rows are emitted in the same
+    order as a loop over mol_entries followed by a loop over
+    combinations_with_replacement(mol_entries, 2), so the tables are
+    the same as that loop would produce.
+
+    if prune_singletons is True, compositions which only contain a
+    single complex are left out. These can't take part in a reaction,
+    since a reaction needs two different complexes with the same
+    composition.
+
+    if bucket_arrays_dir is given, the bucket is also exported as
+    BucketArrays, which reaction filtering can read instead of the db.
+    """
 
-    con.execute("CREATE TABLE group_counts (composition_id, count)")
-    con.execute("CREATE TABLE compositions (composition_id, composition)")
-    for composition in composition_ids:
-        cur.execute(
-            "INSERT INTO group_counts VALUES (?, ?)",
-            (composition_ids[composition],
-             group_counts[composition] + 1))
+    con = sqlite3.connect(bucket_db)
+    con.execute("PRAGMA journal_mode = OFF")
+    con.execute("PRAGMA synchronous = OFF")
+    cur = con.cursor()
+    cur.execute(
+        "CREATE TABLE complexes (species_1, species_2, composition_id, group_id)")
 
-        cur.execute(
-            "INSERT INTO compositions VALUES (?,?)",
-            ((composition_ids[composition],
-              composition)))
+    # composition groups of individual species
+    group_of_composition = {}
+    mol_groups = np.zeros(len(mol_entries), dtype=np.int64)
+    group_species = []
+    for k, m in enumerate(mol_entries):
+        composition = '_'.join(sorted(m.species))
+        if composition not in group_of_composition:
+            group_of_composition[composition] = len(group_species)
+            group_species.append(m.species)
+
+        mol_groups[k] = group_of_composition[composition]
+
+    number_of_groups = len(group_species)
+    elements = sorted(set(
+        element for species in group_species for element in species))
+    element_index = {element : i for i, element in enumerate(elements)}
+
+    group_vectors = np.zeros((number_of_groups, len(elements)), dtype=np.int64)
+    for g, species in enumerate(group_species):
+        for element in species:
+            group_vectors[g, element_index[element]] += 1
+
+    # every composition, whether of a species or a pair, gets a key
+    key_of_composition = {}
+    def composition_key(counts):
+        composition = composition_string(elements, counts)
+        if composition not in key_of_composition:
+            key_of_composition[composition] = len(key_of_composition)
+        return key_of_composition[composition]
+
+    group_keys = np.array(
+        [composition_key(group_vectors[g].tolist())
+         for g in range(number_of_groups)],
+        dtype=np.int64)
+
+    pair_keys = np.zeros((number_of_groups, number_of_groups), dtype=np.int64)
+    for g_0 in range(number_of_groups):
+        for g_1 in range(g_0, number_of_groups):
+            key = composition_key((group_vectors[g_0] + group_vectors[g_1]).tolist())
+            pair_keys[g_0, g_1] = key
+            pair_keys[g_1, g_0] = key
+
+    number_of_keys = len(key_of_composition)
+    mol_indices = np.array([m.ind for m in mol_entries], dtype=np.int64)
+
+    if prune_singletons:
+        group_sizes = np.bincount(mol_groups, minlength=number_of_groups)
+        key_sizes = np.bincount(
+            group_keys, weights=group_sizes, minlength=number_of_keys)
+        for g_0 in range(number_of_groups):
+            for g_1 in range(g_0, number_of_groups):
+                if g_0 == g_1:
+                    pairs = group_sizes[g_0] * (group_sizes[g_0] + 1) // 2
+                else:
+                    pairs = group_sizes[g_0] * group_sizes[g_1]
+                key_sizes[pair_keys[g_0, g_1]] += pairs
+
+        keep_key = key_sizes > 1
+    else:
+        keep_key = np.ones(number_of_keys, dtype=bool)
+
+    writer = BucketWriter(con, number_of_keys, group_size, commit_freq)
+
+    def emit(keys, species_1, species_2):
+        keep = keep_key[keys]
+        writer.emit(keys[keep], species_1[keep], species_2[keep])
+
+    emit(
+        group_keys[mol_groups],
+        mol_indices,
+        np.full(mol_indices.shape[0], -1, dtype=np.int64))
+
+    for i in range(len(mol_entries)):
+        emit(
+            pair_keys[mol_groups[i], mol_groups[i:]],
+            np.full(len(mol_entries) - i, mol_indices[i], dtype=np.int64),
+            mol_indices[i:])
 
+    con.commit()
 
+    # we create an index on (composition, group_id) so worker processes
+    # during reaction filtering can read their work batch faster. It is
+    # cheaper to build it once all the rows are in.
 
-        commit_count += 1
-        if commit_count % commit_freq == 0:
-            con.commit()
+    cur.execute(
+        "CREATE INDEX composition_index ON complexes (composition_id, group_id)")
 
+    composition_of_key = {
+        key : composition for composition, key in key_of_composition.items()}
 
+    con.execute("CREATE TABLE group_counts (composition_id, count)")
+    con.execute("CREATE TABLE compositions (composition_id, composition)")
+    cur.executemany(
+        "INSERT INTO group_counts VALUES (?, ?)",
+        [(composition_id,
+          int(writer.bucket_counts[composition_id]) // group_size + 1)
+         for composition_id in range(len(writer.id_to_key))])
 
+    cur.executemany(
+        "INSERT INTO compositions VALUES (?,?)",
+        [(composition_id, composition_of_key[key])
+         for composition_id, key in enumerate(writer.id_to_key)])
 
     con.commit()
     con.close()
 
-
+    if bucket_arrays_dir is not None:
+        write_bucket_arrays(bucket_db, bucket_arrays_dir)
@@ -1,14 +1,23 @@
 from HiPRGen.report_generator import ReportGenerator
 from HiPRGen.network_renderer import Renderer
-from HiPRGen.network_loader import NetworkLoader
+from HiPRGen.network_loader import (
+    NetworkLoader,
+    TrajectoryStore,
+    trajectory_reaction_ids
+)
 from HiPRGen.constants import ROOM_TEMP, KB
 from HiPRGen.reaction_questions import marcus_barrier
 from monty.serialization import dumpfn
 import math
+import os
+import sys
 import numpy as np
 import matplotlib.pyplot as plt
 import matplotlib.colors as mcolors
+from scipy.sparse import csr_matrix, hstack
+import sqlite3
 from itertools import chain
+from collections import OrderedDict
 from multiprocessing import Pool
 
 def default_cost(free_energy):
@@ -22,152 +31,158 @@ def compute_starting_angle(l, step):
         return - ((l / 2) * step) + 0.05
 
 
-def render_species(network_loader, path):
-    renderer = Renderer()
-
-    starting_species_count = 0
-    for species_id in range(network_loader.number_of_species):
-        if network_loader.initial_state_array[species_id] > 0:
-            starting_species_count += 1
+def layout_species(
+        renderer,
+        network_loader,
+        boundary_colors=None,
+        layout_path=None):
+    """
+    place every species: initial species on the left boundary, species
+    in boundary_colors (if given) on the right boundary and the others
+    inside. If layout_path is given, the layout is loaded from it if it
+    exists and written to it otherwise, so every render of a network
+    which is given the same layout_path has the same positions.
+    """
+    if layout_path is not None and os.path.exists(layout_path):
+        renderer.load_layout(layout_path)
+        return
 
+    initial_species = [
+        species_id for species_id in range(network_loader.number_of_species)
+        if network_loader.initial_state_array[species_id] > 0]
 
     left_angle_counter_step = 0.1
     left_angle_counter = math.pi + compute_starting_angle(
-        starting_species_count,
+        len(initial_species),
         left_angle_counter_step
     )
 
-    for species_id in range(network_loader.number_of_species):
-        if network_loader.initial_state_array[species_id] > 0:
+    for species_id in initial_species:
+        renderer.new_node_boundary(species_id, left_angle_counter)
+        left_angle_counter += left_angle_counter_step
 
-            renderer.new_node_boundary(species_id, left_angle_counter)
-            left_angle_counter += left_angle_counter_step
+    if boundary_colors is not None:
+        right_angle_counter_step = 0.1
+        right_angle_counter = compute_starting_angle(
+            len(boundary_colors),
+            right_angle_counter_step
+        )
 
-        else:
-            renderer.new_node(species_id)
+        for species_id in range(network_loader.number_of_species):
+            if (network_loader.initial_state_array[species_id] <= 0 and
+                species_id in boundary_colors):
+                renderer.new_node_boundary(species_id, right_angle_counter)
+                right_angle_counter += right_angle_counter_step
 
-    for species_id in range(network_loader.number_of_species):
-        if network_loader.initial_state_array[species_id] > 0:
-            renderer.draw_node(species_id, radius=0.008)
-        else:
-            renderer.draw_node(species_id, radius=0.002)
+    renderer.new_nodes(range(network_loader.number_of_species))
 
-    renderer.render(path)
+    if layout_path is not None:
+        renderer.save_layout(layout_path)
 
 
+def reaction_edges(network_loader, reaction_ids):
+    """
+    (reactant, product) for every reactant and product of the reactions
+    """
+    edges = []
+    for reaction_id in reaction_ids:
+        reaction = network_loader.index_to_reaction(reaction_id)
+        for i in range(reaction['number_of_reactants']):
+            for j in range(reaction['number_of_products']):
+                edges.append((reaction['reactants'][i], reaction['products'][j]))
 
+    return edges
 
-def render_reactions_which_fired(network_loader, colors, path):
-    renderer = Renderer()
-    reactions_which_fired = set()
-    for seed in network_loader.trajectories:
-        for step in network_loader.trajectories[seed]:
-            reaction_id = network_loader.trajectories[seed][step][0]
-            reaction = network_loader.index_to_reaction(reaction_id)
-            reactions_which_fired.add(reaction_id)
 
-    starting_species_count = 0
-    for species_id in range(network_loader.number_of_species):
+def draw_species(renderer, network_loader, species_ids, colors=None):
+    """
+    initial species as big nodes, species in colors as squares of
+    their color and the others as small nodes
+    """
+    initial_species = []
+    colored_species = {}
+    other_species = []
+    for species_id in species_ids:
         if network_loader.initial_state_array[species_id] > 0:
-            starting_species_count += 1
+            initial_species.append(species_id)
+        elif colors is not None and species_id in colors:
+            colored_species.setdefault(tuple(colors[species_id]), []).append(
+                species_id)
+        else:
+            other_species.append(species_id)
 
+    renderer.draw_nodes(initial_species, radius=0.008)
+    for color, color_species in colored_species.items():
+        renderer.draw_node_squares(color_species, color=color, side=0.013)
+    renderer.draw_nodes(other_species)
 
-    left_angle_counter_step = 0.1
-    left_angle_counter = math.pi + compute_starting_angle(
-        starting_species_count,
-        left_angle_counter_step
-    )
 
-    for species_id in range(network_loader.number_of_species):
-        if network_loader.initial_state_array[species_id] > 0:
+def fired_reactions(network_loader):
+    reactions_which_fired = set()
+    for seed in network_loader.trajectories:
+        reactions_which_fired.update(
+            network_loader.trajectory_reaction_ids(seed).tolist())
 
-            renderer.new_node_boundary(species_id, left_angle_counter)
-            left_angle_counter += left_angle_counter_step
+    return reactions_which_fired
 
-        else:
-            renderer.new_node(species_id)
 
-    for reaction_id in reactions_which_fired:
-        print(reaction_id)
-        reaction = network_loader.index_to_reaction(reaction_id)
-        for i in range(reaction['number_of_reactants']):
-            for j in range(reaction['number_of_products']):
-                reactant_id = reaction['reactants'][i]
-                product_id = reaction['products'][j]
-                dG = reaction['dG']
-                renderer.draw_edge(reactant_id, product_id)
+def render_species(network_loader, path, layout_path=None):
+    renderer = Renderer()
+    layout_species(renderer, network_loader, layout_path=layout_path)
 
+    initial_species = []
+    other_species = []
     for species_id in range(network_loader.number_of_species):
         if network_loader.initial_state_array[species_id] > 0:
-            renderer.draw_node(species_id, radius=0.008)
-        elif species_id in colors:
-            renderer.draw_node_square(species_id, color=colors[species_id], side=0.013)
+            initial_species.append(species_id)
         else:
-            renderer.draw_node(species_id)
+            other_species.append(species_id)
+
+    renderer.draw_nodes(initial_species, radius=0.008)
+    renderer.draw_nodes(other_species, radius=0.002)
 
     renderer.render(path)
 
 
-def render_reactions_which_fired_new_positions(network_loader, colors, path):
+def render_reactions_which_fired(network_loader, colors, path, layout_path=None):
     renderer = Renderer()
-    reactions_which_fired = set()
-    for seed in network_loader.trajectories:
-        for step in network_loader.trajectories[seed]:
-            reaction_id = network_loader.trajectories[seed][step][0]
-            reaction = network_loader.index_to_reaction(reaction_id)
-            reactions_which_fired.add(reaction_id)
-
-    starting_species_count = 0
-    for species_id in range(network_loader.number_of_species):
-        if network_loader.initial_state_array[species_id] > 0:
-            starting_species_count += 1
-
-
+    layout_species(renderer, network_loader, layout_path=layout_path)
 
-    left_angle_counter_step = 0.1
-    left_angle_counter = math.pi + compute_starting_angle(
-        starting_species_count,
-        left_angle_counter_step
-    )
-    right_angle_counter_step = 0.1
-    right_angle_counter = compute_starting_angle(
-        len(colors),
-        right_angle_counter_step
-    )
-
-    for species_id in range(network_loader.number_of_species):
-        if network_loader.initial_state_array[species_id] > 0:
-
-            renderer.new_node_boundary(species_id, left_angle_counter)
-            left_angle_counter += left_angle_counter_step
+    renderer.draw_edges(reaction_edges(
+        network_loader,
+        fired_reactions(network_loader)))
 
-        elif species_id in colors:
+    draw_species(
+        renderer,
+        network_loader,
+        range(network_loader.number_of_species),
+        colors)
 
-            renderer.new_node_boundary(species_id, right_angle_counter)
-            right_angle_counter += right_angle_counter_step
+    renderer.render(path)
 
-        else:
-            renderer.new_node(species_id)
 
+def render_reactions_which_fired_new_positions(
+        network_loader,
+        colors,
+        path,
+        layout_path=None):
 
+    renderer = Renderer()
+    layout_species(
+        renderer,
+        network_loader,
+        boundary_colors=colors,
+        layout_path=layout_path)
 
-    for reaction_id in reactions_which_fired:
-        print(reaction_id)
-        reaction = network_loader.index_to_reaction(reaction_id)
-        for i in range(reaction['number_of_reactants']):
-            for j in range(reaction['number_of_products']):
-                reactant_id = reaction['reactants'][i]
-                product_id = reaction['products'][j]
-                dG = reaction['dG']
-                renderer.draw_edge(reactant_id, product_id)
+    renderer.draw_edges(reaction_edges(
+        network_loader,
+        fired_reactions(network_loader)))
 
-    for species_id in range(network_loader.number_of_species):
-        if network_loader.initial_state_array[species_id] > 0:
-            renderer.draw_node(species_id, radius=0.008)
-        elif species_id in colors:
-            renderer.draw_node_square(species_id, color=colors[species_id], side=0.013)
-        else:
-            renderer.draw_node(species_id)
+    draw_species(
+        renderer,
+        network_loader,
+        range(network_loader.number_of_species),
+        colors)
 
     renderer.render(path)
 
@@ -189,175 +204,154 @@ class PathfindingTransfer:
         return result
 
 
-def render_top_highlighted(pathfinding, colors, output_path, purple_id, num_threads=8, threshold=5):
-    renderer = Renderer(colors=[(0.7,0.7,0.7)])
+def top_pathway_reactions(pathfinding, colors, num_threads, threshold):
     reactions_in_top_pathways = set()
     species_in_top_pathways = set()
 
+    pathfinding.index_trajectories()
     pathfinding_transfer = PathfindingTransfer(pathfinding, threshold)
 
     with Pool(num_threads) as p:
         for result in p.map(pathfinding_transfer, list(colors.keys())):
             reactions_in_top_pathways.update(result)
 
-    purple = colors[purple_id]
-    pathways_lol = pathfinding.compute_pathways(purple_id)
-    highlighted_reactions = sorted(
-        pathways_lol,
-        key=lambda p: pathways_lol[p]['weight'])[2]
-
     for reaction_id in reactions_in_top_pathways:
         reaction = pathfinding.network_loader.index_to_reaction(reaction_id)
 
         for i in range(reaction['number_of_reactants']):
-            reactant_id = reaction['reactants'][i]
-            species_in_top_pathways.add(reactant_id)
+            species_in_top_pathways.add(reaction['reactants'][i])
 
         for j in range(reaction['number_of_products']):
-            product_id = reaction['products'][j]
-            species_in_top_pathways.add(product_id)
-
-
-    starting_species_count = 0
-    for species_id in range(pathfinding.network_loader.number_of_species):
-        if pathfinding.network_loader.initial_state_array[species_id] > 0:
-            starting_species_count += 1
-
-
-    left_angle_counter_step = 0.1
-    left_angle_counter = math.pi + compute_starting_angle(
-        starting_species_count,
-        left_angle_counter_step
-    )
-    right_angle_counter_step = 0.1
-    right_angle_counter = compute_starting_angle(
-        len(colors),
-        right_angle_counter_step
-    )
-
-    for species_id in range(pathfinding.network_loader.number_of_species):
-        if pathfinding.network_loader.initial_state_array[species_id] > 0:
+            species_in_top_pathways.add(reaction['products'][j])
 
-            renderer.new_node_boundary(species_id, left_angle_counter)
-            left_angle_counter += left_angle_counter_step
+    return reactions_in_top_pathways, species_in_top_pathways
 
-        elif species_id in colors:
-
-            renderer.new_node_boundary(species_id, right_angle_counter)
-            right_angle_counter += right_angle_counter_step
-
-        else:
-            renderer.new_node(species_id)
 
+def render_top_highlighted(
+        pathfinding,
+        colors,
+        output_path,
+        purple_id,
+        num_threads=8,
+        threshold=5,
+        layout_path=None):
 
-    for reaction_id in reactions_in_top_pathways:
-        print(reaction_id)
-        reaction = pathfinding.network_loader.index_to_reaction(reaction_id)
-        for i in range(reaction['number_of_reactants']):
-            for j in range(reaction['number_of_products']):
-                reactant_id = reaction['reactants'][i]
-                product_id = reaction['products'][j]
-                renderer.draw_edge(reactant_id, product_id)
+    renderer = Renderer(colors=[(0.7,0.7,0.7)])
+    reactions_in_top_pathways, species_in_top_pathways = top_pathway_reactions(
+        pathfinding, colors, num_threads, threshold)
 
-    for reaction_id in highlighted_reactions:
-        print(reaction_id)
-        reaction = pathfinding.network_loader.index_to_reaction(reaction_id)
-        for i in range(reaction['number_of_reactants']):
-            for j in range(reaction['number_of_products']):
-                reactant_id = reaction['reactants'][i]
-                product_id = reaction['products'][j]
-                renderer.draw_edge(reactant_id, product_id,color=purple,width=0.003)
+    purple = colors[purple_id]
+    pathways_lol = pathfinding.compute_pathways(purple_id)
+    highlighted_reactions = sorted(
+        pathways_lol,
+        key=lambda p: pathways_lol[p]['weight'])[2]
 
+    layout_species(
+        renderer,
+        pathfinding.network_loader,
+        boundary_colors=colors,
+        layout_path=layout_path)
 
+    renderer.draw_edges(reaction_edges(
+        pathfinding.network_loader,
+        reactions_in_top_pathways))
 
-    for species_id in species_in_top_pathways:
+    renderer.draw_edges(
+        reaction_edges(pathfinding.network_loader, highlighted_reactions),
+        color=purple,
+        width=0.003)
 
-        if pathfinding.network_loader.initial_state_array[species_id] > 0:
-            renderer.draw_node(species_id, radius=0.008)
-        elif species_id in colors:
-            renderer.draw_node_square(species_id, color=colors[species_id], side=0.013)
-        else:
-            renderer.draw_node(species_id)
+    draw_species(
+        renderer,
+        pathfinding.network_loader,
+        species_in_top_pathways,
+        colors)
 
     renderer.render(output_path)
 
 
 
-def render_top_pathways(pathfinding, colors, output_path, num_threads=8, threshold=5):
-    renderer = Renderer()
-    reactions_in_top_pathways = set()
-    species_in_top_pathways = set()
-
-    pathfinding_transfer = PathfindingTransfer(pathfinding, threshold)
-
-    with Pool(num_threads) as p:
-        for result in p.map(pathfinding_transfer, list(colors.keys())):
-            reactions_in_top_pathways.update(result)
-
-    for reaction_id in reactions_in_top_pathways:
-        reaction = pathfinding.network_loader.index_to_reaction(reaction_id)
-
-        for i in range(reaction['number_of_reactants']):
-            reactant_id = reaction['reactants'][i]
-            species_in_top_pathways.add(reactant_id)
-
-        for j in range(reaction['number_of_products']):
-            product_id = reaction['products'][j]
-            species_in_top_pathways.add(product_id)
-
-
-    starting_species_count = 0
-    for species_id in range(pathfinding.network_loader.number_of_species):
-        if pathfinding.network_loader.initial_state_array[species_id] > 0:
-            starting_species_count += 1
-
-
-    left_angle_counter_step = 0.1
-    left_angle_counter = math.pi + compute_starting_angle(
-        starting_species_count,
-        left_angle_counter_step
-    )
-    right_angle_counter_step = 0.1
-    right_angle_counter = compute_starting_angle(
-        len(colors),
-        right_angle_counter_step
-    )
+def render_top_pathways(
+        pathfinding,
+        colors,
+        output_path,
+        num_threads=8,
+        threshold=5,
+        layout_path=None):
 
-    for species_id in range(pathfinding.network_loader.number_of_species):
-        if pathfinding.network_loader.initial_state_array[species_id] > 0:
+    renderer = Renderer()
+    reactions_in_top_pathways, species_in_top_pathways = top_pathway_reactions(
+        pathfinding, colors, num_threads, threshold)
 
-            renderer.new_node_boundary(species_id, left_angle_counter)
-            left_angle_counter += left_angle_counter_step
+    layout_species(
+        renderer,
+        pathfinding.network_loader,
+        boundary_colors=colors,
+        layout_path=layout_path)
 
-        elif species_id in colors:
+    renderer.draw_edges(reaction_edges(
+        pathfinding.network_loader,
+        reactions_in_top_pathways))
 
-            renderer.new_node_boundary(species_id, right_angle_counter)
-            right_angle_counter += right_angle_counter_step
+    draw_species(
+        renderer,
+        pathfinding.network_loader,
+        species_in_top_pathways,
+        colors)
 
-        else:
-            renderer.new_node(species_id)
+    renderer.render(output_path)
 
 
-    for reaction_id in reactions_in_top_pathways:
-        print(reaction_id)
-        reaction = pathfinding.network_loader.index_to_reaction(reaction_id)
-        for i in range(reaction['number_of_reactants']):
-            for j in range(reaction['number_of_products']):
-                reactant_id = reaction['reactants'][i]
-                product_id = reaction['products'][j]
-                renderer.draw_edge(reactant_id, product_id)
-
+def report_data_columns(network_loader, reaction_ids):
+    """
+    the reactions with the given ids, and the entry id of every
+    species, as columns for a report data file. Reaction k of a report
+    data file is reaction_id[k], with reactants reaction_reactants[k]
+    (-1 padded) and so on. Species without an entry id get ''.
+    """
+    reactions = [network_loader.index_to_reaction(i) for i in reaction_ids]
+
+    return {
+        'reaction_id' : np.array(reaction_ids, dtype=np.int64),
+        'reaction_number_of_reactants' : np.array(
+            [r['number_of_reactants'] for r in reactions], dtype=np.int64),
+        'reaction_number_of_products' : np.array(
+            [r['number_of_products'] for r in reactions], dtype=np.int64),
+        'reaction_reactants' : np.array(
+            [r['reactants'] for r in reactions], dtype=np.int64).reshape(-1, 2),
+        'reaction_products' : np.array(
+            [r['products'] for r in reactions], dtype=np.int64).reshape(-1, 2),
+        'reaction_rate' : np.array(
+            [r['rate'] for r in reactions], dtype=np.float64),
+        'reaction_dG' : np.array(
+            [r['dG'] for r in reactions], dtype=np.float64),
+        'reaction_dG_barrier' : np.array(
+            [r['dG_barrier'] for r in reactions], dtype=np.float64),
+        'species_entry_id' : np.array(
+            ["" if m.entry_id is None else str(m.entry_id)
+             for m in network_loader.mol_entries],
+            dtype=np.str_).reshape(-1)
+    }
+
+
+def save_report_data(path, network_loader, reaction_ids, columns):
+    """
+    write the data of a report as a compressed npz file, together with
+    the reactions it refers to (see report_data_columns). The reports
+    below write one if they are given a report_data_path, from the
+    same data as their LaTeX.
+    """
+    data = report_data_columns(network_loader, reaction_ids)
+    data.update(columns)
+    np.savez_compressed(path, **data)
 
-    for species_id in species_in_top_pathways:
 
-        if pathfinding.network_loader.initial_state_array[species_id] > 0:
-            renderer.draw_node(species_id, radius=0.008)
-        elif species_id in colors:
-            renderer.draw_node_square(species_id, color=colors[species_id], side=0.013)
-        else:
-            renderer.draw_node(species_id)
-
-    renderer.render(output_path)
+def load_report_data(path):
+    """
+    the columns of a report data file, as a dict of arrays
+    """
+    with np.load(path) as data:
+        return {name : data[name] for name in data.files}
 
 
 def redox_report(
@@ -442,32 +436,49 @@ def decoordination_report(
 
 
 
-def export_tally_to_json(network_loader, path):
-    reaction_tally = {}
-    reactions = {}
-    for seed in network_loader.trajectories:
-        for step in network_loader.trajectories[seed]:
-            reaction_id = network_loader.trajectories[seed][step][0]
-
-            db_reaction = network_loader.index_to_reaction(reaction_id)
-            json_reactants = [ network_loader.mol_entries[i].entry_id
-                               for i in db_reaction['reactants'] if i != -1]
-            json_products = [ network_loader.mol_entries[i].entry_id
-                              for i in db_reaction['products'] if i != -1]
-            json_reaction = {
-                'reactants' : json_reactants,
-                'products' : json_products
-            }
-
-            if reaction_id not in reactions:
-                reactions[reaction_id] = json_reaction
+def compute_reaction_tally(network_loader, streaming=False):
+    """
+    dict mapping the reactions which fired to the number of times they
+    fired, in order of first firing. If streaming is True, the counting
+    is done by sqlite directly on the initial state databases (see
+    NetworkLoader.load_reaction_tally), so the trajectories never need
+    to be loaded.
+    """
+    if streaming:
+        if network_loader.reaction_tally is None:
+            network_loader.load_reaction_tally()
 
+        return network_loader.reaction_tally
 
+    reaction_tally = {}
+    for seed in network_loader.trajectories:
+        for reaction_id in network_loader.trajectory_reaction_ids(seed).tolist():
             if reaction_id in reaction_tally:
                 reaction_tally[reaction_id] += 1
             else:
                 reaction_tally[reaction_id] = 1
 
+    return reaction_tally
+
+
+def export_tally_to_json(network_loader, path, streaming=False):
+    reaction_tally = compute_reaction_tally(network_loader, streaming)
+    network_loader.prefetch_reactions(list(reaction_tally.keys()))
+
+    reactions = {}
+    for reaction_id in reaction_tally:
+        db_reaction = network_loader.index_to_reaction(reaction_id)
+        json_reactants = [ network_loader.mol_entries[i].entry_id
+                           for i in db_reaction['reactants'] if i != -1]
+        json_products = [ network_loader.mol_entries[i].entry_id
+                          for i in db_reaction['products'] if i != -1]
+        json_reaction = {
+            'reactants' : json_reactants,
+            'products' : json_products
+        }
+
+        reactions[reaction_id] = json_reaction
+
     dumpfn({
         'pathways' : reaction_tally,
         'reactions' : reactions}, path)
@@ -479,28 +490,30 @@ def export_tally_to_json(network_loader, path):
 def reaction_tally_report(
         network_loader,
         reaction_tally_report_path,
-        cutoff=10):
-
-    reaction_tally = {}
-    species_set = set()
-    for seed in network_loader.trajectories:
-        for step in network_loader.trajectories[seed]:
-            reaction_id = network_loader.trajectories[seed][step][0]
+        cutoff=10,
+        streaming=False,
+        report_data_path=None):
+    """
+    if report_data_path is given, the number of firings of every
+    reaction which fired, not just those above the cutoff, is written
+    there as report data, in order of first firing. count[k] is the
+    number of firings of reaction_id[k].
+    """
 
-            reaction = network_loader.index_to_reaction(reaction_id)
+    reaction_tally = compute_reaction_tally(network_loader, streaming)
+    network_loader.prefetch_reactions(list(reaction_tally.keys()))
 
-            if reaction_id in reaction_tally:
-                reaction_tally[reaction_id] += 1
-            else:
-                reaction_tally[reaction_id] = 1
+    species_set = set()
+    for reaction_id in reaction_tally:
+        reaction = network_loader.index_to_reaction(reaction_id)
 
-            for i in range(reaction['number_of_reactants']):
-                reactant_id = reaction['reactants'][i]
-                species_set.add(reactant_id)
+        for i in range(reaction['number_of_reactants']):
+            reactant_id = reaction['reactants'][i]
+            species_set.add(reactant_id)
 
-            for j in range(reaction['number_of_products']):
-                product_id = reaction['products'][j]
-                species_set.add(product_id)
+        for j in range(reaction['number_of_products']):
+            product_id = reaction['products'][j]
+            species_set.add(product_id)
 
 
 
@@ -536,6 +549,14 @@ def reaction_tally_report(
 
     report_generator.finished()
 
+    if report_data_path is not None:
+        save_report_data(
+            report_data_path,
+            network_loader,
+            list(reaction_tally.keys()),
+            {'count' : np.array(list(reaction_tally.values()), dtype=np.int64),
+             'number_of_species_observed' : np.array(len(species_set))})
+
 def species_report(network_loader, species_report_path):
     """
     print all species
@@ -631,41 +652,110 @@ class Pathfinding:
 
     def __init__(
             self,
-            network_loader
+            network_loader,
+            pathway_cache_size=1000000
     ):
+        """
+        pathway_cache_size bounds the number of (seed, species_id)
+        pathways which are remembered. Since the pathway producing an
+        intermediate doesn't depend on the target, these are shared
+        between all the targets.
+        """
 
         self.network_loader = network_loader
-        self.pathways = {}                   
+        self.network_loader.prefetch_reactions()
+        self.pathways = {}
+        self.first_production = {}
+
+        self.pathway_cache_size = pathway_cache_size
+        self.pathway_cache = OrderedDict()
+        self.pathway_cache_hits = 0
+        self.pathway_cache_misses = 0
+        self.pathway_cache_bytes = 0
+
+
+    def compute_first_production(self, seed):
+        """
+        dict mapping each species produced in a trajectory to the
+        reaction which first produced it. This is computed once per seed
+        and shared by every target species.
+        """
+        if seed not in self.first_production:
+            reaction_ids = self.network_loader.trajectory_reaction_ids(seed)
+            reaction_table = self.network_loader.prefetch_reactions(reaction_ids)
+            products = reaction_table.products[
+                reaction_table.positions(reaction_ids)].ravel()
+
+            # products are laid out step by step, so the first occurrence
+            # of a species is in the first step which produced it
+            produced = products != -1
+            species, first_occurrence = np.unique(
+                products[produced], return_index=True)
+            steps = np.nonzero(produced)[0][first_occurrence] // 2
+
+            self.first_production[seed] = dict(zip(
+                species.tolist(),
+                reaction_ids[steps].tolist()))
+
+        return self.first_production[seed]
+
+
+    def index_trajectories(self):
+        """
+        compute the first production index for every seed, e.g. before
+        handing the pathfinding object to a process pool.
+        """
+        for seed in self.network_loader.trajectories:
+            self.compute_first_production(seed)
 
 
     def compute_pathway(
             self,
             species_id,
-            trajectory): 
+            seed):
+
+        key = (seed, species_id)
+        if key in self.pathway_cache:
+            self.pathway_cache_hits += 1
+            self.pathway_cache.move_to_end(key)
+            return list(self.pathway_cache[key])
+
+        self.pathway_cache_misses += 1
+        pathway = self.compute_pathway_uncached(species_id, seed)
+
+        cached_pathway = tuple(pathway)
+        self.pathway_cache[key] = cached_pathway
+        self.pathway_cache_bytes += sys.getsizeof(cached_pathway)
+        while len(self.pathway_cache) > self.pathway_cache_size:
+            _, evicted_pathway = self.pathway_cache.popitem(last=False)
+            self.pathway_cache_bytes -= sys.getsizeof(evicted_pathway)
+
+        return pathway
+
+
+    def compute_pathway_uncached(
+            self,
+            species_id,
+            seed):
 
+        first_production = self.compute_first_production(seed)
         pathway = [] #will be a list of reaction_ids
-        target_produced = False
 
-        for step in trajectory: #trajectory contains every step that ocurred in a given RNMC run
-            reaction_id = trajectory[step][0] 
+        if species_id in first_production: #the reaction that first produced this species
+            reaction_id = first_production[species_id]
             reaction = self.network_loader.index_to_reaction(reaction_id)
-            if species_id in reaction['products']: #ends iteration after finding the reaction that first produced this species as a product
-                target_produced = True 
-                break
-
-        if target_produced:
             pathway.append(reaction_id)
 
             prefixes = []
             for i in range(reaction['number_of_reactants']): #iterates through reactants in the reaction we found
                 reactant_id = reaction['reactants'][i]
                 if self.network_loader.initial_state_dict[reactant_id] == 0: #i.e. this is not a starting species
-                    prefix = self.compute_pathway(reactant_id, trajectory)  #recursive step, returns pathways forming this reactant
+                    prefix = self.compute_pathway(reactant_id, seed)  #recursive step, returns pathways forming this reactant
                     prefixes.append(prefix)
 
                     # alternative base case where the products of a prefix reaction
                     # are the reactants of our reaction
-                    
+
                     prefix_final_reaction = self.network_loader.index_to_reaction(
                         prefix[-1])
 
@@ -688,10 +778,7 @@ class Pathfinding:
         if species_id not in self.pathways:
             reaction_pathway_list = []
             for seed in self.network_loader.trajectories: #dict of the form: trajectories[seed][step] = (reaction_id, time)
-                pathway = self.compute_pathway(
-                    species_id,
-                    self.network_loader.trajectories[seed]
-                )
+                pathway = self.compute_pathway(species_id, seed)
 
                 if len(pathway) > 0:
                     reaction_pathway_list.append(pathway)
@@ -702,6 +789,25 @@ class Pathfinding:
         return self.pathways[species_id]
 
 
+    def pathway_cache_stats(self):
+        """
+        hit rate and approximate memory use of the pathway cache
+        """
+        lookups = self.pathway_cache_hits + self.pathway_cache_misses
+        if lookups > 0:
+            hit_rate = self.pathway_cache_hits / lookups
+        else:
+            hit_rate = 0.0
+
+        return {
+            "hits" : self.pathway_cache_hits,
+            "misses" : self.pathway_cache_misses,
+            "hit_rate" : hit_rate,
+            "entries" : len(self.pathway_cache),
+            "bytes" : self.pathway_cache_bytes
+        }
+
+
     def collect_duplicate_pathways(
         self, pathways
     ):
@@ -752,13 +858,38 @@ def export_pathways_to_json(pathfinding, species_id, path):
 
 
 
+def export_sink_pathways_to_json(simulation_replayer, pathfinding, directory):
+    """
+    write <species_index>_pathway.json into directory for every sink.
+    The pathfinding cache is shared between the sinks, so intermediates
+    common to several of them are only traced once per seed.
+    """
+    for species_index in simulation_replayer.sinks:
+        export_pathways_to_json(
+            pathfinding,
+            species_index,
+            os.path.join(directory, str(species_index) + "_pathway.json"))
+
+    return pathfinding.pathway_cache_stats()
+
+
+
 def pathway_report(
         pathfinding,
         species_id,
         report_file_path,
         number_of_pathways=100,
-        sort_by_frequency=False
+        sort_by_frequency=False,
+        report_data_path=None
 ):
+    """
+    if report_data_path is given, the pathways in the report are
+    written there as report data, in the same order. Pathway k has
+    frequency pathway_frequency[k], weight pathway_weight[k] and
+    reactions
+
+      pathway_reaction_ids[pathway_offsets[k]:pathway_offsets[k+1]]
+    """
 
     report_generator = ReportGenerator(
         pathfinding.network_loader.mol_entries,
@@ -796,9 +927,11 @@ def pathway_report(
             return item[1]["weight"]
 
 
+    reported_pathways = []
     count = 1
     for _, unique_pathway in sorted(pathways.items(), key=sort_function):
 
+        reported_pathways.append(unique_pathway)
         frequency = unique_pathway["frequency"]
         weight = unique_pathway["weight"]
 
@@ -817,6 +950,175 @@ def pathway_report(
 
     report_generator.finished()
 
+    if report_data_path is not None:
+        pathway_offsets = np.zeros(len(reported_pathways) + 1, dtype=np.int64)
+        np.cumsum(
+            [len(p["pathway"]) for p in reported_pathways],
+            out=pathway_offsets[1:])
+
+        pathway_reaction_ids = [
+            reaction_index
+            for p in reported_pathways
+            for reaction_index in p["pathway"]]
+
+        save_report_data(
+            report_data_path,
+            pathfinding.network_loader,
+            list(OrderedDict.fromkeys(pathway_reaction_ids)),
+            {'species_id' : np.array(species_id),
+             'pathway_offsets' : pathway_offsets,
+             'pathway_reaction_ids' : np.array(
+                 pathway_reaction_ids, dtype=np.int64),
+             'pathway_frequency' : np.array(
+                 [p["frequency"] for p in reported_pathways], dtype=np.int64),
+             'pathway_weight' : np.array(
+                 [p["weight"] for p in reported_pathways], dtype=np.float64)})
+
+
+def first_fired_order(fired):
+    """
+    the distinct reaction ids in fired, ordered by first appearance,
+    and for each entry of fired, the position of its reaction id in
+    that ordering.
+    """
+    unique_reactions, first_fired, inverse = np.unique(
+        fired, return_index=True, return_inverse=True)
+
+    order = np.argsort(first_fired, kind='stable')
+    rank = np.empty_like(order)
+    rank[order] = np.arange(order.shape[0])
+
+    return unique_reactions[order], rank[inverse]
+
+
+def count_firings(trajectories, seeds):
+    """
+    the reactions which fired in the given seeds, ordered by when they
+    first fired, and a sparse reactions x seeds matrix counting how
+    many times each of them fired in each seed.
+    """
+    fired_per_seed = [
+        trajectory_reaction_ids(trajectories, seed) for seed in seeds]
+
+    seed_lengths = np.array(
+        [fired_ids.shape[0] for fired_ids in fired_per_seed],
+        dtype=np.int64)
+
+    fired = np.concatenate(
+        [np.zeros(0, dtype=np.int32)] + fired_per_seed)
+
+    # ordering the reactions by first firing makes the dicts built
+    # from them come out in the same order as a step by step walk
+    fired_reactions, step_rows = first_fired_order(fired)
+
+    firing_counts = csr_matrix(
+        (np.ones(fired.shape[0], dtype=np.int64),
+         (step_rows, np.repeat(np.arange(len(seeds)), seed_lengths))),
+        shape=(fired_reactions.shape[0], len(seeds)))
+
+    return fired_reactions, firing_counts
+
+
+def merge_firing_counts(shard_results):
+    """
+    combine the output of count_firings on consecutive shards of seeds
+    into the output count_firings would give on all the seeds.
+    """
+    fired_reactions, _ = first_fired_order(
+        np.concatenate([np.zeros(0, dtype=np.int32)] +
+                       [shard_fired for shard_fired, _ in shard_results]))
+
+    sorted_order = np.argsort(fired_reactions)
+    sorted_reactions = fired_reactions[sorted_order]
+
+    shard_matrices = []
+    for shard_fired, shard_counts in shard_results:
+        rows = sorted_order[np.searchsorted(sorted_reactions, shard_fired)]
+        shard_counts = shard_counts.tocoo()
+        shard_matrices.append(csr_matrix(
+            (shard_counts.data, (rows[shard_counts.row], shard_counts.col)),
+            shape=(fired_reactions.shape[0], shard_counts.shape[1])))
+
+    return fired_reactions, csr_matrix(hstack(shard_matrices))
+
+
+class ReplayShard:
+    """
+    replays a shard of seeds for SimulationReplayer. When the
+    trajectories live in a TrajectoryStore, it is reopened from disk in
+    each worker. Otherwise each worker reads its seeds from the initial
+    state databases.
+    """
+
+    def __init__(self, trajectory_source):
+        self.trajectory_source = trajectory_source
+
+    def __call__(self, seeds):
+        if isinstance(self.trajectory_source, TrajectoryStore):
+            trajectories = self.trajectory_source
+
+        else:
+            trajectories = TrajectoryStore.concatenate([
+                TrajectoryStore.from_database(
+                    sqlite3.connect(initial_state_database),
+                    seeds=seeds)
+                for initial_state_database in self.trajectory_source])
+
+        return count_firings(trajectories, seeds)
+
+
+def stoichiometry_matrices(reaction_table, rows, number_of_species):
+    """
+    sparse species x reaction matrices whose k-th columns count how
+    many times each species is a reactant / product of the reaction in
+    row rows[k] of reaction_table.
+    """
+    shape = (number_of_species, rows.shape[0])
+    columns = np.arange(rows.shape[0])
+
+    def participation_matrix(species, counts):
+        species_entries = []
+        column_entries = []
+        for slot in range(2):
+            mask = counts[rows] > slot
+            species_entries.append(species[rows[mask], slot])
+            column_entries.append(columns[mask])
+
+        species_entries = np.concatenate(species_entries)
+        column_entries = np.concatenate(column_entries)
+
+        return csr_matrix(
+            (np.ones(species_entries.shape[0], dtype=np.int64),
+             (species_entries, column_entries)),
+            shape=shape)
+
+    return (
+        participation_matrix(
+            reaction_table.reactants,
+            reaction_table.number_of_reactants),
+        participation_matrix(
+            reaction_table.products,
+            reaction_table.number_of_products))
+
+
+def occurrence_dicts(participation, total_firings, fired_reactions):
+    """
+    for each species, a dict mapping the reactions which it takes part
+    in to the number of times it took part in them.
+    """
+    occurrences = csr_matrix(participation.multiply(total_firings[np.newaxis, :]))
+    occurrences.sort_indices()
+
+    result = {}
+    for i in range(occurrences.shape[0]):
+        start = occurrences.indptr[i]
+        end = occurrences.indptr[i+1]
+        result[i] = dict(zip(
+            fired_reactions[occurrences.indices[start:end]].tolist(),
+            occurrences.data[start:end].tolist()))
+
+    return result
+
 
 class SimulationReplayer:
     """
@@ -825,87 +1127,97 @@ class SimulationReplayer:
     reactions fire / update reaction propensities.
     """
 
-    def __init__(self, network_loader):
+    def __init__(self, network_loader, num_workers=1):
+        """
+        if num_workers > 1, the trajectories are split into contiguous
+        shards of seeds which are replayed in a process pool. The
+        result is identical to the serial replay.
+        """
         self.network_loader = network_loader
+        self.num_workers = num_workers
 
-
+        self.replay()
         self.compute_expected_final_state()
         self.compute_production_consumption_info()
         self.compute_sink_data()
 
 
-    def compute_expected_final_state(self):
-        self.expected_final_state = np.zeros(
-            self.network_loader.number_of_species,
-            dtype=int
-        )
+    def replay(self):
+        """
+        single pass over the trajectories which records how many times
+        each reaction fired in each seed. Everything else the replayer
+        computes is a sparse product against these counts.
+
+        self.fired_reactions lists the reactions which fired, ordered by
+        when they first fired, and row k of self.firing_counts and
+        column k of self.consumed and self.produced refer to
+        self.fired_reactions[k]. self.firing_counts has one column per
+        seed, in the iteration order of network_loader.trajectories.
+        """
+        trajectories = self.network_loader.trajectories
+        seeds = list(trajectories)
+
+        if self.num_workers > 1:
+            if isinstance(trajectories, TrajectoryStore):
+                replay_shard = ReplayShard(trajectories)
+            else:
+                replay_shard = ReplayShard(
+                    self.network_loader.trajectory_databases)
 
-        for seed in self.network_loader.trajectories:
-            state = np.copy(self.network_loader.initial_state_array)
-            for step in self.network_loader.trajectories[seed]:
-                reaction_index = self.network_loader.trajectories[seed][step][0]
-                time = self.network_loader.trajectories[seed][step][1]
-                reaction = self.network_loader.index_to_reaction(reaction_index)
+            shards = [
+                shard.tolist() for shard in
+                np.array_split(np.array(seeds, dtype=np.int64), self.num_workers)]
+
+            with Pool(self.num_workers) as p:
+                shard_results = p.map(replay_shard, shards)
+
+            self.fired_reactions, self.firing_counts = merge_firing_counts(
+                shard_results)
+
+        else:
+            self.fired_reactions, self.firing_counts = count_firings(
+                trajectories, seeds)
+
+        self.total_firings = np.asarray(
+            self.firing_counts.sum(axis=1), dtype=np.int64).ravel()
 
-                for i in range(reaction['number_of_reactants']):
-                    reactant_index = reaction['reactants'][i]
-                    state[reactant_index] -= 1
+        reaction_table = self.network_loader.prefetch_reactions(
+            self.fired_reactions)
 
-                for j in range(reaction['number_of_products']):
-                    product_index = reaction['products'][j]
-                    state[product_index] += 1
+        self.consumed, self.produced = stoichiometry_matrices(
+            reaction_table,
+            reaction_table.positions(self.fired_reactions),
+            self.network_loader.number_of_species)
 
-            self.expected_final_state += state
+
+    def compute_expected_final_state(self):
+        net_change = (
+            self.produced.dot(self.total_firings) -
+            self.consumed.dot(self.total_firings))
+
+        self.expected_final_state = (
+            len(self.network_loader.trajectories) *
+            self.network_loader.initial_state_array +
+            net_change)
 
         self.expected_final_state = (
             self.expected_final_state / len(self.network_loader.trajectories))
 
     def compute_trajectory_final_states(self):
-        self.final_states = {}
-        for seed in self.network_loader.trajectories:
-            state = np.copy(self.network_loader.initial_state_array)
-            for step in self.network_loader.trajectories[seed]:
-                reaction_index = self.network_loader.trajectories[seed][step][0]
-                time = self.network_loader.trajectories[seed][step][1]
-                reaction = self.network_loader.index_to_reaction(reaction_index)
-
-                for i in range(reaction['number_of_reactants']):
-                    reactant_index = reaction['reactants'][i]
-                    state[reactant_index] -= 1
+        net_changes = (
+            (self.produced - self.consumed).dot(self.firing_counts).toarray())
 
-                for j in range(reaction['number_of_products']):
-                    product_index = reaction['products'][j]
-                    state[product_index] += 1
-            self.final_states[seed] = state
+        self.final_states = {}
+        for k, seed in enumerate(self.network_loader.trajectories):
+            self.final_states[seed] = (
+                self.network_loader.initial_state_array + net_changes[:, k])
 
     def compute_production_consumption_info(self):
-        self.consuming_reactions = {}
-        self.producing_reactions = {}
-
-        for i in range(self.network_loader.number_of_species):
-            self.consuming_reactions[i] = {}
-            self.producing_reactions[i] = {}
+        self.consuming_reactions = occurrence_dicts(
+            self.consumed, self.total_firings, self.fired_reactions)
 
-        for seed in self.network_loader.trajectories:
-            for step in self.network_loader.trajectories[seed]:
-                reaction_index = self.network_loader.trajectories[seed][step][0]
-                time = self.network_loader.trajectories[seed][step][1]
-                reaction = self.network_loader.index_to_reaction(reaction_index)
-
-                for i in range(reaction['number_of_reactants']):
-                    reactant_index = reaction['reactants'][i]
-                    if reaction_index not in self.consuming_reactions[reactant_index]:
-                        self.consuming_reactions[reactant_index][reaction_index] = 1
-                    else:
-                        self.consuming_reactions[reactant_index][reaction_index] += 1
-
-
-                for j in range(reaction['number_of_products']):
-                    product_index = reaction['products'][j]
-                    if reaction_index not in self.producing_reactions[product_index]:
-                        self.producing_reactions[product_index][reaction_index] = 1
-                    else:
-                        self.producing_reactions[product_index][reaction_index] += 1
+        self.producing_reactions = occurrence_dicts(
+            self.produced, self.total_firings, self.fired_reactions)
 
     def compute_state_time_series(self, seed):
         state_dimension_size = len(self.network_loader.initial_state_array)
@@ -1191,8 +1503,14 @@ def export_species_report_to_json(network_loader, path):
 def consumption_report(
         simulation_replayer,
         species_index,
-        consumption_report_path
+        consumption_report_path,
+        report_data_path=None
 ):
+    """
+    if report_data_path is given, the consuming and producing reactions
+    and their counts are written there as report data, in the same
+    order as the report.
+    """
 
     sink_data = simulation_replayer.sink_data[species_index]
 
@@ -1210,10 +1528,15 @@ def consumption_report(
     report_generator.emit_text("expected val: " +
                                str(sink_data["expected_value"]))
     report_generator.emit_newline()
+    consuming_sorted = sorted(
+        consuming_reactions.items(),
+        key=lambda item: -item[1])
+    producing_sorted = sorted(
+        producing_reactions.items(),
+        key=lambda item: -item[1])
+
     report_generator.emit_text("consuming reactions:")
-    for (reaction_index, number) in sorted(
-            consuming_reactions.items(),
-            key=lambda item: -item[1]):
+    for (reaction_index, number) in consuming_sorted:
 
         reaction = simulation_replayer.network_loader.index_to_reaction(
             reaction_index)
@@ -1222,9 +1545,7 @@ def consumption_report(
 
 
     report_generator.emit_text("producing reactions:")
-    for (reaction_index, number) in sorted(
-            producing_reactions.items(),
-            key=lambda item: -item[1]):
+    for (reaction_index, number) in producing_sorted:
 
         reaction = simulation_replayer.network_loader.index_to_reaction(
             reaction_index)
@@ -1235,12 +1556,36 @@ def consumption_report(
 
     report_generator.finished()
 
+    if report_data_path is not None:
+        save_report_data(
+            report_data_path,
+            simulation_replayer.network_loader,
+            list(OrderedDict.fromkeys(
+                [i for (i, _) in consuming_sorted] +
+                [i for (i, _) in producing_sorted])),
+            {'species_index' : np.array(species_index),
+             'ratio' : np.array(sink_data["ratio"]),
+             'expected_value' : np.array(sink_data["expected_value"]),
+             'consuming_reaction_id' : np.array(
+                 [i for (i, _) in consuming_sorted], dtype=np.int64),
+             'consuming_count' : np.array(
+                 [n for (_, n) in consuming_sorted], dtype=np.int64),
+             'producing_reaction_id' : np.array(
+                 [i for (i, _) in producing_sorted], dtype=np.int64),
+             'producing_count' : np.array(
+                 [n for (_, n) in producing_sorted], dtype=np.int64)})
+
 
 def sink_report(
         simulation_replayer,
-        sink_report_path
+        sink_report_path,
+        report_data_path=None
 ):
-
+    """
+    if report_data_path is given, the sink data of every species is
+    written there as report data, one column per sink_data field
+    indexed by species, together with the sinks in report order.
+    """
 
     report_generator = ReportGenerator(
         simulation_replayer.network_loader.mol_entries,
@@ -1288,11 +1633,31 @@ def sink_report(
 
     report_generator.finished()
 
+    if report_data_path is not None:
+        species = range(simulation_replayer.network_loader.number_of_species)
+        columns = {
+            name : np.array(
+                [simulation_replayer.sink_data[i][name] for i in species])
+            for name in simulation_replayer.sink_data[0]}
+
+        columns['sinks'] = np.array(sinks_sorted, dtype=np.int64)
+        save_report_data(
+            report_data_path,
+            simulation_replayer.network_loader,
+            [],
+            columns)
+
 
 def final_state_report(
         simulation_replayer,
-        final_state_report_path
+        final_state_report_path,
+        report_data_path=None
 ):
+    """
+    if report_data_path is given, the species with a positive expected
+    final amount are written there as report data, as species_index
+    and amount columns in the same order as the report.
+    """
     final_state = []
     for species_index, value in enumerate(simulation_replayer.expected_final_state):
         if value > 0.0:
@@ -1310,3 +1675,14 @@ def final_state_report(
         report_generator.emit_newline()
     report_generator.finished()
 
+    if report_data_path is not None:
+        save_report_data(
+            report_data_path,
+            simulation_replayer.network_loader,
+            [],
+            {'species_index' : np.array(
+                [entry["index"] for entry in sorted_final_state], dtype=np.int64),
+             'amount' : np.array(
+                 [entry["value"] for entry in sorted_final_state],
+                 dtype=np.float64)})
+
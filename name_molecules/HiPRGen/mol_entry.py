@@ -96,6 +96,8 @@ class MoleculeEntry:
 
         self.atom_locations = [site.coords for site in self.molecule]
 
+        # free energies by temperature, see tabulate_free_energy
+        self.free_energy_table = {}
         self.free_energy = self.get_free_energy()
 
         self.non_metal_atoms = [
@@ -307,12 +309,29 @@ class MoleculeEntry:
         """
         Get the free energy at the give temperature.
         """
+        # entries pickled before free_energy_table was added don't have it
+        free_energy_table = self.__dict__.get("free_energy_table")
+        if free_energy_table is not None and temperature in free_energy_table:
+            return free_energy_table[temperature]
+
         if self.enthalpy is not None and self.entropy is not None:
             # TODO: fix these hard coded vals
             return self.energy + self.enthalpy - temperature * self.entropy
         else:
             return None
 
+    def tabulate_free_energy(self, temperature: float = ROOM_TEMP):
+        """
+        store the free energy at the given temperature, so that
+        get_free_energy looks it up rather than computing it. Reaction
+        filtering does this once for its temperature before filtering.
+        """
+        if "free_energy_table" not in self.__dict__:
+            self.free_energy_table = {}
+
+        self.free_energy_table.pop(temperature, None)
+        self.free_energy_table[temperature] = self.get_free_energy(temperature)
+
     def __repr__(self):
 
         output = [
@@ -0,0 +1,380 @@
+import os
+import networkx as nx
+import numpy as np
+from HiPRGen.constants import ROOM_TEMP
+
+"""
+compact, array based copy of mol_entries.
+
+mol_entries.pickle holds pymatgen Molecules, MoleculeGraphs and
+networkx graphs, so every process which loads it builds its own copy
+of all of them. MolEntryArrays stores what later phases look up about
+each species as flat numpy arrays in a directory of .npy files, which
+are memory mapped when loaded, so processes on the same node share one
+read only copy.
+"""
+
+
+def csr_offsets(counts):
+    offsets = np.zeros(len(counts) + 1, dtype=np.int64)
+    np.cumsum(counts, out=offsets[1:])
+    return offsets
+
+
+def string_array(strings):
+    # np.array of an empty list has dtype float
+    return np.array(strings, dtype=np.str_).reshape(len(strings))
+
+
+def optional_float(value):
+    if value is None:
+        return np.nan
+    else:
+        return value
+
+
+def optional_value(value):
+    # inverse of optional_float
+    value = float(value)
+    if np.isnan(value):
+        return None
+    else:
+        return value
+
+
+class MolEntryRecord:
+    """
+    read only view of species i of a MolEntryArrays, with the
+    attributes of MoleculeEntry which don't need pymatgen or networkx.
+    """
+
+    def __init__(self, arrays, i):
+        self.arrays = arrays
+        self.ind = i
+
+    @property
+    def entry_id(self):
+        entry_id = str(self.arrays.entry_ids[self.ind])
+        if entry_id == "":
+            return None
+        else:
+            return entry_id
+
+    @property
+    def formula(self):
+        return str(self.arrays.formulas[self.arrays.formula_id[self.ind]])
+
+    @property
+    def charge(self):
+        return int(self.arrays.charge[self.ind])
+
+    @property
+    def spin_multiplicity(self):
+        spin_multiplicity = int(self.arrays.spin_multiplicity[self.ind])
+        if spin_multiplicity == -1:
+            return None
+        else:
+            return spin_multiplicity
+
+    @property
+    def num_atoms(self):
+        return int(self.arrays.num_atoms[self.ind])
+
+    @property
+    def energy(self):
+        return optional_value(self.arrays.energy[self.ind])
+
+    @property
+    def enthalpy(self):
+        return optional_value(self.arrays.enthalpy[self.ind])
+
+    @property
+    def entropy(self):
+        return optional_value(self.arrays.entropy[self.ind])
+
+    @property
+    def electron_affinity(self):
+        return optional_value(self.arrays.electron_affinity[self.ind])
+
+    @property
+    def ionization_energy(self):
+        return optional_value(self.arrays.ionization_energy[self.ind])
+
+    @property
+    def free_energy(self):
+        return self.get_free_energy()
+
+    @property
+    def solvation_correction(self):
+        return optional_value(self.arrays.solvation_correction[self.ind])
+
+    @property
+    def species(self):
+        return self.arrays.species(self.ind)
+
+    @property
+    def covalent_hash(self):
+        return self.arrays.hash(self.arrays.covalent_hash[self.ind])
+
+    @property
+    def total_hash(self):
+        return self.arrays.hash(self.arrays.total_hash[self.ind])
+
+    def get_free_energy(self, temperature=ROOM_TEMP):
+        return optional_value(self.arrays.free_energies(temperature)[self.ind])
+
+
+class MolEntryArrays:
+    """
+    species i has
+
+      charge[i], spin_multiplicity[i] (-1 if unknown), num_atoms[i],
+      energy[i], enthalpy[i], entropy[i], solvation_correction[i],
+      electron_affinity[i], ionization_energy[i] (nan if unknown),
+      entry_ids[i] ('' if None) and formulas[formula_id[i]].
+
+    its atoms are atom_offsets[i] to atom_offsets[i+1], atom a having
+    species elements[atom_species[a]]. The covalent graph is stored in
+    CSR format: the neighbors of atom a (as indices within the
+    molecule, once per bond) are
+
+      covalent_neighbors[neighbor_offsets[a]:neighbor_offsets[a+1]]
+
+    and covalent_atom[a] is False for the metal atoms, which aren't in
+    the covalent graph.
+
+    hashes are stored once in the hash table hashes, and referred to by
+    their index, -1 meaning no hash. covalent_hash[i] and total_hash[i]
+    are the hashes of species i. Its fragment complexes are
+    fragment_complex_offsets[i] to fragment_complex_offsets[i+1], and
+    fragment complex c breaks fragment_bonds_broken[c] bonds into the
+    fragments with hashes
+
+      fragment_hash_ids[fragment_hash_offsets[c]:fragment_hash_offsets[c+1]]
+    """
+
+    array_names = [
+        "charge",
+        "spin_multiplicity",
+        "num_atoms",
+        "energy",
+        "enthalpy",
+        "entropy",
+        "solvation_correction",
+        "electron_affinity",
+        "ionization_energy",
+        "entry_ids",
+        "formula_id",
+        "formulas",
+        "atom_offsets",
+        "atom_species",
+        "elements",
+        "neighbor_offsets",
+        "covalent_neighbors",
+        "covalent_atom",
+        "hashes",
+        "covalent_hash",
+        "total_hash",
+        "fragment_complex_offsets",
+        "fragment_bonds_broken",
+        "fragment_hash_offsets",
+        "fragment_hash_ids"]
+
+    def __init__(self, **arrays):
+        for name in self.array_names:
+            setattr(self, name, arrays[name])
+
+        self.free_energy_cache = {}
+
+    @classmethod
+    def load(cls, path, mmap_mode='r'):
+        return cls(**{
+            name : np.load(os.path.join(path, name + ".npy"), mmap_mode=mmap_mode)
+            for name in cls.array_names})
+
+    def save(self, path):
+        os.makedirs(path, exist_ok=True)
+        for name in self.array_names:
+            np.save(os.path.join(path, name + ".npy"), getattr(self, name))
+
+    def __len__(self):
+        return self.charge.shape[0]
+
+    def __getitem__(self, i):
+        return MolEntryRecord(self, i)
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield MolEntryRecord(self, i)
+
+    def hash(self, hash_id):
+        if hash_id == -1:
+            return None
+        else:
+            return str(self.hashes[hash_id])
+
+    def free_energies(self, temperature=ROOM_TEMP):
+        """
+        the free energy of every species at temperature, nan if the
+        enthalpy or entropy is unknown
+        """
+        if temperature not in self.free_energy_cache:
+            self.free_energy_cache[temperature] = (
+                self.energy + self.enthalpy - temperature * self.entropy)
+
+        return self.free_energy_cache[temperature]
+
+    def species(self, i):
+        start = self.atom_offsets[i]
+        end = self.atom_offsets[i+1]
+        return [str(self.elements[s]) for s in self.atom_species[start:end]]
+
+    def covalent_graph(self, i):
+        """
+        the covalent graph of species i, as a networkx MultiGraph with
+        the same nodes and edges as MoleculeEntry.covalent_graph and
+        the species of each atom as its specie attribute
+        """
+        start = self.atom_offsets[i]
+        graph = nx.MultiGraph()
+
+        for a in range(start, self.atom_offsets[i+1]):
+            if self.covalent_atom[a]:
+                graph.add_node(
+                    int(a - start),
+                    specie=str(self.elements[self.atom_species[a]]))
+
+        for a in range(start, self.atom_offsets[i+1]):
+            for b in self.covalent_neighbors[
+                    self.neighbor_offsets[a]:self.neighbor_offsets[a+1]]:
+                # every bond is stored from both ends
+                if a - start <= b:
+                    graph.add_edge(int(a - start), int(b))
+
+        return graph
+
+    def fragment_complexes(self, i):
+        """
+        (number of bonds broken, fragment hashes) for each fragment
+        complex of species i, in the order of its fragment_data
+        """
+        fragment_complexes = []
+        for c in range(
+                self.fragment_complex_offsets[i],
+                self.fragment_complex_offsets[i+1]):
+            hash_ids = self.fragment_hash_ids[
+                self.fragment_hash_offsets[c]:self.fragment_hash_offsets[c+1]]
+            fragment_complexes.append((
+                int(self.fragment_bonds_broken[c]),
+                [self.hash(h) for h in hash_ids]))
+
+        return fragment_complexes
+
+
+def write_mol_entry_arrays(mol_entries, mol_entry_arrays_dir):
+    """
+    export mol_entries, which must be indexed by their position in the
+    list, as MolEntryArrays.
+    """
+    hash_ids = {}
+    def hash_id(h):
+        if h is None:
+            return -1
+        if h not in hash_ids:
+            hash_ids[h] = len(hash_ids)
+        return hash_ids[h]
+
+    formula_ids = {}
+    element_ids = {}
+    atom_species = []
+    neighbor_counts = []
+    covalent_neighbors = []
+    covalent_atom = []
+    fragment_complex_counts = []
+    fragment_bonds_broken = []
+    fragment_hash_counts = []
+    fragment_hash_ids = []
+
+    for mol in mol_entries:
+        formula_ids.setdefault(mol.formula, len(formula_ids))
+
+        for a, element in enumerate(mol.species):
+            atom_species.append(element_ids.setdefault(element, len(element_ids)))
+            covalent_atom.append(a in mol.covalent_graph)
+            if a in mol.covalent_graph:
+                # edges of a MultiGraph are listed once per bond
+                neighbors = [b for (_, b) in mol.covalent_graph.edges(a)]
+            else:
+                neighbors = []
+
+            neighbor_counts.append(len(neighbors))
+            covalent_neighbors.extend(neighbors)
+
+        fragment_complex_counts.append(len(mol.fragment_data))
+        for fragment_complex in mol.fragment_data:
+            fragment_bonds_broken.append(fragment_complex.number_of_bonds_broken)
+            fragment_hash_counts.append(len(fragment_complex.fragment_hashes))
+            fragment_hash_ids.extend(
+                hash_id(h) for h in fragment_complex.fragment_hashes)
+
+    covalent_hash = np.array(
+        [hash_id(getattr(mol, "covalent_hash", None)) for mol in mol_entries],
+        dtype=np.int32)
+    total_hash = np.array(
+        [hash_id(getattr(mol, "total_hash", None)) for mol in mol_entries],
+        dtype=np.int32)
+
+    def by_id(ids):
+        strings = [None] * len(ids)
+        for string, i in ids.items():
+            strings[i] = string
+        return string_array(strings)
+
+    mol_entry_arrays = MolEntryArrays(
+        charge=np.array([mol.charge for mol in mol_entries], dtype=np.int32),
+        spin_multiplicity=np.array(
+            [-1 if mol.spin_multiplicity is None else mol.spin_multiplicity
+             for mol in mol_entries],
+            dtype=np.int32),
+        num_atoms=np.array([mol.num_atoms for mol in mol_entries], dtype=np.int32),
+        energy=np.array(
+            [optional_float(mol.energy) for mol in mol_entries],
+            dtype=np.float64),
+        enthalpy=np.array(
+            [optional_float(mol.enthalpy) for mol in mol_entries],
+            dtype=np.float64),
+        entropy=np.array(
+            [optional_float(mol.entropy) for mol in mol_entries],
+            dtype=np.float64),
+        solvation_correction=np.array(
+            [optional_float(getattr(mol, "solvation_correction", None))
+             for mol in mol_entries],
+            dtype=np.float64),
+        electron_affinity=np.array(
+            [optional_float(mol.electron_affinity) for mol in mol_entries],
+            dtype=np.float64),
+        ionization_energy=np.array(
+            [optional_float(mol.ionization_energy) for mol in mol_entries],
+            dtype=np.float64),
+        entry_ids=string_array(
+            ["" if mol.entry_id is None else str(mol.entry_id)
+             for mol in mol_entries]),
+        formula_id=np.array(
+            [formula_ids[mol.formula] for mol in mol_entries], dtype=np.int32),
+        formulas=by_id(formula_ids),
+        atom_offsets=csr_offsets([len(mol.species) for mol in mol_entries]),
+        atom_species=np.array(atom_species, dtype=np.int16),
+        elements=by_id(element_ids),
+        neighbor_offsets=csr_offsets(neighbor_counts),
+        covalent_neighbors=np.array(covalent_neighbors, dtype=np.int32),
+        covalent_atom=np.array(covalent_atom, dtype=bool),
+        hashes=by_id(hash_ids),
+        covalent_hash=covalent_hash,
+        total_hash=total_hash,
+        fragment_complex_offsets=csr_offsets(fragment_complex_counts),
+        fragment_bonds_broken=np.array(fragment_bonds_broken, dtype=np.int32),
+        fragment_hash_offsets=csr_offsets(fragment_hash_counts),
+        fragment_hash_ids=np.array(fragment_hash_ids, dtype=np.int32))
+
+    mol_entry_arrays.save(mol_entry_arrays_dir)
+    return mol_entry_arrays
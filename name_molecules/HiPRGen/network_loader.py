@@ -1,6 +1,8 @@
 import sqlite3
 import pickle
+import os
 import numpy as np
+from HiPRGen.mol_entry_arrays import MolEntryArrays
 
 """
 class for dynamically loading a reaction network
@@ -10,30 +12,547 @@ sql_get_reaction = """
     SELECT * FROM reactions WHERE reaction_id = ?;
 """
 
+sql_create_prefetch_table = """
+    CREATE TEMP TABLE prefetch_ids (reaction_id INTEGER NOT NULL PRIMARY KEY);
+"""
+
+sql_insert_prefetch_id = """
+    INSERT INTO prefetch_ids VALUES (?);
+"""
+
+sql_get_prefetched_reactions = """
+    SELECT reactions.* FROM reactions
+    JOIN prefetch_ids ON reactions.reaction_id = prefetch_ids.reaction_id
+    ORDER BY reactions.reaction_id;
+"""
+
+sql_drop_prefetch_table = """
+    DROP TABLE prefetch_ids;
+"""
+
 sql_get_reaction_range = """
     SELECT * FROM reactions WHERE ? <= reaction_id AND reaction_id < ?;
 """
 
+# reaction_filter doesn't index the reactions table beyond its primary
+# key, so create_network_indices adds what the queries below need to
+# the network database the first time one of them is run.
+
+# species_reactions has a row for each species taking part in a
+# reaction, with role 0 for reactants and 1 for products, so the
+# reactions of a species are found by a primary key range instead of
+# a scan of the reactions table.
+sql_get_species_reactions_table = """
+    SELECT name FROM sqlite_master
+    WHERE type = 'table' AND name = 'species_reactions';
+"""
+
+sql_create_species_reactions_table = """
+    CREATE TABLE species_reactions (
+            species_id          INTEGER NOT NULL,
+            role                INTEGER NOT NULL,
+            reaction_id         INTEGER NOT NULL,
+            PRIMARY KEY (species_id, role, reaction_id)
+    ) WITHOUT ROWID;
+"""
+
+# a species can appear twice on one side of a reaction, hence OR IGNORE
+sql_fill_species_reactions_table = """
+    INSERT OR IGNORE INTO species_reactions
+    SELECT reactant_1, 0, reaction_id FROM reactions
+    UNION ALL
+    SELECT reactant_2, 0, reaction_id FROM reactions
+    WHERE number_of_reactants = 2
+    UNION ALL
+    SELECT product_1, 1, reaction_id FROM reactions
+    UNION ALL
+    SELECT product_2, 1, reaction_id FROM reactions
+    WHERE number_of_products = 2
+    ORDER BY 1, 2, 3;
+"""
+
+sql_create_redox_index = """
+    CREATE INDEX IF NOT EXISTS redox_index ON reactions (is_redox);
+"""
+
 sql_get_redox = """
-    SELECT * FROM reactions WHERE is_redox = 1;
+    SELECT * FROM reactions WHERE is_redox = 1 ORDER BY reaction_id;
 """
 
-def sql_get_coord(metal_id):
-    return "SELECT * FROM reactions WHERE (number_of_reactants=2 AND number_of_products=1 AND (reactant_1={0} OR reactant_2={0})) ORDER BY dG DESC;".format(metal_id)
+sql_get_coord = """
+    SELECT reactions.* FROM species_reactions
+    JOIN reactions ON reactions.reaction_id = species_reactions.reaction_id
+    WHERE species_reactions.species_id = ? AND species_reactions.role = 0
+    AND number_of_reactants = 2 AND number_of_products = 1
+    ORDER BY dG DESC, reactions.reaction_id;
+"""
 
-def sql_get_decoord(metal_id):
-    return "SELECT * FROM reactions WHERE (number_of_reactants=1 AND number_of_products=2 AND (product_1={0} OR product_2={0})) ORDER BY dG DESC;".format(metal_id)
+sql_get_decoord = """
+    SELECT reactions.* FROM species_reactions
+    JOIN reactions ON reactions.reaction_id = species_reactions.reaction_id
+    WHERE species_reactions.species_id = ? AND species_reactions.role = 1
+    AND number_of_reactants = 1 AND number_of_products = 2
+    ORDER BY dG DESC, reactions.reaction_id;
+"""
+
+sql_get_species_reactions = """
+    SELECT reactions.* FROM species_reactions
+    JOIN reactions ON reactions.reaction_id = species_reactions.reaction_id
+    WHERE species_reactions.species_id = ? AND species_reactions.role = ?
+    ORDER BY species_reactions.reaction_id;
+"""
 
 
 sql_get_trajectory = """
     SELECT * FROM trajectories;
 """
 
+sql_count_trajectory_rows = """
+    SELECT COUNT(*) FROM trajectories;
+"""
+
+sql_create_seed_filter_table = """
+    CREATE TEMP TABLE seed_filter (seed INTEGER NOT NULL PRIMARY KEY);
+"""
+
+sql_insert_seed_filter = """
+    INSERT INTO seed_filter VALUES (?);
+"""
+
+sql_count_filtered_trajectory_rows = """
+    SELECT COUNT(*) FROM trajectories
+    JOIN seed_filter ON trajectories.seed = seed_filter.seed;
+"""
+
+sql_get_filtered_trajectory = """
+    SELECT trajectories.* FROM trajectories
+    JOIN seed_filter ON trajectories.seed = seed_filter.seed;
+"""
+
+sql_drop_seed_filter_table = """
+    DROP TABLE seed_filter;
+"""
+
+# reactions are ordered by when they first fire in a walk over the
+# trajectories, which takes seeds in order of first appearance and each
+# seed in step order, like a TrajectoryStore
+sql_get_reaction_tally = """
+    WITH seed_order AS (
+        SELECT seed, MIN(rowid) AS seed_row FROM trajectories GROUP BY seed),
+    firings AS (
+        SELECT reaction_id, seed_row, step FROM trajectories
+        JOIN seed_order ON trajectories.seed = seed_order.seed),
+    tally AS (
+        SELECT reaction_id, COUNT(*) AS count, MIN(seed_row) AS first_seed_row
+        FROM firings GROUP BY reaction_id)
+    SELECT tally.reaction_id, tally.count FROM tally
+    JOIN firings ON firings.reaction_id = tally.reaction_id
+    AND firings.seed_row = tally.first_seed_row
+    GROUP BY tally.reaction_id
+    ORDER BY tally.first_seed_row, MIN(firings.step);
+"""
+
 sql_get_initial_state = """
     SELECT * FROM initial_state;
 """
 
 
+def create_network_indices(rn_con):
+    """
+    add the species_reactions table and the indices used by the
+    NetworkLoader queries to a reaction network database, unless it
+    already has them. This takes a while on a large network, but only
+    needs to be done once.
+    """
+    cur = rn_con.cursor()
+    if len(list(cur.execute(sql_get_species_reactions_table))) == 0:
+        # in one transaction, so that an interrupted run doesn't leave
+        # a partially filled table behind. sqlite3 doesn't open one
+        # before CREATE TABLE by itself, and there may already be one
+        # open on the connection.
+        if not rn_con.in_transaction:
+            cur.execute("BEGIN")
+        cur.execute(sql_create_species_reactions_table)
+        cur.execute(sql_fill_species_reactions_table)
+        cur.execute(sql_create_redox_index)
+        rn_con.commit()
+    else:
+        cur.execute(sql_create_redox_index)
+        rn_con.commit()
+
+
+def trajectory_store_dir(initial_state_database):
+    """
+    the trajectory store for an initial state database lives in a
+    directory next to it.
+    """
+    return initial_state_database + ".trajectory_store"
+
+
+class SeedTrajectory:
+    """
+    read only view of a single trajectory inside a TrajectoryStore.
+    Behaves like the dict trajectories[seed] built by
+    NetworkLoader.load_trajectories, so trajectory[step] gives
+    (reaction_id, time), but the underlying data are array slices.
+    """
+
+    def __init__(self, reaction_ids, times):
+        self.reaction_ids = reaction_ids
+        self.times = times
+
+    def __len__(self):
+        return self.reaction_ids.shape[0]
+
+    def __iter__(self):
+        return iter(range(self.reaction_ids.shape[0]))
+
+    def __contains__(self, step):
+        return 0 <= step < self.reaction_ids.shape[0]
+
+    def __getitem__(self, step):
+        return (int(self.reaction_ids[step]), float(self.times[step]))
+
+
+def trajectory_reaction_ids(trajectories, seed):
+    """
+    array of the reaction ids which fired in a trajectory, in step
+    order. trajectories is either a TrajectoryStore or the nested dict
+    built by NetworkLoader.load_trajectories.
+    """
+    trajectory = trajectories[seed]
+    if isinstance(trajectory, SeedTrajectory):
+        return trajectory.reaction_ids
+
+    return np.array(
+        [trajectory[step][0] for step in trajectory],
+        dtype=np.int32)
+
+
+class TrajectoryStore:
+    """
+    columnar storage for the trajectories table. The reaction ids and
+    times for every seed are stored contiguously, with offsets[k] the
+    start of the k-th seed, so trajectory k occupies
+    reaction_ids[offsets[k]:offsets[k+1]]. Seeds keep the order in
+    which they first appear in the trajectories table and steps are
+    positional, as RNMC writes steps 0, 1, 2, ... for each seed.
+
+    A TrajectoryStore can be indexed by seed like the nested dict
+    built by NetworkLoader.load_trajectories, so code written against
+    the dict keeps working. Code which wants speed should use the
+    arrays directly.
+    """
+
+    array_names = ["seeds", "offsets", "reaction_ids", "times"]
+
+    def __init__(self, seeds, offsets, reaction_ids, times, path=None):
+        self.seeds = seeds
+        self.offsets = offsets
+        self.reaction_ids = reaction_ids
+        self.times = times
+        self.path = path
+        self.seed_positions = {
+            int(seed) : k for k, seed in enumerate(seeds.tolist())}
+
+
+    @classmethod
+    def from_database(cls, initial_state_con, seeds=None, chunk_size=1000000):
+        """
+        stream the trajectories table once into flat arrays. If seeds
+        is given, only the trajectories for those seeds are read.
+        """
+        cur = initial_state_con.cursor()
+        if seeds is None:
+            count_sql = sql_count_trajectory_rows
+            trajectory_sql = sql_get_trajectory
+        else:
+            cur.execute(sql_create_seed_filter_table)
+            cur.executemany(
+                sql_insert_seed_filter,
+                ((seed,) for seed in seeds))
+            count_sql = sql_count_filtered_trajectory_rows
+            trajectory_sql = sql_get_filtered_trajectory
+
+        number_of_rows = list(cur.execute(count_sql))[0][0]
+
+        row_seeds = np.zeros(number_of_rows, dtype=np.int64)
+        row_steps = np.zeros(number_of_rows, dtype=np.int64)
+        row_reaction_ids = np.zeros(number_of_rows, dtype=np.int32)
+        row_times = np.zeros(number_of_rows, dtype=np.float64)
+
+        cur.execute(trajectory_sql)
+        position = 0
+        while True:
+            rows = cur.fetchmany(chunk_size)
+            if len(rows) == 0:
+                break
+
+            seed_column, step_column, reaction_column, time_column = zip(*rows)
+            end = position + len(rows)
+            row_seeds[position:end] = seed_column
+            row_steps[position:end] = step_column
+            row_reaction_ids[position:end] = reaction_column
+            row_times[position:end] = time_column
+            position = end
+
+        if seeds is not None:
+            cur.execute(sql_drop_seed_filter_table)
+            # the inserts opened a transaction, which would otherwise
+            # hold a lock on the database
+            initial_state_con.commit()
+
+        return cls.from_rows(row_seeds, row_steps, row_reaction_ids, row_times)
+
+
+    @classmethod
+    def from_rows(cls, row_seeds, row_steps, row_reaction_ids, row_times):
+        """
+        build a store from unordered (seed, step, reaction_id, time) columns
+        """
+        unique_seeds, first_index, seed_inverse = np.unique(
+            row_seeds, return_index=True, return_inverse=True)
+
+        # rank seeds by first appearance so that iteration order agrees
+        # with the dict built by NetworkLoader.load_trajectories
+        appearance_order = np.argsort(first_index, kind='stable')
+        seed_rank = np.empty_like(appearance_order)
+        seed_rank[appearance_order] = np.arange(appearance_order.shape[0])
+        row_rank = seed_rank[seed_inverse]
+
+        row_order = np.lexsort((row_steps, row_rank))
+        seeds = unique_seeds[appearance_order]
+        counts = np.bincount(row_rank, minlength=seeds.shape[0])
+        offsets = np.zeros(seeds.shape[0] + 1, dtype=np.int64)
+        np.cumsum(counts, out=offsets[1:])
+
+        sorted_steps = row_steps[row_order]
+        expected_steps = (
+            np.arange(sorted_steps.shape[0]) -
+            np.repeat(offsets[:-1], counts))
+        if not np.array_equal(sorted_steps, expected_steps):
+            raise ValueError(
+                "trajectory steps must be numbered 0, 1, 2, ... for each seed")
+
+        return cls(
+            seeds,
+            offsets,
+            row_reaction_ids[row_order],
+            row_times[row_order])
+
+
+    @classmethod
+    def load(cls, path, mmap_mode='r'):
+        arrays = [
+            np.load(os.path.join(path, name + ".npy"), mmap_mode=mmap_mode)
+            for name in cls.array_names]
+
+        return cls(*arrays, path=path)
+
+
+    def save(self, path):
+        os.makedirs(path, exist_ok=True)
+        for name in self.array_names:
+            np.save(os.path.join(path, name + ".npy"), getattr(self, name))
+
+        self.path = path
+
+
+    @classmethod
+    def concatenate(cls, stores):
+        """
+        merge stores loaded from several initial state databases. As
+        with the dict representation, the seeds need to be distinct.
+        """
+        offsets = [np.zeros(1, dtype=np.int64)]
+        shift = 0
+        for store in stores:
+            offsets.append(np.asarray(store.offsets[1:]) + shift)
+            shift += store.reaction_ids.shape[0]
+
+        seeds = np.concatenate([store.seeds for store in stores])
+        if np.unique(seeds).shape[0] != seeds.shape[0]:
+            raise ValueError("can only merge trajectory stores with distinct seeds")
+
+        return cls(
+            seeds,
+            np.concatenate(offsets),
+            np.concatenate([store.reaction_ids for store in stores]),
+            np.concatenate([store.times for store in stores]))
+
+
+    def __getstate__(self):
+        # a store backed by files gets reopened from disk rather than
+        # copied, which keeps multiprocessing workers cheap to spawn.
+        if self.path is not None:
+            return {"path" : self.path}
+
+        return {name : getattr(self, name) for name in self.array_names}
+
+
+    def __setstate__(self, state):
+        if "path" in state:
+            store = TrajectoryStore.load(state["path"])
+        else:
+            store = TrajectoryStore(*[state[name] for name in self.array_names])
+
+        self.__dict__.update(store.__dict__)
+
+
+    def __len__(self):
+        return self.seeds.shape[0]
+
+    def __iter__(self):
+        return iter(self.seed_positions)
+
+    def __contains__(self, seed):
+        return seed in self.seed_positions
+
+    def __getitem__(self, seed):
+        k = self.seed_positions[seed]
+        start = self.offsets[k]
+        end = self.offsets[k+1]
+        return SeedTrajectory(
+            self.reaction_ids[start:end],
+            self.times[start:end])
+
+    def keys(self):
+        return self.seed_positions.keys()
+
+
+
+class ReactionTable:
+    """
+    dense, array backed copy of a set of rows from the reactions
+    table, sorted by reaction id. Missing reactants / products are -1,
+    as in the database.
+    """
+
+    def __init__(
+            self,
+            reaction_ids,
+            number_of_reactants,
+            number_of_products,
+            reactants,
+            products,
+            rate,
+            dG,
+            dG_barrier):
+
+        self.reaction_ids = reaction_ids
+        self.number_of_reactants = number_of_reactants
+        self.number_of_products = number_of_products
+        self.reactants = reactants
+        self.products = products
+        self.rate = rate
+        self.dG = dG
+        self.dG_barrier = dG_barrier
+
+
+    @classmethod
+    def from_rows(cls, rows):
+        number_of_rows = len(rows)
+        reaction_ids = np.zeros(number_of_rows, dtype=np.int64)
+        number_of_reactants = np.zeros(number_of_rows, dtype=np.int8)
+        number_of_products = np.zeros(number_of_rows, dtype=np.int8)
+        reactants = np.zeros((number_of_rows, 2), dtype=np.int32)
+        products = np.zeros((number_of_rows, 2), dtype=np.int32)
+        rate = np.zeros(number_of_rows, dtype=np.float64)
+        dG = np.zeros(number_of_rows, dtype=np.float64)
+        dG_barrier = np.zeros(number_of_rows, dtype=np.float64)
+
+        for k, res in enumerate(rows):
+            reaction_ids[k] = res[0]
+            number_of_reactants[k] = res[1]
+            number_of_products[k] = res[2]
+            reactants[k] = res[3:5]
+            products[k] = res[5:7]
+            rate[k] = res[7]
+            dG[k] = res[8]
+            dG_barrier[k] = res[9]
+
+        order = np.argsort(reaction_ids, kind='stable')
+        return cls(
+            reaction_ids[order],
+            number_of_reactants[order],
+            number_of_products[order],
+            reactants[order],
+            products[order],
+            rate[order],
+            dG[order],
+            dG_barrier[order])
+
+
+    @classmethod
+    def merge(cls, table_0, table_1):
+        """
+        union of two tables with disjoint reaction ids
+        """
+        reaction_ids = np.concatenate(
+            [table_0.reaction_ids, table_1.reaction_ids])
+        order = np.argsort(reaction_ids, kind='stable')
+
+        def merged(name):
+            return np.concatenate(
+                [getattr(table_0, name), getattr(table_1, name)])[order]
+
+        return cls(
+            reaction_ids[order],
+            merged('number_of_reactants'),
+            merged('number_of_products'),
+            merged('reactants'),
+            merged('products'),
+            merged('rate'),
+            merged('dG'),
+            merged('dG_barrier'))
+
+
+    def __len__(self):
+        return self.reaction_ids.shape[0]
+
+
+    def positions(self, reaction_ids):
+        """
+        row positions of reaction ids which are in the table
+        """
+        if not np.all(self.contains(reaction_ids)):
+            raise KeyError("reaction ids missing from reaction table")
+
+        return np.searchsorted(self.reaction_ids, reaction_ids)
+
+
+    def contains(self, reaction_ids):
+        """
+        boolean mask of which reaction ids are in the table
+        """
+        if len(self) == 0:
+            return np.zeros(np.shape(reaction_ids), dtype=bool)
+
+        positions = np.minimum(
+            np.searchsorted(self.reaction_ids, reaction_ids),
+            len(self) - 1)
+        return self.reaction_ids[positions] == reaction_ids
+
+
+    def __contains__(self, reaction_id):
+        return bool(self.contains(np.array([reaction_id]))[0])
+
+
+    def reaction(self, reaction_id):
+        """
+        the reaction in the dict format produced by NetworkLoader.index_to_reaction
+        """
+        k = int(self.positions(np.array([reaction_id]))[0])
+        reaction = {}
+        reaction['number_of_reactants'] = int(self.number_of_reactants[k])
+        reaction['number_of_products'] = int(self.number_of_products[k])
+        reaction['reactants'] = tuple(self.reactants[k].tolist())
+        reaction['products'] = tuple(self.products[k].tolist())
+        reaction['rate'] = float(self.rate[k])
+        reaction['dG'] = float(self.dG[k])
+        reaction['dG_barrier'] = float(self.dG_barrier[k])
+        return reaction
+
 
 class NetworkLoader:
 
@@ -41,29 +560,70 @@ class NetworkLoader:
             self,
             network_database,
             mol_entries_pickle,
-            initial_state_database=None
+            initial_state_database=None,
+            trajectory_store=False,
+            debug=False,
+            mol_entry_arrays_dir=None
     ):
+        """
+        if trajectory_store is True, load_trajectories reads the
+        trajectories into a TrajectoryStore which is cached next to the
+        initial state database instead of building nested dicts.
+
+        if debug is True, every reaction which index_to_reaction has
+        to fetch individually from the database is printed.
+
+        if mol_entry_arrays_dir is given, mol_entries is the memory
+        mapped MolEntryArrays there rather than the unpickled
+        mol_entries_pickle, which isn't read and can be None. Its
+        entries have entry_id, formula, charge, free_energy and the
+        other plain attributes of a MoleculeEntry, but no pymatgen
+        molecule or graphs.
+        """
 
 
         self.rn_con = sqlite3.connect(network_database)
 
-        with open(mol_entries_pickle, 'rb') as f:
-            self.mol_entries = pickle.load(f)
+        if mol_entry_arrays_dir is not None:
+            self.mol_entries = MolEntryArrays.load(mol_entry_arrays_dir)
+        else:
+            with open(mol_entries_pickle, 'rb') as f:
+                self.mol_entries = pickle.load(f)
 
         cur = self.rn_con.cursor()
         metadata = list(cur.execute("SELECT * FROM metadata"))[0]
         self.number_of_species = metadata[0]
         self.number_of_reactions = metadata[1]
 
+        self.trajectory_store = trajectory_store
+        self.initial_state_database = initial_state_database
+        # initial state databases which trajectories have been loaded from
+        self.trajectory_databases = []
         if initial_state_database:
             self.initial_state_con = sqlite3.connect(initial_state_database)
 
+        self.debug = debug
+        self.reaction_fetch_count = 0
+        # set once create_network_indices has been run
+        self.network_indexed = False
+
         self.reactions = {}
+        self.reaction_table = ReactionTable.from_rows([])
         self.trajectories = {}
+        # computed by load_reaction_tally, None until then
+        self.reaction_tally = None
+        # initial state databases load_reaction_tally has counted
+        self.reaction_tally_databases = []
         self.initial_state_dict = {}
         self.initial_state_array = {}
 
+    def index_network(self):
+        if not self.network_indexed:
+            create_network_indices(self.rn_con)
+            self.network_indexed = True
+
     def get_all_redox_reactions(self):
+        self.index_network()
         redox_reactions = []
         cur = self.rn_con.cursor()
         for res in cur.execute(sql_get_redox):
@@ -81,9 +641,10 @@ class NetworkLoader:
 
 
     def get_all_coordination_reactions(self, metal_id):
+        self.index_network()
         coordination_reactions = []
         cur = self.rn_con.cursor()
-        for res in cur.execute(sql_get_coord(metal_id)):
+        for res in cur.execute(sql_get_coord, (metal_id,)):
             reaction = {}
             reaction['number_of_reactants'] = res[1]
             reaction['number_of_products'] = res[2]
@@ -98,9 +659,10 @@ class NetworkLoader:
 
 
     def get_all_decoordination_reactions(self, metal_id):
+        self.index_network()
         decoordination_reactions = []
         cur = self.rn_con.cursor()
-        for res in cur.execute(sql_get_decoord(metal_id)):
+        for res in cur.execute(sql_get_decoord, (metal_id,)):
             reaction = {}
             reaction['number_of_reactants'] = res[1]
             reaction['number_of_products'] = res[2]
@@ -114,6 +676,30 @@ class NetworkLoader:
         return decoordination_reactions
 
 
+    def get_species_reactions(self, species_id, as_product=False):
+        """
+        the reactions which species_id is a reactant of, or a product
+        of if as_product is True, in order of reaction id
+        """
+        self.index_network()
+        species_reactions = []
+        cur = self.rn_con.cursor()
+        for res in cur.execute(
+                sql_get_species_reactions,
+                (species_id, int(as_product))):
+            reaction = {}
+            reaction['number_of_reactants'] = res[1]
+            reaction['number_of_products'] = res[2]
+            reaction['reactants'] = res[3:5]
+            reaction['products'] = res[5:7]
+            reaction['rate'] = res[7]
+            reaction['dG'] = res[8]
+            reaction['dG_barrier'] = res[9]
+            species_reactions.append(reaction)
+
+        return species_reactions
+
+
     def get_reactions_in_range(self, lower_bound, upper_bound):
         """
         get range of reactions from database but don't cache them
@@ -143,8 +729,16 @@ class NetworkLoader:
         if reaction_index in self.reactions:
             return self.reactions[reaction_index]
 
+        elif reaction_index in self.reaction_table:
+            reaction = self.reaction_table.reaction(reaction_index)
+            self.reactions[reaction_index] = reaction
+            return reaction
+
         else:
-            print("fetching data for reaction", reaction_index)
+            self.reaction_fetch_count += 1
+            if self.debug:
+                print("fetching data for reaction", reaction_index)
+
             cur = self.rn_con.cursor()
             res = list(
                 cur.execute(sql_get_reaction, (reaction_index,))
@@ -161,8 +755,64 @@ class NetworkLoader:
             return reaction
 
 
+    def prefetch_reactions(self, reaction_ids=None):
+        """
+        fetch a set of reactions from the database in a single query
+        and store them in self.reaction_table. By default, all the
+        reactions which fired in the loaded trajectories are fetched.
+        """
+        if reaction_ids is None:
+            reaction_ids = self.fired_reaction_ids()
+
+        reaction_ids = np.unique(np.asarray(reaction_ids, dtype=np.int64))
+        reaction_ids = reaction_ids[~self.reaction_table.contains(reaction_ids)]
+
+        if reaction_ids.shape[0] == 0:
+            return self.reaction_table
+
+        cur = self.rn_con.cursor()
+        cur.execute(sql_create_prefetch_table)
+        cur.executemany(
+            sql_insert_prefetch_id,
+            ((reaction_id,) for reaction_id in reaction_ids.tolist()))
+
+        table = ReactionTable.from_rows(
+            list(cur.execute(sql_get_prefetched_reactions)))
+
+        cur.execute(sql_drop_prefetch_table)
+        # the inserts opened a transaction, which would otherwise hold a
+        # lock on the network database for the lifetime of the loader
+        self.rn_con.commit()
+
+        self.reaction_table = ReactionTable.merge(self.reaction_table, table)
+        return self.reaction_table
+
+
+    def fired_reaction_ids(self):
+        """
+        array of the reaction ids fired across all loaded trajectories,
+        with repetition
+        """
+        if isinstance(self.trajectories, TrajectoryStore):
+            return self.trajectories.reaction_ids
+
+        if len(self.trajectories) == 0:
+            return np.zeros(0, dtype=np.int32)
+
+        return np.concatenate([
+            self.trajectory_reaction_ids(seed)
+            for seed in self.trajectories])
+
+
     def load_trajectories(self):
 
+        self.trajectory_databases.append(self.initial_state_database)
+        self.reaction_tally = None
+
+        if self.trajectory_store:
+            self.load_trajectory_store()
+            return
+
         cur = self.initial_state_con.cursor()
 
         for row in cur.execute(sql_get_trajectory):
@@ -177,6 +827,76 @@ class NetworkLoader:
             self.trajectories[seed][step] = (reaction_id, time)
 
 
+    def load_reaction_tally(self):
+        """
+        count how many times each reaction fired with aggregate queries
+        against the initial state databases, without loading the
+        trajectories. The tally covers every database in
+        trajectory_databases, every database which was current when
+        this was called before, and the current one, in that order.
+        set_initial_state_db and load_trajectories invalidate it.
+        """
+        if self.initial_state_database not in self.reaction_tally_databases:
+            self.reaction_tally_databases.append(self.initial_state_database)
+
+        databases = []
+        for database in self.trajectory_databases + self.reaction_tally_databases:
+            if database not in databases:
+                databases.append(database)
+
+        self.reaction_tally = {}
+        for database in databases:
+            if database == self.initial_state_database:
+                con = self.initial_state_con
+            else:
+                con = sqlite3.connect(database)
+
+            for reaction_id, count in con.execute(sql_get_reaction_tally):
+                if reaction_id in self.reaction_tally:
+                    self.reaction_tally[reaction_id] += count
+                else:
+                    self.reaction_tally[reaction_id] = count
+
+            if con is not self.initial_state_con:
+                con.close()
+
+        return self.reaction_tally
+
+
+    def load_trajectory_store(self):
+        """
+        load the trajectories as a TrajectoryStore. The arrays are
+        written next to the initial state database on first use and
+        memory mapped on later runs, as long as the database hasn't
+        been modified since.
+        """
+        path = trajectory_store_dir(self.initial_state_database)
+        offsets_file = os.path.join(path, "offsets.npy")
+
+        if (os.path.exists(offsets_file) and
+            os.path.getmtime(offsets_file) >=
+            os.path.getmtime(self.initial_state_database)):
+            store = TrajectoryStore.load(path)
+
+        else:
+            store = TrajectoryStore.from_database(self.initial_state_con)
+            store.save(path)
+            store = TrajectoryStore.load(path)
+
+        if len(self.trajectories) == 0:
+            self.trajectories = store
+        else:
+            self.trajectories = TrajectoryStore.concatenate(
+                [self.trajectories, store])
+
+
+    def trajectory_reaction_ids(self, seed):
+        """
+        array of the reaction ids which fired in a trajectory, in step order
+        """
+        return trajectory_reaction_ids(self.trajectories, seed)
+
+
     def load_initial_state(self):
 
         cur = self.initial_state_con.cursor()
@@ -206,4 +926,6 @@ class NetworkLoader:
     def set_initial_state_db(self, initial_state_database):
         # NOTE: switching to a new initial state database and loading in trajectory
         # info from it will only work if the new database has different seeds!
+        self.initial_state_database = initial_state_database
         self.initial_state_con = sqlite3.connect(initial_state_database)
+        self.reaction_tally = None
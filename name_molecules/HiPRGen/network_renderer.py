@@ -2,191 +2,191 @@ from HiPRGen.network_loader import NetworkLoader
 import cairo
 import math
 import random
+import numpy as np
 
 
-class QuadTreeNode:
+def neighbor_ids(grid, i, j):
     """
-    origin is at top left so to agree with
-    the cairo canvas coordinates.
-
-    Notice that this is a recursive initializer. It creates
-    1 + 4 + ... + 4^(depth) = O(4^(depth + 1)) QuadTreeNodes,
-    so don't go too deep!
+    for each of the 25 cells at most two cells away from cells (i, j),
+    the ids stored in grid there, -1 for empty cells and cells outside
+    of the grid.
+    """
+    x_cells, y_cells = grid.shape
+    for di in range(-2, 3):
+        for dj in range(-2, 3):
+            ni = i + di
+            nj = j + dj
+            inside = (0 <= ni) & (ni < x_cells) & (0 <= nj) & (nj < y_cells)
+            ids = np.full(i.shape, -1, dtype=np.int64)
+            ids[inside] = grid[ni[inside], nj[inside]]
+            yield ids
+
+
+class PoissonDiskSampler:
+    """
+    samples points at least rejection_radius apart, vectorized with
+    numpy.
+
+    sampled points are stored in a grid with cells of side
+    rejection_radius / sqrt(2), so a cell contains at most one of them
+    and points closer than rejection_radius are at most two cells
+    apart. Candidates are drawn in batches, and a candidate is kept if
+    it is not too close to a point which is already placed or to an
+    earlier kept candidate of its batch.
+
+    global_mask(xs, ys) gets arrays of coordinates and returns a
+    boolean array, False where samples should be rejected.
     """
-    def __init__(self, depth, x_min, x_max, y_min, y_max):
-
-        self.x_min = x_min
-        self.x_max = x_max
-        self.y_min = y_min
-        self.y_max = y_max
-
-        # you either have quads or data
-        # if you have quads, you are non terminal
-        # if you have data you are terminal
-        self.quads = None
-        self.data = []
-        self.branch(depth)
-
-
-    def branch(self, depth):
-        """
-        break node into 4 nodes.
-        """
-
-        if depth > 0:
-            self.data = None
-            self.quads = [
-                None, # top left
-                None, # top right
-                None, # bottom left
-                None  # bottom right
-            ]
-
-            self.x_mid = (self.x_min + self.x_max) / 2
-            self.y_mid = (self.y_min + self.y_max) / 2
-
-            # top left
-            self.quads[0] = QuadTreeNode(
-                depth - 1,
-                self.x_min,
-                self.x_mid,
-                self.y_min,
-                self.y_mid)
-
-            # top right
-            self.quads[1] = QuadTreeNode(
-                depth - 1,
-                self.x_mid,
-                self.x_max,
-                self.y_min,
-                self.y_mid)
-
-            # bottom left
-            self.quads[2] = QuadTreeNode(
-                depth - 1,
-                self.x_min,
-                self.x_mid,
-                self.y_mid,
-                self.y_max)
-
-            # bottom right
-            self.quads[3] = QuadTreeNode(
-                depth - 1,
-                self.x_mid,
-                self.x_max,
-                self.y_mid,
-                self.y_max)
-
-    def insert(self, x, y, val):
-        node = self.find_node(x,y)
-        node.data.append(val)
-        return val
-
-    def find_neighborhood(self,x,y):
-        """
-        find all nodes adjacent to our point.
-        doesn't return the node actually containing our point.
-        """
-        node = self.find_node(x,y)
-        x_diff = node.x_max - node.x_min
-        y_diff = node.y_max - node.y_min
-        maybe_adjacent_nodes = [
-            self.find_node(x + x_diff, y),
-            self.find_node(x - x_diff, y),
-            self.find_node(x, y + y_diff),
-            self.find_node(x, y - y_diff),
-            self.find_node(x + x_diff, y + y_diff),
-            self.find_node(x - x_diff, y + y_diff),
-            self.find_node(x + x_diff, y - y_diff),
-            self.find_node(x - x_diff, y - y_diff)
-        ]
-
-        adjacent_nodes = [n for n in maybe_adjacent_nodes if n is not None]
-        return adjacent_nodes
-
-    def find_node(self, x, y):
-        """
-        find the terminal node so that
-        x_min <= x < x_max
-        y_min <= y < y_max
-        return None if there is no node.
-        Note: this gives the wrong answer if called from a terminal node.
-        """
-        if self.quads is not None:
-            for quad in self.quads:
-                if (quad.x_min <= x < quad.x_max and
-                    quad.y_min <= y < quad.y_max):
-                    return quad.find_node(x,y)
-
-            return None
-
-        else:
-            return self
-
-    def __str__(self):
-        return (
-            "x : [" + str(self.x_min) + ", " + str(self.x_max) + ")  " +
-            "y : [" + str(self.y_min) + ", " + str(self.y_max) + ")"
-        )
-
-    def __repr__(self):
-        return self.__str__()
-
 
-class RepulsiveSampler:
     def __init__(self,
                  rejection_radius,
                  x_min,
                  x_max,
                  y_min,
                  y_max,
-                 global_mask, # reject a sample if global mask returns false
-                 quad_tree_depth=7,
+                 global_mask,
                  seed=42,
+                 batch_size=1024
                  ):
 
-        self.quad_tree = QuadTreeNode(quad_tree_depth, x_min, x_max, y_min, y_max)
         self.rejection_radius = rejection_radius
-        self.internal_sampler = random.Random(seed)
+        self.x_min = x_min
+        self.x_max = x_max
+        self.y_min = y_min
+        self.y_max = y_max
         self.global_mask = global_mask
+        self.batch_size = batch_size
+        self.internal_sampler = np.random.default_rng(seed)
+
+        self.cell_size = rejection_radius / math.sqrt(2)
+        self.grid = np.full(
+            (math.ceil((x_max - x_min) / self.cell_size),
+             math.ceil((y_max - y_min) / self.cell_size)),
+            -1,
+            dtype=np.int64)
+
+        # grid points are stored in points[:number_of_points]. Inserted
+        # points which don't fit in the grid are checked one by one.
+        self.points = np.zeros((64, 2))
+        self.number_of_points = 0
+        self.extra_points = np.zeros((0, 2))
+
+    def cells(self, xs, ys):
+        i = np.floor((xs - self.x_min) / self.cell_size).astype(np.int64)
+        j = np.floor((ys - self.y_min) / self.cell_size).astype(np.int64)
+        return i, j
+
+    def add(self, xs, ys, i, j):
+        end = self.number_of_points + len(xs)
+        if end > len(self.points):
+            points = np.zeros((max(end, 2 * len(self.points)), 2))
+            points[:self.number_of_points] = self.points[:self.number_of_points]
+            self.points = points
+
+        self.points[self.number_of_points:end, 0] = xs
+        self.points[self.number_of_points:end, 1] = ys
+        self.grid[i, j] = np.arange(self.number_of_points, end)
+        self.number_of_points = end
+
+    def too_close(self, grid, points, xs, ys, i, j, earlier_only=False):
+        """
+        for each candidate, whether one of points, which are indexed by
+        grid, is closer than rejection_radius to it. If earlier_only,
+        points are the candidates and only earlier ones are compared.
+        """
+        result = np.zeros(len(xs), dtype=bool)
+        for ids in neighbor_ids(grid, i, j):
+            if earlier_only:
+                mask = (ids >= 0) & (ids < np.arange(len(xs)))
+            else:
+                mask = ids >= 0
 
-    def sample(self):
-        while (True):
-
-            x = self.internal_sampler.uniform(
-                self.quad_tree.x_min,
-                self.quad_tree.x_max)
-
-            y = self.internal_sampler.uniform(
-                self.quad_tree.y_min,
-                self.quad_tree.y_max)
-
-            if not self.global_mask(x,y):
-                continue
-
-            node = self.quad_tree.find_node(x,y)
-            neighborhood = self.quad_tree.find_neighborhood(x,y)
-            neighborhood.append(node)
-
-            too_close = False
-            for adjacent_node in neighborhood:
-                for point in adjacent_node.data:
-                    if (point[0] - x)**2 + (point[1] - y)**2 < (self.rejection_radius **2):
-                        too_close = True
-                        break
+            neighbors = points[ids[mask]]
+            result[mask] |= (
+                (neighbors[:,0] - xs[mask])**2 + (neighbors[:,1] - ys[mask])**2
+                < self.rejection_radius**2)
 
-                if too_close:
-                    break
+        return result
 
-            if (not too_close):
-                result = (x,y)
-                print(result)
-                node.data.append(result)
-                return result
+    def sample(self, count):
+        """
+        count new points, as a (count, 2) array
+        """
+        result = np.zeros((count, 2))
+        found = 0
+
+        while found < count:
+            size = min(self.batch_size, max(16, 4 * (count - found)))
+            xs = self.internal_sampler.uniform(self.x_min, self.x_max, size)
+            ys = self.internal_sampler.uniform(self.y_min, self.y_max, size)
+
+            keep = np.asarray(self.global_mask(xs, ys), dtype=bool)
+            xs, ys = xs[keep], ys[keep]
+            i, j = self.cells(xs, ys)
+
+            keep = ~self.too_close(self.grid, self.points, xs, ys, i, j)
+            if len(self.extra_points) > 0:
+                keep &= ~(
+                    ((xs[:,None] - self.extra_points[:,0])**2 +
+                     (ys[:,None] - self.extra_points[:,1])**2)
+                    < self.rejection_radius**2).any(axis=1)
+
+            xs, ys, i, j = xs[keep], ys[keep], i[keep], j[keep]
+
+            # two candidates in the same cell are too close
+            _, first = np.unique(i * self.grid.shape[1] + j, return_index=True)
+            first.sort()
+            xs, ys, i, j = xs[first], ys[first], i[first], j[first]
+
+            batch_grid = np.full(self.grid.shape, -1, dtype=np.int64)
+            batch_grid[i, j] = np.arange(len(xs))
+            keep = ~self.too_close(
+                batch_grid,
+                np.stack([xs, ys], axis=1),
+                xs, ys, i, j,
+                earlier_only=True)
+
+            xs, ys, i, j = xs[keep], ys[keep], i[keep], j[keep]
+            new = min(len(xs), count - found)
+            xs, ys, i, j = xs[:new], ys[:new], i[:new], j[:new]
+
+            self.add(xs, ys, i, j)
+            result[found:found + new, 0] = xs
+            result[found:found + new, 1] = ys
+            found += new
+
+        return result
+
+    def insert(self, point):
+        """
+        place a point exactly where it is, even if it is close to
+        other points. Sampled points keep away from it.
+        """
+        x, y = point
+        i, j = self.cells(np.array([x]), np.array([y]))
+        x_cells, y_cells = self.grid.shape
+        if (0 <= i[0] < x_cells and
+            0 <= j[0] < y_cells and
+            self.grid[i[0], j[0]] == -1):
+            self.add(np.array([x]), np.array([y]), i, j)
+        else:
+            self.extra_points = np.concatenate(
+                [self.extra_points, [[x, y]]])
 
+        return point
 
 
 class Renderer:
+    """
+    nodes are placed with new_node, new_nodes and new_node_boundary, or
+    loaded from a layout written by save_layout, so a network can be
+    rendered again with other highlights without placing its nodes
+    again. Layout tags must be integers, like species ids.
+
+    draw_edges, draw_nodes and draw_node_squares draw many elements
+    with one cairo path for each color, instead of one path per
+    element.
+    """
 
     def __init__(
             self,
@@ -197,15 +197,13 @@ class Renderer:
             colors = [(x,x,x) for x in [0.3,0.4,0.5,0.6,0.7,0.8]]
     ):
 
-        self.repulsive_sampler = RepulsiveSampler(
+        self.sampler = PoissonDiskSampler(
             rejection_radius,
             0.0,
             1.0,
             0.0,
             1.0,
-            lambda x, y: (
-                True if (x - 0.5)**2 + (y - 0.5)**2 < global_mask_radius**2
-                else False )
+            lambda x, y: (x - 0.5)**2 + (y - 0.5)**2 < global_mask_radius**2
         )
 
         self.local_sampler = random.Random(42)
@@ -227,15 +225,17 @@ class Renderer:
         if tag not in self.node_dict:
 
             if point is not None:
-                self.node_dict[tag] = (
-                    self.repulsive_sampler.quad_tree.insert(
-                        point[0],
-                        point[1],
-                        point))
+                self.node_dict[tag] = self.sampler.insert(point)
 
             else:
-                self.node_dict[tag] = self.repulsive_sampler.sample()
+                self.new_nodes([tag])
 
+    def new_nodes(self, tags):
+        # generate positions for all the unused tags at once
+        tags = [tag for tag in dict.fromkeys(tags) if tag not in self.node_dict]
+        points = self.sampler.sample(len(tags))
+        for tag, (x, y) in zip(tags, points.tolist()):
+            self.node_dict[tag] = (x, y)
 
     def new_node_boundary(self, tag, angle):
         point = (0.5 + self.global_mask_radius * math.cos(angle),
@@ -243,32 +243,77 @@ class Renderer:
 
         self.new_node(tag, point=point)
 
+    def save_layout(self, path):
+        tags = list(self.node_dict)
+        with open(path, "wb") as f:
+            np.savez(
+                f,
+                tags=np.array(tags, dtype=np.int64).reshape(-1),
+                points=np.array(
+                    [self.node_dict[tag] for tag in tags],
+                    dtype=np.float64).reshape(-1, 2))
+
+    def load_layout(self, path):
+        # nodes which are already placed keep their position
+        with np.load(path) as layout:
+            for tag, point in zip(layout['tags'].tolist(),
+                                  layout['points'].tolist()):
+                self.new_node(tag, point=tuple(point))
+
     def draw_node(self, tag, color=(0,0,0), radius=0.0008):
-        point = self.node_dict[tag]
+        self.draw_nodes([tag], color=color, radius=radius)
+
+    def draw_nodes(self, tags, color=(0,0,0), radius=0.0008):
+        if len(tags) == 0:
+            return
+
         self.context.set_source_rgb(*color)
-        self.context.arc(point[0], point[1], radius, 0, 2 * math.pi)
+        for tag in tags:
+            x, y = self.node_dict[tag]
+            self.context.new_sub_path()
+            self.context.arc(x, y, radius, 0, 2 * math.pi)
+
         self.context.fill()
 
     def draw_node_square(self, tag, color=(0,0,0), side=0.005):
-        point = self.node_dict[tag]
+        self.draw_node_squares([tag], color=color, side=side)
+
+    def draw_node_squares(self, tags, color=(0,0,0), side=0.005):
+        if len(tags) == 0:
+            return
+
         self.context.set_source_rgb(*color)
-        self.context.rectangle(point[0] - side/2, point[1] - side/2, side, side)
+        for tag in tags:
+            x, y = self.node_dict[tag]
+            self.context.rectangle(x - side/2, y - side/2, side, side)
+
         self.context.fill()
 
     def draw_edge(self, tag1, tag2, color=None, width=0.001):
+        self.draw_edges([(tag1, tag2)], color=color, width=width)
+
+    def draw_edges(self, edges, color=None, width=0.001):
+        # edges is a sequence of (tag1, tag2). If color is None, each
+        # edge gets a random color from self.colors, as in draw_edge.
+        # Edges of the same color are stroked together, so where edges
+        # cross, the color on top can differ from drawing them one by one.
+        paths = {}
+        for tag1, tag2 in edges:
+            if color is None:
+                edge_color = self.local_sampler.choice(self.colors)
+            else:
+                edge_color = color
 
-        if color is None:
-            color = self.local_sampler.choice(self.colors)
-
-
+            paths.setdefault(tuple(edge_color), []).append((tag1, tag2))
 
-        point1 = self.node_dict[tag1]
-        point2 = self.node_dict[tag2]
-        self.context.set_source_rgb(*color)
         self.context.set_line_width(width)
-        self.context.move_to(*point1)
-        self.context.line_to(*point2)
-        self.context.stroke()
+        for edge_color, color_edges in paths.items():
+            self.context.set_source_rgb(*edge_color)
+            for tag1, tag2 in color_edges:
+                self.context.move_to(*self.node_dict[tag1])
+                self.context.line_to(*self.node_dict[tag2])
+
+            self.context.stroke()
 
     def render(self, path):
         self.surface.write_to_png(path)
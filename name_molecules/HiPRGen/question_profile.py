@@ -0,0 +1,148 @@
+import json
+import os
+from time import perf_counter
+
+"""
+per question profiling of decision trees.
+
+passing a QuestionProfile to run_decision_tree (in species_questions
+or reaction_questions) records, for every question which is asked,
+the number of times it was asked, the number of times it answered
+True and the total wall time spent in it.
+
+Questions are keyed by the name of their decision tree and their
+position in it (e.g "reaction decision tree/1/3" is the fourth
+question in the node reached by the second question of the root), so
+profiles recorded by different workers can be merged.
+"""
+
+
+def question_description(question):
+    if type(question).__str__ is object.__str__:
+        return ""
+    else:
+        return str(question)
+
+
+class QuestionProfile:
+
+    def __init__(self):
+        self.stats = {}
+
+    def record(self, key, question, answer, elapsed):
+        if key not in self.stats:
+            self.stats[key] = {
+                'question' : type(question).__name__,
+                'description' : question_description(question),
+                'count' : 0,
+                'true_count' : 0,
+                'time' : 0.0}
+
+        stats = self.stats[key]
+        stats['count'] += 1
+        stats['time'] += elapsed
+        if answer:
+            stats['true_count'] += 1
+
+    def walk(self, tree_name, decision_tree, ask, decision_pathway=None,
+             runs=None):
+        """
+        the same walk as run_decision_tree, timing every question.
+        ask(question) asks a question about the reaction or species
+        being filtered. Returns the node the walk ended at.
+
+        if runs is given, runs(node) splits the (question, child) pairs
+        of a node into runs, in order. Every question of a run is
+        asked before the first which answered True is followed, so the
+        statistics of questions which commute don't depend on their
+        order.
+        """
+        node = decision_tree
+        path = tree_name
+
+        while type(node) == list:
+            if runs is None:
+                node_runs = [[pair] for pair in node]
+            else:
+                node_runs = runs(node)
+
+            next_node = None
+            index = 0
+            for run in node_runs:
+                answers = []
+                for question, _ in run:
+                    key = path + "/" + str(index + len(answers))
+                    start = perf_counter()
+                    answer = ask(question)
+                    self.record(key, question, answer, perf_counter() - start)
+                    answers.append(answer)
+
+                if True in answers:
+                    position = answers.index(True)
+                    question, new_node = run[position]
+                    if decision_pathway is not None:
+                        decision_pathway.append(question)
+
+                    next_node = new_node
+                    path = path + "/" + str(index + position)
+                    break
+
+                index += len(run)
+
+            node = next_node
+
+        return node
+
+    def merge(self, other):
+        for key, other_stats in other.stats.items():
+            if key not in self.stats:
+                self.stats[key] = dict(other_stats)
+            else:
+                stats = self.stats[key]
+                stats['count'] += other_stats['count']
+                stats['true_count'] += other_stats['true_count']
+                stats['time'] += other_stats['time']
+
+        return self
+
+    def rows(self):
+        """
+        one dict per question, most time consuming first
+        """
+        rows = []
+        for key, stats in self.stats.items():
+            row = {'position' : key}
+            row.update(stats)
+            row['false_count'] = stats['count'] - stats['true_count']
+            row['true_ratio'] = stats['true_count'] / stats['count']
+            rows.append(row)
+
+        rows.sort(key=lambda row: row['time'], reverse=True)
+        return rows
+
+    def table(self):
+        lines = ["%10s %12s %12s %8s  %-32s %s" % (
+            "time (s)", "count", "us per call", "true %",
+            "position", "question")]
+
+        for row in self.rows():
+            lines.append("%10.3f %12d %12.2f %8.2f  %-32s %s" % (
+                row['time'],
+                row['count'],
+                1e6 * row['time'] / row['count'],
+                100 * row['true_ratio'],
+                row['position'],
+                (row['question'] + " " + row['description']).strip()))
+
+        return "\n".join(lines) + "\n"
+
+    def dump(self, path):
+        """
+        write the profile as json to path and as a text table to path
+        with its extension replaced by .txt
+        """
+        with open(path, "w") as f:
+            json.dump(self.rows(), f, indent=2)
+
+        with open(os.path.splitext(path)[0] + ".txt", "w") as f:
+            f.write(self.table())
@@ -1,6 +1,10 @@
-from mpi4py import MPI
-from itertools import permutations, product
+from itertools import product, islice
+from random import Random
+from multiprocessing import Pool
+import numpy as np
 from HiPRGen.report_generator import ReportGenerator
+from HiPRGen.bucketing import BucketArrays
+from HiPRGen.question_profile import QuestionProfile
 import sqlite3
 from time import localtime, strftime, time
 from enum import Enum
@@ -11,9 +15,17 @@ from HiPRGen.reaction_filter_payloads import (
 )
 
 from HiPRGen.reaction_questions import (
-    run_decision_tree
+    run_decision_tree,
+    compile_decision_tree
 )
 
+# MPI is only needed by dispatcher / worker. local_reaction_filter runs
+# the same filtering over a multiprocessing pool without it.
+try:
+    from mpi4py import MPI
+except ImportError:
+    MPI = None
+
 """
 Phases 3 & 4 run in parallel using MPI
 
@@ -28,6 +40,8 @@ output: reaction network database
 description: the worker processes from phase 3 are sending their reactions to this phase and it is writing them to DB as it gets them. We can ensure that duplicates don't get generated in phase 3 which means we don't need extra index tables on the db.
 
 the code in this file is designed to run on a compute cluster using MPI.
+For a single machine, local_reaction_filter runs the same phases over a
+multiprocessing pool and doesn't need an MPI runtime.
 """
 
 
@@ -69,6 +83,12 @@ get_complex_group_sql = """
     SELECT * FROM complexes WHERE composition_id=? AND group_id=?
 """
 
+# answered from the (composition_id, group_id) index
+get_group_sizes_sql = """
+    SELECT composition_id, group_id, COUNT(*) FROM complexes
+    GROUP BY composition_id, group_id
+"""
+
 
 # TODO: structure these global variables better
 DISPATCHER_RANK = 0
@@ -85,12 +105,20 @@ SEND_ME_A_WORK_BATCH = 1
 # sent by dispatcher to workers when delivering a new table
 HERE_IS_A_WORK_BATCH = 2
 
-# sent by workers to the dispatcher when reaction passes db decision tree
+# sent by workers to the dispatcher with a list of reactions which
+# passed the db decision tree
 NEW_REACTION_DB = 3
 
-# sent by workers to the dispatcher when reaction passes logging decision tree
+# sent by workers to the dispatcher with a list of reactions which
+# passed the logging decision tree
 NEW_REACTION_LOGGING = 4
 
+# sent by workers to the dispatcher once they have been told there is
+# no work left, with their QuestionProfile or None if they weren't
+# profiling. only sent once, and the worker is finished once the
+# dispatcher has received it
+QUESTION_PROFILE = 5
+
 class WorkerState(Enum):
     INITIALIZING = 0
     RUNNING = 1
@@ -102,22 +130,78 @@ def log_message(*args, **kwargs):
         '[' + strftime('%H:%M:%S', localtime()) + ']',
         *args, **kwargs)
 
+def work_batch_cost(size_0, size_1, same_group):
+    """
+    number of candidate reactions in a work batch. A group paired with
+    itself is run through permutations, otherwise through a product.
+    """
+    if same_group:
+        return size_0 * (size_0 - 1)
+    else:
+        return size_0 * size_1
+
+
+def build_work_batches(bucket_cur, max_batch_cost, bucket_arrays=None):
+    """
+    A work batch is (composition_id, group_id_0, group_id_1, start, end)
+    and covers the candidate reactions whose reactants are rows start
+    to end of group_id_0. Batches with more than max_batch_cost
+    candidates are split into several row ranges. Returns a list of
+    (cost, work_batch) sorted so that popping from the end hands out
+    the most expensive batch first. Group sizes come from bucket_arrays
+    if it is given and from the bucket db otherwise.
+    """
+    group_sizes = {}
+    if bucket_arrays is not None:
+        group_counts = bucket_arrays.group_counts()
+        for (composition_id, count) in group_counts:
+            for group_id in range(count):
+                group_sizes[(composition_id, group_id)] = (
+                    bucket_arrays.group_size(composition_id, group_id))
+
+    else:
+        for (composition_id, group_id, size) in bucket_cur.execute(
+                get_group_sizes_sql):
+            group_sizes[(composition_id, group_id)] = size
+
+        group_counts = list(bucket_cur.execute("SELECT * FROM group_counts"))
+
+    work_batches = []
+    for (composition_id, count) in group_counts:
+        for (i,j) in product(range(count), repeat=2):
+            size_0 = group_sizes.get((composition_id, i), 0)
+            size_1 = group_sizes.get((composition_id, j), 0)
+            cost = work_batch_cost(size_0, size_1, i == j)
+            if cost == 0:
+                continue
+
+            row_cost = cost // size_0
+            rows_per_batch = max(1, max_batch_cost // row_cost)
+            for start in range(0, size_0, rows_per_batch):
+                end = min(start + rows_per_batch, size_0)
+                work_batches.append(
+                    (row_cost * (end - start),
+                     (composition_id, i, j, start, end)))
+
+    work_batches.sort(key=lambda item: item[0])
+    return work_batches
+
+
 def dispatcher(
         mol_entries,
         dispatcher_payload
 ):
 
     comm = MPI.COMM_WORLD
-    work_batch_list = []
     bucket_con = sqlite3.connect(dispatcher_payload.bucket_db_file)
     bucket_cur = bucket_con.cursor()
-    size_cur = bucket_con.cursor()
 
-    res = bucket_cur.execute("SELECT * FROM group_counts")
-    for (composition_id, count) in res:
-        for (i,j) in product(range(count), repeat=2):
-            work_batch_list.append(
-                (composition_id, i, j))
+    work_batch_list = build_work_batches(
+        bucket_cur,
+        dispatcher_payload.max_batch_cost,
+        open_bucket_arrays(dispatcher_payload.bucket_arrays_dir))
+    remaining_cost = sum(cost for (cost, _) in work_batch_list)
+    log_message("total candidate reactions:", remaining_cost)
 
     composition_names = {}
     res = bucket_cur.execute("SELECT * FROM compositions")
@@ -125,28 +209,32 @@ def dispatcher(
         composition_names[composition_id] = composition
 
     log_message("creating reaction network db")
-    rn_con = sqlite3.connect(dispatcher_payload.reaction_network_db_file)
+    rn_con = create_reaction_network_db(
+        dispatcher_payload.reaction_network_db_file)
     rn_cur = rn_con.cursor()
-    rn_cur.execute(create_metadata_table)
-    rn_cur.execute(create_reactions_table)
-    rn_con.commit()
 
     log_message("initializing report generator")
 
     # since MPI processes spin lock, we don't want to have the dispathcer
-    # spend a bunch of time generating molecule pictures
+    # spend a bunch of time generating molecule pictures, or waiting for
+    # the report to be written
     report_generator = ReportGenerator(
         mol_entries,
         dispatcher_payload.report_file,
-        rebuild_mol_pictures=False
+        rebuild_mol_pictures=False,
+        background_writer=True
     )
 
     worker_states = {}
 
     worker_ranks = [i for i in range(comm.Get_size()) if i != DISPATCHER_RANK]
 
+    # reactions received from each worker since the last checkpoint
+    worker_reaction_counts = {}
+
     for i in worker_ranks:
         worker_states[i] = WorkerState.INITIALIZING
+        worker_reaction_counts[i] = 0
 
     for i in worker_states:
         # block, waiting for workers to initialize
@@ -159,7 +247,10 @@ def dispatcher(
 
     log_message("handling requests")
 
+    question_profile = QuestionProfile()
+
     batches_left_at_last_checkpoint = len(work_batch_list)
+    cost_left_at_last_checkpoint = remaining_cost
     last_checkpoint_time = floor(time())
     while True:
         if WorkerState.RUNNING not in worker_states.values():
@@ -176,13 +267,28 @@ def dispatcher(
 
             batch_consumption_rate = batch_count_diff / time_diff
 
+            cost_consumption_rate = (
+                cost_left_at_last_checkpoint - remaining_cost) / time_diff
+
             log_message("batches remaining:", batches_left_at_current_checkpoint)
             log_message("batch consumption rate:",
                         batch_consumption_rate,
                         "batches per second")
+            log_message("candidate reactions remaining:", remaining_cost)
+            if cost_consumption_rate > 0:
+                log_message("projected time remaining:",
+                            floor(remaining_cost / cost_consumption_rate),
+                            "seconds")
+
+            for i in worker_ranks:
+                log_message("worker", i, "throughput:",
+                            worker_reaction_counts[i] / time_diff,
+                            "reactions per second")
+                worker_reaction_counts[i] = 0
 
 
             batches_left_at_last_checkpoint = batches_left_at_current_checkpoint
+            cost_left_at_last_checkpoint = remaining_cost
             last_checkpoint_time = current_time
 
 
@@ -193,54 +299,46 @@ def dispatcher(
 
         if tag == SEND_ME_A_WORK_BATCH:
             if len(work_batch_list) == 0:
+                # the worker is finished once its QUESTION_PROFILE arrives
                 comm.send(None, dest=rank, tag=HERE_IS_A_WORK_BATCH)
-                worker_states[rank] = WorkerState.FINISHED
             else:
-                # pop removes and returns the last item in the list
-                work_batch = work_batch_list.pop()
+                # pop removes and returns the last item in the list,
+                # which is the most expensive batch left
+                cost, work_batch = work_batch_list.pop()
+                remaining_cost -= cost
                 comm.send(work_batch, dest=rank, tag=HERE_IS_A_WORK_BATCH)
-                composition_id, group_id_0, group_id_1 = work_batch
+                composition_id, group_id_0, group_id_1, start, end = work_batch
                 log_message(
                     "dispatched",
                     composition_names[composition_id],
                     ": group ids:",
-                    group_id_0, group_id_1
+                    group_id_0, group_id_1,
+                    ": rows:",
+                    start, end
                 )
 
 
         elif tag == NEW_REACTION_DB:
-            reaction = data
-            rn_cur.execute(
-                insert_reaction,
-                (reaction_index,
-                 reaction['number_of_reactants'],
-                 reaction['number_of_products'],
-                 reaction['reactants'][0],
-                 reaction['reactants'][1],
-                 reaction['products'][0],
-                 reaction['products'][1],
-                 reaction['rate'],
-                 reaction['dG'],
-                 reaction['dG_barrier'],
-                 reaction['is_redox']
-                 ))
-
-            reaction_index += 1
-            if reaction_index % dispatcher_payload.commit_frequency == 0:
-                rn_con.commit()
+            reactions = data
+            reaction_index = insert_reactions(
+                rn_con,
+                reactions,
+                reaction_index,
+                dispatcher_payload.commit_frequency)
+            worker_reaction_counts[rank] += len(reactions)
 
 
         elif tag == NEW_REACTION_LOGGING:
+            emit_logged_reactions(report_generator, data)
 
-            reaction = data[0]
-            decision_path = data[1]
 
-            report_generator.emit_verbatim(decision_path)
-            report_generator.emit_reaction(reaction)
-            report_generator.emit_bond_breakage(reaction)
-            report_generator.emit_newline()
+        elif tag == QUESTION_PROFILE:
+            if data is not None:
+                question_profile.merge(data)
+            worker_states[rank] = WorkerState.FINISHED
 
 
+    dump_question_profile(question_profile, dispatcher_payload)
 
     log_message("finalzing database and generation report")
     rn_cur.execute(
@@ -256,14 +354,308 @@ def dispatcher(
     rn_con.close()
 
 
+def dump_question_profile(question_profile, dispatcher_payload):
+    if (dispatcher_payload.question_profile_file is not None
+        and len(question_profile.stats) > 0):
+        log_message("writing question profile")
+        question_profile.dump(dispatcher_payload.question_profile_file)
+
+
+def create_reaction_network_db(reaction_network_db_file):
+    rn_con = sqlite3.connect(reaction_network_db_file)
+    rn_cur = rn_con.cursor()
+    rn_cur.execute(create_metadata_table)
+    rn_cur.execute(create_reactions_table)
+    rn_con.commit()
+    return rn_con
+
+
+def insert_reactions(rn_con, reactions, reaction_index, commit_frequency):
+    """
+    write a batch of reactions with consecutive ids starting at
+    reaction_index and return the next free id.
+    """
+    rn_con.executemany(
+        insert_reaction,
+        [(reaction_index + k,
+          reaction['number_of_reactants'],
+          reaction['number_of_products'],
+          reaction['reactants'][0],
+          reaction['reactants'][1],
+          reaction['products'][0],
+          reaction['products'][1],
+          reaction['rate'],
+          reaction['dG'],
+          reaction['dG_barrier'],
+          reaction['is_redox'])
+         for k, reaction in enumerate(reactions)])
+
+    next_reaction_index = reaction_index + len(reactions)
+    if (next_reaction_index // commit_frequency !=
+        reaction_index // commit_frequency):
+        rn_con.commit()
+
+    return next_reaction_index
+
+
+def emit_logged_reactions(report_generator, logged_reactions):
+    for reaction, decision_path in logged_reactions:
+        report_generator.emit_verbatim(decision_path)
+        report_generator.emit_reaction(reaction)
+        report_generator.emit_bond_breakage(reaction)
+        report_generator.emit_newline()
+
+
+def permutations_in_range(bucket, start, end):
+    """
+    the pairs of permutations(bucket, r=2) whose first element is one
+    of bucket[start:end], in the same order.
+    """
+    for a in range(start, end):
+        for b in range(len(bucket)):
+            if a != b:
+                yield (bucket[a], bucket[b])
+
+
+def open_bucket_arrays(bucket_arrays_dir):
+    if bucket_arrays_dir is None:
+        return None
+    else:
+        return BucketArrays.load(bucket_arrays_dir)
+
+
+def get_complex_group(bucket, composition_id, group_id):
+    """
+    the (species_1, species_2) complexes in a group, read either from
+    BucketArrays or through a cursor on the bucket db.
+    """
+    if isinstance(bucket, BucketArrays):
+        return [
+            tuple(row) for row in
+            bucket.group(composition_id, group_id).tolist()]
+
+    res = bucket.execute(
+        get_complex_group_sql,
+        (composition_id, group_id))
+
+    complexes = []
+    for row in res:
+        complexes.append((row[0],row[1]))
+
+    return complexes
+
+
+def candidate_reactions(bucket, work_batch):
+    """
+    the candidate reactions covered by a work batch, in a fixed order.
+    bucket is BucketArrays or a cursor on the bucket db.
+    """
+    composition_id, group_id_0, group_id_1, start, end = work_batch
+
+    if group_id_0 == group_id_1:
+
+        complexes = get_complex_group(bucket, composition_id, group_id_0)
+        iterator = permutations_in_range(complexes, start, end)
+
+    else:
+
+        complexes_0 = get_complex_group(bucket, composition_id, group_id_0)
+        complexes_1 = get_complex_group(bucket, composition_id, group_id_1)
+        iterator = product(complexes_0[start:end], complexes_1)
+
+
+    for (reactants, products) in iterator:
+        yield {
+            'reactants' : reactants,
+            'products' : products,
+            'number_of_reactants' : len([i for i in reactants if i != -1]),
+            'number_of_products' : len([i for i in products if i != -1])}
+
+
+def candidate_reaction_arrays(bucket, work_batch):
+    """
+    the candidate reactions of a work batch, in the same order as
+    candidate_reactions, as (n, 2) arrays of reactants and products
+    with -1 where a reaction has a single reactant or product. These
+    are the arguments of the work_batch_dG method of the dG questions.
+    """
+    composition_id, group_id_0, group_id_1, start, end = work_batch
+
+    if group_id_0 == group_id_1:
+        complexes = np.array(
+            get_complex_group(bucket, composition_id, group_id_0),
+            dtype=np.int64).reshape(-1, 2)
+        a = np.repeat(np.arange(start, end), complexes.shape[0])
+        b = np.tile(np.arange(complexes.shape[0]), end - start)
+        keep = a != b
+        return complexes[a[keep]], complexes[b[keep]]
+
+    else:
+        complexes_0 = np.array(
+            get_complex_group(bucket, composition_id, group_id_0),
+            dtype=np.int64).reshape(-1, 2)[start:end]
+        complexes_1 = np.array(
+            get_complex_group(bucket, composition_id, group_id_1),
+            dtype=np.int64).reshape(-1, 2)
+        return (
+            np.repeat(complexes_0, complexes_1.shape[0], axis=0),
+            np.tile(complexes_1, (complexes_0.shape[0], 1)))
+
+
+def tabulate_free_energies(mol_entries, params):
+    """
+    precompute the free energies at the filtering temperature, which
+    the dG questions look up for every candidate reaction
+    """
+    if "temperature" in params:
+        for mol in mol_entries:
+            mol.tabulate_free_energy(params["temperature"])
+
+
+def filter_reaction(reaction, mol_entries, worker_payload, profile=None):
+    """
+    run a candidate reaction through the reaction and logging decision
+    trees. Returns the reaction to write to the network db (or None)
+    and the (reaction, decision path) to log (or None). If profile is
+    a QuestionProfile, both trees are profiled in it.
+    """
+    db_reaction = None
+    logged_reaction = None
+
+    decision_pathway = []
+    if run_decision_tree(reaction,
+                         mol_entries,
+                         worker_payload.params,
+                         worker_payload.reaction_decision_tree,
+                         decision_pathway,
+                         profile,
+                         "reaction decision tree"
+                         ):
+
+        # the logging decision tree below can still set fields on
+        # reaction, so keep a copy of what the db tree produced
+        db_reaction = dict(reaction)
+
+
+    if run_decision_tree(reaction,
+                         mol_entries,
+                         worker_payload.params,
+                         worker_payload.logging_decision_tree,
+                         profile=profile,
+                         tree_name="logging decision tree"):
+
+        logged_reaction = (
+            reaction,
+            '\n'.join([str(f) for f in decision_pathway])
+        )
+
+    return db_reaction, logged_reaction
+
+
+def sample_candidate_reactions(
+        bucket_db_file,
+        sample_size,
+        bucket_arrays_dir=None,
+        max_batch_cost=250000,
+        candidates_per_batch=100,
+        seed=0):
+    """
+    a sample of candidate reactions, taken from randomly chosen work
+    batches so that it covers many compositions.
+    """
+    bucket_con = sqlite3.connect(bucket_db_file)
+    bucket = open_bucket_arrays(bucket_arrays_dir)
+    if bucket is None:
+        bucket = bucket_con.cursor()
+
+    work_batch_list = build_work_batches(
+        bucket_con.cursor(),
+        max_batch_cost,
+        bucket if isinstance(bucket, BucketArrays) else None)
+
+    Random(seed).shuffle(work_batch_list)
+
+    reactions = []
+    for (_, work_batch) in work_batch_list:
+        if len(reactions) >= sample_size:
+            break
+
+        reactions.extend(islice(
+            candidate_reactions(bucket, work_batch),
+            min(candidates_per_batch, sample_size - len(reactions))))
+
+    bucket_con.close()
+    return reactions
+
+
+def compile_decision_trees(
+        mol_entries,
+        worker_payload,
+        sample_size=10000,
+        verify=False):
+    """
+    replace the decision trees of a worker payload by compiled trees
+    (see reaction_questions.compile_decision_tree) profiled on a sample
+    of candidate reactions from the bucket. The sample only affects
+    the speed of the compiled trees, not their decisions.
+    """
+    reactions = sample_candidate_reactions(
+        worker_payload.bucket_db_file,
+        sample_size,
+        worker_payload.bucket_arrays_dir)
+
+    worker_payload.reaction_decision_tree = compile_decision_tree(
+        worker_payload.reaction_decision_tree,
+        mol_entries,
+        worker_payload.params,
+        reactions,
+        verify)
+
+    worker_payload.logging_decision_tree = compile_decision_tree(
+        worker_payload.logging_decision_tree,
+        mol_entries,
+        worker_payload.params,
+        reactions,
+        verify)
+
+    return worker_payload
+
+
 def worker(
         mol_entries,
         worker_payload
 ):
 
     comm = MPI.COMM_WORLD
-    con = sqlite3.connect(worker_payload.bucket_db_file)
-    cur = con.cursor()
+    tabulate_free_energies(mol_entries, worker_payload.params)
+    bucket = open_bucket_arrays(worker_payload.bucket_arrays_dir)
+    if bucket is None:
+        con = sqlite3.connect(worker_payload.bucket_db_file)
+        bucket = con.cursor()
+
+    db_reactions = []
+    logging_reactions = []
+
+    if worker_payload.profile_questions:
+        profile = QuestionProfile()
+    else:
+        profile = None
+
+    def send_db_reactions():
+        if len(db_reactions) > 0:
+            comm.send(
+                list(db_reactions),
+                dest=DISPATCHER_RANK,
+                tag=NEW_REACTION_DB)
+            db_reactions.clear()
+
+    def send_logging_reactions():
+        if len(logging_reactions) > 0:
+            comm.send(
+                list(logging_reactions),
+                dest=DISPATCHER_RANK,
+                tag=NEW_REACTION_LOGGING)
+            logging_reactions.clear()
 
 
     comm.send(None, dest=DISPATCHER_RANK, tag=INITIALIZATION_FINISHED)
@@ -276,74 +668,162 @@ def worker(
             break
 
 
-        composition_id, group_id_0, group_id_1 = work_batch
+        for reaction in candidate_reactions(bucket, work_batch):
+            db_reaction, logged_reaction = filter_reaction(
+                reaction, mol_entries, worker_payload, profile)
+
+            if db_reaction is not None:
+                db_reactions.append(db_reaction)
+                if len(db_reactions) >= worker_payload.reaction_batch_size:
+                    send_db_reactions()
 
+            if logged_reaction is not None:
+                logging_reactions.append(logged_reaction)
+                if len(logging_reactions) >= worker_payload.reaction_batch_size:
+                    send_logging_reactions()
 
-        if group_id_0 == group_id_1:
+        # flush partial batches before asking for more work, so nothing is
+        # still buffered when the dispatcher marks this worker as finished
+        send_db_reactions()
+        send_logging_reactions()
 
-            res = cur.execute(
-                get_complex_group_sql,
-                (composition_id, group_id_0))
+    comm.send(profile, dest=DISPATCHER_RANK, tag=QUESTION_PROFILE)
 
-            bucket = []
-            for row in res:
-                bucket.append((row[0],row[1]))
 
-            iterator = permutations(bucket, r=2)
+# per process state for the pool workers of local_reaction_filter. It
+# is set once by the pool initializer so that mol_entries isn't sent
+# along with every work batch.
+local_worker_state = {}
 
-        else:
 
-            res_0 = cur.execute(
-                get_complex_group_sql,
-                (composition_id, group_id_0))
+def initialize_local_worker(mol_entries, worker_payload):
+    tabulate_free_energies(mol_entries, worker_payload.params)
+    bucket = open_bucket_arrays(worker_payload.bucket_arrays_dir)
+    if bucket is None:
+        con = sqlite3.connect(worker_payload.bucket_db_file)
+        bucket = con.cursor()
 
-            bucket_0 = []
-            for row in res_0:
-                bucket_0.append((row[0],row[1]))
+    local_worker_state['mol_entries'] = mol_entries
+    local_worker_state['worker_payload'] = worker_payload
+    local_worker_state['bucket'] = bucket
 
-            res_1 = cur.execute(
-                get_complex_group_sql,
-                (composition_id, group_id_1))
 
-            bucket_1 = []
-            for row in res_1:
-                bucket_1.append((row[0],row[1]))
+def filter_work_batch(work_batch):
+    mol_entries = local_worker_state['mol_entries']
+    worker_payload = local_worker_state['worker_payload']
 
-            iterator = product(bucket_0, bucket_1)
+    if worker_payload.profile_questions:
+        profile = QuestionProfile()
+    else:
+        profile = None
 
+    db_reactions = []
+    logging_reactions = []
+    for reaction in candidate_reactions(local_worker_state['bucket'], work_batch):
+        db_reaction, logged_reaction = filter_reaction(
+            reaction, mol_entries, worker_payload, profile)
 
+        if db_reaction is not None:
+            db_reactions.append(db_reaction)
 
-        for (reactants, products) in iterator:
-            reaction = {
-                'reactants' : reactants,
-                'products' : products,
-                'number_of_reactants' : len([i for i in reactants if i != -1]),
-                'number_of_products' : len([i for i in products if i != -1])}
+        if logged_reaction is not None:
+            logging_reactions.append(logged_reaction)
 
+    return db_reactions, logging_reactions, profile
 
-            decision_pathway = []
-            if run_decision_tree(reaction,
-                                 mol_entries,
-                                 worker_payload.params,
-                                 worker_payload.reaction_decision_tree,
-                                 decision_pathway
-                                 ):
 
-                comm.send(
-                    reaction,
-                    dest=DISPATCHER_RANK,
-                    tag=NEW_REACTION_DB)
+def local_reaction_filter(
+        mol_entries,
+        dispatcher_payload,
+        worker_payload,
+        num_workers=None
+):
+    """
+    run phases 3 and 4 on a single machine using a multiprocessing
+    pool instead of MPI. num_workers defaults to the number of cores.
+
+    Work batches are handed out in the same order as the MPI
+    dispatcher, but results are written in work batch order rather
+    than in order of arrival, so the reactions table is the same on
+    every run regardless of num_workers.
+    """
+
+    bucket_con = sqlite3.connect(dispatcher_payload.bucket_db_file)
+    bucket_cur = bucket_con.cursor()
+    work_batch_list = build_work_batches(
+        bucket_cur,
+        dispatcher_payload.max_batch_cost,
+        open_bucket_arrays(dispatcher_payload.bucket_arrays_dir))
+    bucket_con.close()
+
+    remaining_cost = sum(cost for (cost, _) in work_batch_list)
+    log_message("total candidate reactions:", remaining_cost)
 
+    # the MPI dispatcher pops from the end of the list
+    work_batch_list.reverse()
 
-            if run_decision_tree(reaction,
-                                 mol_entries,
-                                 worker_payload.params,
-                                 worker_payload.logging_decision_tree):
+    log_message("creating reaction network db")
+    rn_con = create_reaction_network_db(
+        dispatcher_payload.reaction_network_db_file)
+    rn_cur = rn_con.cursor()
 
-                comm.send(
-                    (reaction,
-                     '\n'.join([str(f) for f in decision_pathway])
-                     ),
+    log_message("initializing report generator")
+    report_generator = ReportGenerator(
+        mol_entries,
+        dispatcher_payload.report_file,
+        rebuild_mol_pictures=False,
+        background_writer=True
+    )
+
+    reaction_index = 0
+    batches_left = len(work_batch_list)
+    question_profile = QuestionProfile()
+    last_checkpoint_time = time()
+
+    log_message("handling requests")
+    with Pool(
+            num_workers,
+            initializer=initialize_local_worker,
+            initargs=(mol_entries, worker_payload)) as p:
 
-                    dest=DISPATCHER_RANK,
-                    tag=NEW_REACTION_LOGGING)
+        results = p.imap(
+            filter_work_batch,
+            [work_batch for (_, work_batch) in work_batch_list])
+
+        for (cost, _), (db_reactions, logging_reactions, profile) in zip(
+                work_batch_list, results):
+
+            if profile is not None:
+                question_profile.merge(profile)
+
+            reaction_index = insert_reactions(
+                rn_con,
+                db_reactions,
+                reaction_index,
+                dispatcher_payload.commit_frequency)
+            emit_logged_reactions(report_generator, logging_reactions)
+
+            batches_left -= 1
+            remaining_cost -= cost
+
+            current_time = time()
+            if (current_time - last_checkpoint_time >=
+                dispatcher_payload.checkpoint_interval):
+                log_message("batches remaining:", batches_left)
+                log_message("candidate reactions remaining:", remaining_cost)
+                log_message("reactions found:", reaction_index)
+                last_checkpoint_time = current_time
+
+
+    dump_question_profile(question_profile, dispatcher_payload)
+
+    log_message("finalzing database and generation report")
+    rn_cur.execute(
+        insert_metadata,
+        (len(mol_entries),
+         reaction_index)
+    )
+
+    report_generator.finished()
+    rn_con.commit()
+    rn_con.close()
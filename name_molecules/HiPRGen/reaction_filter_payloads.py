@@ -14,7 +14,10 @@ class DispatcherPayload(MSONable):
             reaction_network_db_file,
             report_file,
             commit_frequency = 1000,
-            checkpoint_interval = 10):
+            checkpoint_interval = 10,
+            max_batch_cost = 250000,
+            bucket_arrays_dir = None,
+            question_profile_file = None):
 
         self.bucket_db_file = bucket_db_file
         self.reaction_network_db_file = reaction_network_db_file
@@ -22,6 +25,19 @@ class DispatcherPayload(MSONable):
         self.commit_frequency = commit_frequency
         self.checkpoint_interval = checkpoint_interval
 
+        # work batches with more candidate reactions than this are split
+        # into several batches so that no worker is left with a long tail
+        self.max_batch_cost = max_batch_cost
+
+        # if set, group sizes are read from the BucketArrays written by
+        # bucketing.write_bucket_arrays instead of the bucket db
+        self.bucket_arrays_dir = bucket_arrays_dir
+
+        # if set, the question profiles sent by the workers (see
+        # WorkerPayload.profile_questions) are merged and written here
+        # as json, with a text table next to it
+        self.question_profile_file = question_profile_file
+
 
 class WorkerPayload(MSONable):
     """
@@ -33,9 +49,25 @@ class WorkerPayload(MSONable):
             bucket_db_file,
             reaction_decision_tree,
             params,
-            logging_decision_tree):
+            logging_decision_tree,
+            reaction_batch_size = 1000,
+            bucket_arrays_dir = None,
+            profile_questions = False):
 
         self.bucket_db_file = bucket_db_file
         self.reaction_decision_tree = reaction_decision_tree
         self.params = params
         self.logging_decision_tree = logging_decision_tree
+
+        # number of accepted reactions (and logging entries) a worker
+        # collects before sending them to the dispatcher in one message
+        self.reaction_batch_size = reaction_batch_size
+
+        # if set, work batches are sliced out of the memory mapped
+        # BucketArrays in this directory instead of queried from the
+        # bucket db
+        self.bucket_arrays_dir = bucket_arrays_dir
+
+        # if True, workers record a question_profile.QuestionProfile of
+        # both decision trees and send it to the dispatcher
+        self.profile_questions = profile_questions
@@ -1,11 +1,12 @@
 import math
+import numpy as np
 from HiPRGen.mol_entry import MoleculeEntry
 from functools import partial
 import itertools
-import copy
 import networkx as nx
 from networkx.algorithms.graph_hashing import weisfeiler_lehman_graph_hash
 from HiPRGen.constants import Terminal, ROOM_TEMP, KB, PLANCK, m_formulas
+from HiPRGen.question_profile import QuestionProfile
 from monty.json import MSONable
 
 """
@@ -69,9 +70,27 @@ carbon_hash = weisfeiler_lehman_graph_hash(carbon_graph, node_attr="specie")
 
 
 def run_decision_tree(
-    reaction, mol_entries, params, decision_tree, decision_pathway=None
+    reaction,
+    mol_entries,
+    params,
+    decision_tree,
+    decision_pathway=None,
+    profile=None,
+    tree_name="reaction decision tree"
 ):
-    node = decision_tree
+    """
+    if profile is a QuestionProfile, the questions asked are recorded
+    in it under tree_name.
+    """
+    if profile is not None:
+        node = profile.walk(
+            tree_name,
+            decision_tree,
+            lambda question: question(reaction, mol_entries, params),
+            decision_pathway)
+
+    else:
+        node = decision_tree
 
     while type(node) == list:
         next_node = None
@@ -114,6 +133,51 @@ def default_rate(dG_barrier, params):
     return rate
 
 
+def vectorized_dG(reactants, products, free_energies, charges, electron_free_energy):
+    """
+    dG of a batch of reactions. reactants and products are integer
+    arrays of shape (n, 2) of species indices, with -1 where a reaction
+    has a single reactant or product, and free_energies and charges are
+    arrays indexed by species. The terms are added in the same order as
+    in reaction_dG, so the results are the same.
+    """
+    dG = np.zeros(reactants.shape[0])
+
+    # positive dCharge means electrons are lost
+    dCharge = np.zeros(reactants.shape[0])
+
+    for sign, species in [
+            (-1, reactants[:,0]),
+            (-1, reactants[:,1]),
+            (1, products[:,0]),
+            (1, products[:,1])]:
+
+        # adding 0.0 for missing species leaves the sums unchanged
+        present = species != -1
+        dG += sign * np.where(present, free_energies[species], 0.0)
+        dCharge += sign * np.where(present, charges[species], 0.0)
+
+    dG += dCharge * electron_free_energy
+    return dG
+
+
+def species_arrays(question, mol_entries, temperature, reactants, products):
+    """
+    free energies (as computed by a dG question) and charges of the
+    species in a work batch, as arrays indexed by species. Other
+    species are left as 0.
+    """
+    free_energies = np.zeros(len(mol_entries))
+    charges = np.zeros(len(mol_entries))
+
+    species = np.unique(np.concatenate([reactants.ravel(), products.ravel()]))
+    for i in species[species != -1].tolist():
+        free_energies[i] = question.get_free_energy(mol_entries[i], temperature)
+        charges[i] = mol_entries[i].charge
+
+    return free_energies, charges
+
+
 class dG_above_threshold(MSONable):
     def __init__(self, threshold, free_energy_type, constant_barrier, barrier_factor=0):
 
@@ -132,7 +196,7 @@ class dG_above_threshold(MSONable):
     def __str__(self):
         return self.free_energy_type + " dG is above threshold=" + str(self.threshold)
 
-    def __call__(self, reaction, mol_entries, params):
+    def reaction_dG(self, reaction, mol_entries, params):
 
         dG = 0.0
 
@@ -152,6 +216,26 @@ class dG_above_threshold(MSONable):
             dCharge += mol.charge
 
         dG += dCharge * params["electron_free_energy"]
+        return dG
+
+    def work_batch_dG(self, reactants, products, mol_entries, params):
+        """
+        reaction_dG of every reaction in a work batch at once, see
+        vectorized_dG
+        """
+        free_energies, charges = species_arrays(
+            self, mol_entries, params["temperature"], reactants, products)
+
+        return vectorized_dG(
+            reactants,
+            products,
+            free_energies,
+            charges,
+            params["electron_free_energy"])
+
+    def __call__(self, reaction, mol_entries, params):
+
+        dG = self.reaction_dG(reaction, mol_entries, params)
 
         if dG > self.threshold:
             reaction["dG"] = dG
@@ -191,7 +275,7 @@ class dG_below_threshold(MSONable):
     def __str__(self):
         return self.free_energy_type + " dG is below threshold=" + str(self.threshold)
 
-    def __call__(self, reaction, mol_entries, params):
+    def reaction_dG(self, reaction, mol_entries, params):
 
         dG = 0.0
 
@@ -211,6 +295,26 @@ class dG_below_threshold(MSONable):
             dCharge += mol.charge
 
         dG += dCharge * params["electron_free_energy"]
+        return dG
+
+    def work_batch_dG(self, reactants, products, mol_entries, params):
+        """
+        reaction_dG of every reaction in a work batch at once, see
+        vectorized_dG
+        """
+        free_energies, charges = species_arrays(
+            self, mol_entries, params["temperature"], reactants, products)
+
+        return vectorized_dG(
+            reactants,
+            products,
+            free_energies,
+            charges,
+            params["electron_free_energy"])
+
+    def __call__(self, reaction, mol_entries, params):
+
+        dG = self.reaction_dG(reaction, mol_entries, params)
 
         if dG < self.threshold:
             return True
@@ -958,6 +1062,103 @@ class compositions_preclude_h_transfer(MSONable):
         return True
 
 
+# multiset keys of the fragment complexes of a species, cached by the
+# fragment_data list they were computed from. Holding on to the list
+# means its id can't be reused while the entry is in the cache.
+fragment_key_cache = {}
+
+
+def fragment_complex_keys(fragment_data):
+    """
+    the fragment hashes of each fragment complex as a sorted tuple.
+    This is a canonical key for the multiset of fragments, so two
+    combinations of fragment complexes have the same fragments exactly
+    when their merged keys are equal.
+    """
+    cached = fragment_key_cache.get(id(fragment_data))
+    if cached is not None and cached[0] is fragment_data:
+        return cached[1]
+
+    keys = [
+        tuple(sorted(
+            fragment_complex.fragment_hashes[i]
+            for i in range(fragment_complex.number_of_fragments)))
+        for fragment_complex in fragment_data]
+
+    fragment_key_cache[id(fragment_data)] = (fragment_data, keys)
+    return keys
+
+
+def fragment_combinations(species, number_of_species, mol_entries):
+    """
+    (fragment complex indices, multiset key, number of fragments) for
+    the combinations of fragment complexes of one or two species which
+    break at most one bond, in the order fragment_matching_found has
+    always considered them.
+    """
+    combinations = []
+
+    if number_of_species == 1:
+        fragment_data = mol_entries[species[0]].fragment_data
+        keys = fragment_complex_keys(fragment_data)
+        for i in range(len(fragment_data)):
+            combinations.append(
+                ([i], keys[i], fragment_data[i].number_of_fragments))
+
+    if number_of_species == 2:
+        fragment_data_0 = mol_entries[species[0]].fragment_data
+        fragment_data_1 = mol_entries[species[1]].fragment_data
+        keys_0 = fragment_complex_keys(fragment_data_0)
+        keys_1 = fragment_complex_keys(fragment_data_1)
+
+        # indices of the fragment complexes of the second species
+        # breaking at most 0 and at most 1 bonds
+        at_most = [[], []]
+        for j, fragment_complex in enumerate(fragment_data_1):
+            for bonds in range(fragment_complex.number_of_bonds_broken, 2):
+                at_most[bonds].append(j)
+
+        for i, fragment_complex_0 in enumerate(fragment_data_0):
+            bonds_left = 1 - fragment_complex_0.number_of_bonds_broken
+            if bonds_left < 0:
+                continue
+
+            for j in at_most[bonds_left]:
+                combinations.append((
+                    [i, j],
+                    tuple(sorted(keys_0[i] + keys_1[j])),
+                    fragment_complex_0.number_of_fragments
+                    + fragment_data_1[j].number_of_fragments))
+
+    return combinations
+
+
+def fragment_combination_data(species, fragment_indices, mol_entries):
+    """
+    the broken bonds and the fragment hash counts of a combination of
+    fragment complexes
+    """
+    bonds_broken = []
+    hashes = dict()
+    for index, frag_complex_index in enumerate(fragment_indices):
+        fragment_complex = mol_entries[species[index]].fragment_data[frag_complex_index]
+
+        for bond in fragment_complex.bonds_broken:
+            # first element of tuple is which species, x is an
+            # integer, bond is a tuple containing two numbers denoting
+            # the edge of a molecule graph
+            bonds_broken.append([(index, x) for x in bond])
+
+        for i in range(fragment_complex.number_of_fragments):
+            tag = fragment_complex.fragment_hashes[i]
+            if tag in hashes:
+                hashes[tag] += 1
+            else:
+                hashes[tag] = 1
+
+    return bonds_broken, hashes
+
+
 class fragment_matching_found(MSONable):
     def __init__(self):
         pass
@@ -966,118 +1167,69 @@ class fragment_matching_found(MSONable):
         return "fragment matching found"
 
     def __call__(self, reaction, mol_entries, params):
+        """
+        looks for a combination of reactant fragment complexes (breaking
+        at most one bond) with the same multiset of fragments as a
+        combination of product fragment complexes. Rather than comparing
+        every reactant combination with every product combination, the
+        product combinations are indexed by their multiset key and each
+        reactant combination looks up the ones it matches. Matches are
+        visited in the same order as the nested loops would.
+        """
 
-        reactant_fragment_indices_list = []
-        product_fragment_indices_list = []
+        reactant_combinations = fragment_combinations(
+            reaction["reactants"], reaction["number_of_reactants"], mol_entries)
 
-        if reaction["number_of_reactants"] == 1: #creates a list of the indicies pointing to FragmentComplex objects
-            reactant = mol_entries[reaction["reactants"][0]] #reactant is a mol_entry
-            for i in range(len(reactant.fragment_data)):  #fragment_data is a list of FragmentComplex objects, where each
-                reactant_fragment_indices_list.append([i]) #FragmentComplex object is basically a dictionary with four keys
+        product_combinations = fragment_combinations(
+            reaction["products"], reaction["number_of_products"], mol_entries)
 
-        if reaction["number_of_reactants"] == 2: 
-            reactant_0 = mol_entries[reaction["reactants"][0]]
-            reactant_1 = mol_entries[reaction["reactants"][1]]
-            for i in range(len(reactant_0.fragment_data)): #for each fragment of one reactant
-                for j in range(len(reactant_1.fragment_data)): #look at each fragment of the other reactant
-                    if (                                                    #true only when adding fragments of one reactant with the other 
-                        reactant_0.fragment_data[i].number_of_bonds_broken  #unfragmented reactant?
-                        + reactant_1.fragment_data[j].number_of_bonds_broken
-                        <= 1 
-                    ): 
+        products_by_key = {}
+        for (product_fragment_indices, key, _) in product_combinations:
+            if key in products_by_key:
+                products_by_key[key].append(product_fragment_indices)
+            else:
+                products_by_key[key] = [product_fragment_indices]
 
-                        reactant_fragment_indices_list.append([i, j]) #append a list to the list containing fragment indicies for both reactants
+        viable_fragment_matches = []
+        for (reactant_fragment_indices,
+             key,
+             reactant_fragment_count) in reactant_combinations:
 
-        if reaction["number_of_products"] == 1: #repeat for product indicies
-            product = mol_entries[reaction["products"][0]]
-            for i in range(len(product.fragment_data)):
-                product_fragment_indices_list.append([i])
+            if key not in products_by_key:
+                continue
 
-        if reaction["number_of_products"] == 2:
-            product_0 = mol_entries[reaction["products"][0]]
-            product_1 = mol_entries[reaction["products"][1]]
-            for i in range(len(product_0.fragment_data)):
-                for j in range(len(product_1.fragment_data)):
-                    if (
-                        product_0.fragment_data[i].number_of_bonds_broken
-                        + product_1.fragment_data[j].number_of_bonds_broken
-                        <= 1
-                    ):
+            # don't consider fragmentations with both a ring opening and
+            # closing. Matching combinations have the same number of
+            # fragments, so the product side has 2 as well
+            if (
+                reaction["number_of_reactants"] == 2
+                and reaction["number_of_products"] == 2
+                and reactant_fragment_count == 2
+            ):
+                continue
 
-                        product_fragment_indices_list.append([i, j])
+            reactant_bonds_broken, reactant_hashes = fragment_combination_data(
+                reaction["reactants"], reactant_fragment_indices, mol_entries)
 
-        viable_fragment_matches = []
-        for reactant_fragment_indices in reactant_fragment_indices_list: #iterating over all reactant and product fragment indicies
-            for product_fragment_indices in product_fragment_indices_list:
-                reactant_fragment_count = 0
-                product_fragment_count = 0
-                reactant_bonds_broken = []
-                product_bonds_broken = []
-
-                reactant_hashes = dict()
-                for reactant_index, frag_complex_index in enumerate(reactant_fragment_indices):
-                    fragment_complex = mol_entries[                  #pulls out a fragment_complex whose index matches the above
-                        reaction["reactants"][reactant_index]
-                    ].fragment_data[frag_complex_index]
-
-                    for bond in fragment_complex.bonds_broken:       #save what bonds are broken in this complex to reactant_bonds_broken
-                        reactant_bonds_broken.append(
-                            [(reactant_index, x) for x in bond] #first element of tuple is which reactant, x is a integer, bond is a tuple containing two numbers denoting the edge of a molecule graph
-                        )
-
-                    for i in range(fragment_complex.number_of_fragments):
-                        reactant_fragment_count += 1
-                        tag = fragment_complex.fragment_hashes[i]
-                        if tag in reactant_hashes:
-                            reactant_hashes[tag] += 1
-                        else:
-                            reactant_hashes[tag] = 1
-
-                product_hashes = dict()
-                for product_index, frag_complex_index in enumerate(
-                    product_fragment_indices
-                ):
+            for product_fragment_indices in products_by_key[key]:
+                product_bonds_broken, _ = fragment_combination_data(
+                    reaction["products"], product_fragment_indices, mol_entries)
 
-                    fragment_complex = mol_entries[
-                        reaction["products"][product_index]
-                    ].fragment_data[frag_complex_index]
-
-                    for bond in fragment_complex.bonds_broken:
-                        product_bonds_broken.append([(product_index, x) for x in bond])
-
-                    for i in range(fragment_complex.number_of_fragments):
-                        product_fragment_count += 1
-                        tag = fragment_complex.fragment_hashes[i]
-                        if tag in product_hashes:
-                            product_hashes[tag] += 1
-                        else:
-                            product_hashes[tag] = 1
-
-                # don't consider fragmentations with both a ring opening and closing
-                if (
-                    reaction["number_of_reactants"] == 2
-                    and reaction["number_of_products"] == 2
-                    and reactant_fragment_count == 2
-                    and product_fragment_count == 2
-                ):
-                    continue
-
-                if reactant_hashes == product_hashes:
-                    if hydrogen_hash in reactant_hashes:
-                        reaction["reactant_bonds_broken"] = reactant_bonds_broken
-                        reaction["product_bonds_broken"] = product_bonds_broken
-                        reaction["hashes"] = reactant_hashes
-                        reaction["reactant_fragment_count"] = reactant_fragment_count
-                        reaction["product_fragment_count"] = product_fragment_count
-                        return True
-                    else:
-                        tmp = {}
-                        tmp["reactant_bonds_broken"] = reactant_bonds_broken
-                        tmp["product_bonds_broken"] = product_bonds_broken
-                        tmp["hashes"] = reactant_hashes
-                        tmp["reactant_fragment_count"] = reactant_fragment_count
-                        tmp["product_fragment_count"] = product_fragment_count
-                        viable_fragment_matches.append(tmp)
+                if hydrogen_hash in reactant_hashes:
+                    reaction["reactant_bonds_broken"] = reactant_bonds_broken
+                    reaction["product_bonds_broken"] = product_bonds_broken
+                    reaction["hashes"] = reactant_hashes
+                    reaction["reactant_fragment_count"] = reactant_fragment_count
+                    reaction["product_fragment_count"] = reactant_fragment_count
+                    return True
+                else:
+                    tmp = {}
+                    tmp["reactant_bonds_broken"] = reactant_bonds_broken
+                    tmp["product_bonds_broken"] = product_bonds_broken
+                    tmp["hashes"] = reactant_hashes
+                    tmp["reactant_fragment_count"] = reactant_fragment_count
+                    tmp["product_fragment_count"] = reactant_fragment_count
+                    viable_fragment_matches.append(tmp)
 
         if len(viable_fragment_matches) > 0:
             min_frag_size = 1000000000
@@ -1090,11 +1242,11 @@ class fragment_matching_found(MSONable):
                             reactant = mol_entries[reactant_index]
                             if len(reactant.molecule) < min_frag_size:
                                 min_frag_size = len(reactant.molecule)
-                                best_matching = copy.deepcopy(viable_match)
+                                best_matching = viable_match
                     else:
                         for l in viable_match["reactant_bonds_broken"]:
                             hot_reactant = mol_entries[reaction["reactants"][l[0][0]]]
-                            hot_reactant_graph = copy.deepcopy(hot_reactant.covalent_graph)
+                            hot_reactant_graph = hot_reactant.covalent_graph.copy()
                             edge = (l[0][1],l[1][1])
                             hot_reactant_graph.remove_edge(*edge)
                             connected_components = nx.algorithms.components.connected_components(hot_reactant_graph)
@@ -1105,7 +1257,7 @@ class fragment_matching_found(MSONable):
                                 #         print(nx.get_node_attributes(hot_reactant_graph, "specie")[node])
                                 if subgraph.number_of_nodes() < min_frag_size:
                                     min_frag_size = subgraph.number_of_nodes()
-                                    best_matching = copy.deepcopy(viable_match)
+                                    best_matching = viable_match
             reaction["reactant_bonds_broken"] = best_matching["reactant_bonds_broken"]
             reaction["product_bonds_broken"] = best_matching["product_bonds_broken"]
             reaction["hashes"] = best_matching["hashes"]
@@ -1749,4 +1901,396 @@ euvl_phase2_logging_tree = [
         ],
     ),
     (reaction_default_true(), Terminal.DISCARD),
-]
\ No newline at end of file
+]
+
+"""
+decision tree compilation:
+
+compile_decision_tree returns a copy of a decision tree which makes the
+same KEEP / DISCARD decisions but is cheaper to run on a large number
+of candidate reactions.
+
+- questions which only depend on per species quantities (free energy
+  at the run temperature, charge) are replaced by variants which look
+  them up in flat per species arrays instead of recomputing them for
+  every candidate reaction.
+
+- given a sample of candidate reactions, runs of consecutive sibling
+  questions which lead to the same Terminal are reordered so that
+  cheap questions which are likely to answer True are asked first.
+  Since any question in such a run answering True leads to the same
+  Terminal, the order doesn't change the decision. Only questions in
+  commuting_questions are moved. The others set fields on the reaction
+  (dG, rate, is_redox, the fragment matching, ...) and nothing is moved
+  past them.
+
+The decision pathway recorded by run_decision_tree names the question
+which answered True first in the compiled order, so in a reordered run
+it can be a different question than the one the original tree names.
+
+verify_decision_tree checks that two trees agree on a list of reactions.
+"""
+
+# questions which don't modify the reaction and don't rely on a sibling
+# having been asked before them
+commuting_questions = (
+    dG_below_threshold,
+    too_many_reactants_or_products,
+    more_than_one_reactant,
+    only_one_product,
+    metal_metal_reaction,
+    dcharge_too_large,
+    to_negative_ion,
+    reactant_and_product_not_isomorphic,
+    reaction_default_true,
+    star_count_diff_above_threshold,
+    reaction_is_charge_transfer,
+    reaction_is_covalent_charge_decomposable,
+    reaction_is_coupled_electron_fragment_transfer,
+    reaction_is_covalent_decomposable,
+    reaction_is_radical_separation,
+    reaction_is_charge_separation,
+    reactants_are_both_anions_or_both_cations,
+    two_closed_shell_reactants_and_two_open_shell_products,
+    metal_coordination_passthrough,
+    compositions_preclude_h_transfer,
+    single_reactant_single_product_not_atom_transfer,
+    not_h_transfer,
+    fragments_are_not_2A_B,
+    single_reactant_single_product,
+    single_reactant_double_product_ring_close,
+    h_abstraction_from_closed_shell_reactant,
+    h_minus_abstraction,
+    concerted_metal_coordination,
+    concerted_metal_coordination_one_product,
+    concerted_metal_coordination_one_reactant,
+    single_reactant_with_ring_break_two,
+    single_product_with_ring_form_two,
+    reaction_is_hindered,
+    neutral_single_reactant_single_product,
+)
+
+
+class SpeciesCache:
+    """
+    per species quantities needed by the decision tree questions,
+    stored as flat lists indexed by species index. Free energies are
+    computed by the question's own get_free_energy at the run
+    temperature, so cached and uncached questions agree exactly.
+    """
+
+    def __init__(self, mol_entries, temperature):
+        self.mol_entries = mol_entries
+        self.temperature = temperature
+        self.charges = [mol.charge for mol in mol_entries]
+        self.free_energies = {}
+
+    def free_energy_list(self, question):
+        if question.free_energy_type not in self.free_energies:
+            self.free_energies[question.free_energy_type] = [
+                question.get_free_energy(mol, self.temperature)
+                for mol in self.mol_entries]
+
+        return self.free_energies[question.free_energy_type]
+
+    def __getstate__(self):
+        # workers get the cached lists, not a second copy of mol_entries
+        state = dict(self.__dict__)
+        state['mol_entries'] = None
+        return state
+
+
+def cached_dG(reaction, free_energies, charges, electron_free_energy):
+    """
+    the same sums as dG_above_threshold.reaction_dG, in the same order
+    """
+    dG = 0.0
+
+    # positive dCharge means electrons are lost
+    dCharge = 0.0
+
+    for i in range(reaction["number_of_reactants"]):
+        reactant_index = reaction["reactants"][i]
+        dG -= free_energies[reactant_index]
+        dCharge -= charges[reactant_index]
+
+    for j in range(reaction["number_of_products"]):
+        product_index = reaction["products"][j]
+        dG += free_energies[product_index]
+        dCharge += charges[product_index]
+
+    dG += dCharge * electron_free_energy
+    return dG
+
+
+def cached_dCharge(reaction, charges):
+    dCharge = 0.0
+
+    for i in range(reaction["number_of_reactants"]):
+        dCharge -= charges[reaction["reactants"][i]]
+
+    for j in range(reaction["number_of_products"]):
+        dCharge += charges[reaction["products"][j]]
+
+    return dCharge
+
+
+class cached_dG_above_threshold(dG_above_threshold):
+    def __init__(self, question, species_cache):
+        super().__init__(
+            question.threshold,
+            question.free_energy_type,
+            question.constant_barrier,
+            question.barrier_factor)
+
+        self.free_energies = species_cache.free_energy_list(question)
+        self.charges = species_cache.charges
+        self.free_energy_array = np.array(self.free_energies, dtype=float)
+        self.charge_array = np.array(self.charges, dtype=float)
+
+    def reaction_dG(self, reaction, mol_entries, params):
+        return cached_dG(
+            reaction,
+            self.free_energies,
+            self.charges,
+            params["electron_free_energy"])
+
+    def work_batch_dG(self, reactants, products, mol_entries, params):
+        return vectorized_dG(
+            reactants,
+            products,
+            self.free_energy_array,
+            self.charge_array,
+            params["electron_free_energy"])
+
+
+class cached_dG_below_threshold(dG_below_threshold):
+    def __init__(self, question, species_cache):
+        super().__init__(
+            question.threshold,
+            question.free_energy_type,
+            question.constant_barrier)
+
+        self.free_energies = species_cache.free_energy_list(question)
+        self.charges = species_cache.charges
+        self.free_energy_array = np.array(self.free_energies, dtype=float)
+        self.charge_array = np.array(self.charges, dtype=float)
+
+    def reaction_dG(self, reaction, mol_entries, params):
+        return cached_dG(
+            reaction,
+            self.free_energies,
+            self.charges,
+            params["electron_free_energy"])
+
+    def work_batch_dG(self, reactants, products, mol_entries, params):
+        return vectorized_dG(
+            reactants,
+            products,
+            self.free_energy_array,
+            self.charge_array,
+            params["electron_free_energy"])
+
+
+class cached_is_redox_reaction(is_redox_reaction):
+    def __init__(self, question, species_cache):
+        self.charges = species_cache.charges
+
+    def __call__(self, reaction, mol_entries, params):
+        if cached_dCharge(reaction, self.charges) == 0:
+            reaction["is_redox"] = False
+            return False
+        else:
+            reaction["is_redox"] = True
+            return True
+
+
+class cached_dcharge_too_large(dcharge_too_large):
+    def __init__(self, question, species_cache):
+        self.charges = species_cache.charges
+
+    def __call__(self, reaction, mol_entries, params):
+        if abs(cached_dCharge(reaction, self.charges)) > 1:
+            return True
+        else:
+            return False
+
+
+cached_question_types = {
+    dG_above_threshold : cached_dG_above_threshold,
+    dG_below_threshold : cached_dG_below_threshold,
+    is_redox_reaction : cached_is_redox_reaction,
+    dcharge_too_large : cached_dcharge_too_large,
+}
+
+
+def cache_questions(node, species_cache):
+    """
+    copy of a decision tree with questions replaced by their cached
+    variants where there is one
+    """
+    if type(node) != list:
+        return node
+
+    compiled_node = []
+    for (question, child) in node:
+        cached_type = cached_question_types.get(type(question))
+        if cached_type is not None:
+            question = cached_type(question, species_cache)
+
+        compiled_node.append((question, cache_questions(child, species_cache)))
+
+    return compiled_node
+
+
+def sibling_runs(node):
+    """
+    split the (question, child) pairs of a node into runs which can be
+    asked in any order: maximal sequences of commuting questions
+    leading to the same Terminal. Every other pair is a run by itself.
+    """
+    runs = []
+    for (question, child) in node:
+        commutes = (
+            isinstance(question, commuting_questions)
+            and type(child) == Terminal)
+
+        if (commutes
+            and len(runs) > 0
+            and runs[-1][0]
+            and runs[-1][1][-1][1] == child):
+            runs[-1][1].append((question, child))
+        else:
+            runs.append((commutes, [(question, child)]))
+
+    return [run for (_, run) in runs]
+
+
+def profile_decision_tree(
+        decision_tree,
+        reactions,
+        mol_entries,
+        params,
+        tree_name="reaction decision tree"):
+    """
+    run copies of a sample of reactions through a decision tree and
+    return their QuestionProfile. Every question in a run of commuting
+    siblings is asked, so the statistics don't depend on the order of
+    the run.
+    """
+    profile = QuestionProfile()
+
+    for original_reaction in reactions:
+        reaction = dict(original_reaction)
+        profile.walk(
+            tree_name,
+            decision_tree,
+            lambda question: question(reaction, mol_entries, params),
+            runs=sibling_runs)
+
+    return profile
+
+
+def question_order_key(stats):
+    """
+    asking a run of questions until one answers True, the expected
+    cost is minimized by asking them in increasing order of
+    cost / probability of answering True.
+    """
+    if stats is None or stats['count'] == 0:
+        return (math.inf, math.inf)
+
+    cost = stats['time'] / stats['count']
+    probability = stats['true_count'] / stats['count']
+
+    if probability == 0:
+        return (math.inf, cost)
+    else:
+        return (cost / probability, cost)
+
+
+def reorder_decision_tree(node, profile, path="reaction decision tree"):
+    """
+    reorder the runs of commuting siblings of a decision tree using a
+    QuestionProfile of it, recorded under the tree name path
+    """
+    if type(node) != list:
+        return node
+
+    reordered_node = []
+    index = 0
+    for run in sibling_runs(node):
+        keyed_run = []
+        for (question, child) in run:
+            keyed_run.append((path + "/" + str(index), question, child))
+            index += 1
+
+        # sorted is stable, so questions without statistics keep their order
+        keyed_run.sort(
+            key=lambda item: question_order_key(profile.stats.get(item[0])))
+
+        for (key, question, child) in keyed_run:
+            reordered_node.append(
+                (question, reorder_decision_tree(child, profile, key)))
+
+    return reordered_node
+
+
+def verify_decision_tree(
+        decision_tree,
+        compiled_decision_tree,
+        reactions,
+        mol_entries,
+        params):
+    """
+    run copies of each reaction through both trees and raise if they
+    disagree on whether to keep it, or on the fields of a kept
+    reaction. Returns the number of reactions checked.
+    """
+    for original_reaction in reactions:
+        reaction = dict(original_reaction)
+        compiled_reaction = dict(original_reaction)
+
+        keep = run_decision_tree(reaction, mol_entries, params, decision_tree)
+        compiled_keep = run_decision_tree(
+            compiled_reaction, mol_entries, params, compiled_decision_tree)
+
+        if keep != compiled_keep or (keep and reaction != compiled_reaction):
+            raise Exception(
+                "compiled decision tree disagrees on reaction " +
+                str(original_reaction))
+
+    return len(reactions)
+
+
+def compile_decision_tree(
+        decision_tree,
+        mol_entries,
+        params,
+        reactions=None,
+        verify=False):
+    """
+    compile a decision tree as described above. Without a sample of
+    reactions, questions are only replaced by their cached variants.
+    If verify is True, the compiled tree is checked against the
+    original on the sample.
+    """
+    species_cache = SpeciesCache(mol_entries, params["temperature"])
+    compiled_decision_tree = cache_questions(decision_tree, species_cache)
+
+    if reactions is not None:
+        reactions = list(reactions)
+        profile = profile_decision_tree(
+            compiled_decision_tree, reactions, mol_entries, params)
+        compiled_decision_tree = reorder_decision_tree(
+            compiled_decision_tree, profile)
+
+        if verify:
+            verify_decision_tree(
+                decision_tree,
+                compiled_decision_tree,
+                reactions,
+                mol_entries,
+                params)
+
+    return compiled_decision_tree
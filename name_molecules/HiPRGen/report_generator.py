@@ -1,7 +1,12 @@
 import networkx as nx
 from copy import deepcopy
+import gzip
+import hashlib
 import os
+from multiprocessing import Pool
 from pathlib import Path
+from queue import Queue
+from threading import Thread
 
 atom_colors = {
     "H": "gray",
@@ -21,17 +26,31 @@ atom_colors = {
 }
 
 
+# a mol pictures folder has a line "index hash" in this file for every
+# picture which has been drawn, hash being the picture_hash of the
+# molecule entry it was drawn from.
+picture_hashes_file_name = "picture_hashes.txt"
+
+
 def visualize_molecule_entry(molecule_entry, path):
     """
     visualize a molecule using graphviz and
     output the resulting pdf to path
     """
+    visualize_molecule_graph(
+        molecule_entry.graph,
+        molecule_entry.species,
+        molecule_entry.charge,
+        path)
+
 
-    graph = deepcopy(molecule_entry.graph)
+def visualize_molecule_graph(graph, species, charge, path):
+
+    graph = deepcopy(graph)
 
     nx.set_node_attributes(graph, "filled", "style")
     nx.set_node_attributes(graph, "circle", "shape")
-    if molecule_entry.species[0] == "E":
+    if species[0] == "E":
         nx.set_node_attributes(graph, "0.5", "width")
     else:
         nx.set_node_attributes(graph, "0.2", "width")
@@ -41,11 +60,10 @@ def visualize_molecule_entry(molecule_entry, path):
 
     nx.set_node_attributes(
         graph,
-        dict(enumerate([atom_colors[a] for a in molecule_entry.species])),
+        dict(enumerate([atom_colors[a] for a in species])),
         "color",
     )
 
-    charge = molecule_entry.charge
     agraph = nx.nx_agraph.to_agraph(graph)
     if charge != 0:
         agraph.add_node(
@@ -61,11 +79,167 @@ def visualize_molecule_entry(molecule_entry, path):
     agraph.draw(path.as_posix(), format="pdf")
 
 
-def visualize_molecules(mol_entries, folder):
+def picture_hash(molecule_entry):
+    """
+    hash of everything a molecule picture is drawn from
+    """
+    edges = sorted(tuple(sorted(edge[0:2])) for edge in molecule_entry.graph.edges)
+    content = repr((molecule_entry.species, edges, molecule_entry.charge))
+    return hashlib.sha256(content.encode()).hexdigest()
+
+
+def read_picture_hashes(folder):
+    picture_hashes = {}
+    path = folder.joinpath(picture_hashes_file_name)
+    if path.exists():
+        with path.open() as f:
+            for line in f:
+                fields = line.split()
+                # the last line can be cut short if drawing was interrupted
+                if len(fields) == 2 and len(fields[1]) == 64:
+                    picture_hashes[int(fields[0])] = fields[1]
+
+    return picture_hashes
+
+
+def draw_molecule_picture(picture):
+    index, graph, species, charge, path = picture
+
+    # drawn next to the picture and then moved into place, so a
+    # picture is never left half written
+    partial_path = path.with_name(path.stem + ".partial.pdf")
+    visualize_molecule_graph(graph, species, charge, partial_path)
+    os.replace(partial_path, path)
+    return index
+
+
+def visualize_molecules(mol_entries, folder, num_workers=None):
+    """
+    draw a picture of each molecule entry into folder, using a pool of
+    num_workers processes (all cores if it is None). Pictures which
+    are already in the folder and were drawn from the same graph,
+    species and charge are kept, so pictures are only redrawn when
+    their molecules change, and an interrupted run picks up where it
+    stopped.
+    """
+
+    folder.mkdir(parents=True, exist_ok=True)
+    old_picture_hashes = read_picture_hashes(folder)
+    picture_hashes = [picture_hash(m) for m in mol_entries]
 
-    folder.mkdir()
+    pictures = []
     for index, molecule_entry in enumerate(mol_entries):
-        visualize_molecule_entry(molecule_entry, folder.joinpath(str(index) + ".pdf"))
+        path = folder.joinpath(str(index) + ".pdf")
+        if (old_picture_hashes.get(index) != picture_hashes[index] or
+            not path.exists()):
+            pictures.append((
+                index,
+                molecule_entry.graph,
+                molecule_entry.species,
+                molecule_entry.charge,
+                path))
+
+    hashes_path = folder.joinpath(picture_hashes_file_name)
+    with hashes_path.open("a") as f:
+
+        def record(index):
+            f.write(str(index) + " " + picture_hashes[index] + "\n")
+            f.flush()
+
+        if num_workers == 1 or len(pictures) <= 1:
+            for picture in pictures:
+                record(draw_molecule_picture(picture))
+        else:
+            with Pool(num_workers) as p:
+                for index in p.imap_unordered(
+                        draw_molecule_picture, pictures, chunksize=8):
+                    record(index)
+
+    # rewrite the hashes file with one line per picture, so it doesn't
+    # keep growing when the folder is reused
+    partial_hashes_path = folder.joinpath(picture_hashes_file_name + ".partial")
+    with partial_hashes_path.open("w") as f:
+        for index, h in enumerate(picture_hashes):
+            f.write(str(index) + " " + h + "\n")
+
+    os.replace(partial_hashes_path, hashes_path)
+
+
+class ReportFile:
+    """
+    the file a ReportGenerator writes to. Writes are collected in
+    memory and written out in chunks of about buffer_size characters.
+    If background is True, the chunks are written by a thread, with at
+    most queue_size of them waiting, so writing to a ReportFile only
+    waits for the disk when it falls that far behind. An error in the
+    thread is raised by close. Files whose name ends in .gz are gzip
+    compressed.
+    """
+
+    def __init__(self, path, buffer_size=1 << 20, background=False,
+                 queue_size=4):
+        if path.suffix == ".gz":
+            self.f = gzip.open(path, mode="wt")
+        else:
+            self.f = path.open(mode="w")
+
+        self.buffer = []
+        self.buffered = 0
+        self.buffer_size = buffer_size
+
+        if background:
+            self.chunks = Queue(maxsize=queue_size)
+            self.error = None
+            self.thread = Thread(target=self.write_chunks, daemon=True)
+            self.thread.start()
+        else:
+            self.chunks = None
+
+    def write(self, s):
+        self.buffer.append(s)
+        self.buffered += len(s)
+        if self.buffered >= self.buffer_size:
+            self.flush()
+
+    def flush(self):
+        chunk = "".join(self.buffer)
+        self.buffer = []
+        self.buffered = 0
+
+        if self.chunks is None:
+            self.f.write(chunk)
+        else:
+            self.chunks.put(chunk)
+
+    def write_chunks(self):
+        # None marks the end of the file
+        while True:
+            chunk = self.chunks.get()
+            if chunk is None:
+                break
+
+            # once writing has failed, the error is raised by close and
+            # the remaining chunks are dropped. The queue keeps being
+            # drained, so that the writer doesn't block on a full queue
+            if self.error is None:
+                try:
+                    self.f.write(chunk)
+                except BaseException as e:
+                    self.error = e
+
+    def close(self):
+        self.flush()
+        if self.chunks is not None:
+            self.chunks.put(None)
+            self.thread.join()
+
+        try:
+            self.f.close()
+        finally:
+            # the error from the thread is the one to report, closing
+            # the file after it often fails as well
+            if self.chunks is not None and self.error is not None:
+                raise self.error
 
 
 class ReportGenerator:
@@ -75,7 +249,19 @@ class ReportGenerator:
         report_file_path,
         mol_pictures_folder_name="mol_pictures",
         rebuild_mol_pictures=True,
+        num_workers=None,
+        background_writer=False,
     ):
+        """
+        if rebuild_mol_pictures is True, pictures of mol_entries are
+        drawn into the mol pictures folder by visualize_molecules,
+        using num_workers processes. Pictures already there which are
+        up to date are kept.
+
+        the report is written through a ReportFile, in a background
+        thread if background_writer is True. If report_file_path ends
+        in .gz, the report is gzip compressed.
+        """
         self.report_file_path = Path(report_file_path)
         self.mol_pictures_folder_name = mol_pictures_folder_name
         self.mol_pictures_folder = self.report_file_path.parent.joinpath(
@@ -83,10 +269,13 @@ class ReportGenerator:
         )
 
         if rebuild_mol_pictures:
-            visualize_molecules(mol_entries, self.mol_pictures_folder)
+            visualize_molecules(
+                mol_entries,
+                self.mol_pictures_folder,
+                num_workers)
 
         self.mol_entries = mol_entries
-        self.f = self.report_file_path.open(mode="w")
+        self.f = ReportFile(self.report_file_path, background=background_writer)
 
         # write in header
         self.f.write("\\documentclass{article}\n")
@@ -1,4 +1,5 @@
 from HiPRGen.mol_entry import MoleculeEntry
+from multiprocessing import Pool
 from functools import partial
 from itertools import chain
 from monty.serialization import dumpfn
@@ -10,6 +11,8 @@ from time import localtime, strftime
 from networkx.algorithms.graph_hashing import weisfeiler_lehman_graph_hash
 import networkx.algorithms.isomorphism as iso
 from HiPRGen.report_generator import ReportGenerator
+from HiPRGen.question_profile import QuestionProfile
+from HiPRGen.mol_entry_arrays import write_mol_entry_arrays
 from pymatgen.core.periodic_table import DummySpecies
 from pymatgen.core.sites import Site
 from pymatgen.core.structure import Molecule
@@ -54,23 +57,74 @@ def really_covalent_isomorphic(mol1, mol2):
     )
 
 
-def groupby(equivalence_relation, xs):
+def isomorphism_invariant(mol):
+    """
+    a key which is equal for molecules with isomorphic covalent graphs:
+    the degree sequence, the species of each atom together with the
+    sorted species of its neighbors and a WL hash with more iterations
+    than covalent_hash.
+    """
+    graph = mol.covalent_graph
+    degrees = tuple(sorted(d for _, d in graph.degree()))
+    neighbor_signatures = tuple(sorted(
+        (graph.nodes[n]["specie"],
+         tuple(sorted(graph.nodes[v]["specie"] for _, v in graph.edges(n))))
+        for n in graph.nodes))
+
+    wl_hash = weisfeiler_lehman_graph_hash(
+        graph,
+        node_attr="specie",
+        iterations=max(3, graph.number_of_nodes()))
+
+    return (degrees, neighbor_signatures, wl_hash)
+
+
+def groupby(equivalence_relation, xs, key=None, counts=None):
     """
     warning: this has slightly different semantics than
     itertools groupby which depends on ordering.
+
+    if key is given, equivalent elements must have equal keys. Each
+    element is then only compared with the groups whose keys are
+    equal to its own, which gives the same groups in the same order.
+    if counts is given, counts["checks"] is incremented by the number
+    of times equivalence_relation is called and counts["avoided"] by
+    the number of calls the key saved.
     """
     groups = []
+    groups_by_key = {}
 
     for x in xs:
+        if key is None:
+            candidates = groups
+        else:
+            candidates = groups_by_key.setdefault(key(x), [])
+
+        checks = 0
         group_found = False
-        for group in groups:
+        for group in candidates:
+            checks += 1
             if equivalence_relation(x, group[0]):
                 group.append(x)
                 group_found = True
                 break
 
+        if counts is not None:
+            # without a key, x is compared with every group up to the
+            # one it belongs to
+            if group_found:
+                unkeyed_checks = next(
+                    i for i, g in enumerate(groups) if g is group) + 1
+            else:
+                unkeyed_checks = len(groups)
+
+            counts["checks"] += checks
+            counts["avoided"] += unkeyed_checks - checks
+
         if not group_found:
             groups.append([x])
+            if key is not None:
+                candidates.append(groups[-1])
 
     return groups
 
@@ -79,6 +133,74 @@ def log_message(string):
     print("[" + strftime("%H:%M:%S", localtime()) + "]", string)
 
 
+def apply_local_filters(
+        mol,
+        species_decision_tree,
+        species_logging_decision_tree,
+        question_profile=None):
+    """
+    run a molecule entry through the species and logging decision
+    trees. Returns whether to keep it and the decision pathway to log,
+    or None if it isn't logged.
+    """
+    decision_pathway = []
+    keep = run_decision_tree(
+        mol,
+        species_decision_tree,
+        decision_pathway,
+        question_profile,
+        "species decision tree")
+
+    logged_pathway = None
+    if run_decision_tree(
+            mol,
+            species_logging_decision_tree,
+            profile=question_profile,
+            tree_name="species logging decision tree"):
+        logged_pathway = "\n".join([str(f) for f in decision_pathway])
+
+    return keep, logged_pathway
+
+
+# per process state for the pool workers of species_filter. It is set
+# once by the pool initializer so that the decision trees aren't sent
+# along with every entry.
+species_worker_state = {}
+
+
+def initialize_species_worker(
+        from_entry,
+        species_decision_tree,
+        species_logging_decision_tree,
+        profile_questions):
+
+    species_worker_state['from_entry'] = from_entry
+    species_worker_state['species_decision_tree'] = species_decision_tree
+    species_worker_state['species_logging_decision_tree'] = species_logging_decision_tree
+    species_worker_state['profile_questions'] = profile_questions
+
+
+def filter_species(entry):
+    """
+    pool version of apply_local_filters, building the molecule entry
+    from a dataset entry.
+    """
+    mol = species_worker_state['from_entry'](entry)
+
+    if species_worker_state['profile_questions']:
+        question_profile = QuestionProfile()
+    else:
+        question_profile = None
+
+    keep, logged_pathway = apply_local_filters(
+        mol,
+        species_worker_state['species_decision_tree'],
+        species_worker_state['species_logging_decision_tree'],
+        question_profile)
+
+    return mol, keep, logged_pathway, question_profile
+
+
 def species_filter(
     dataset_entries,
     mol_entries_pickle_location,
@@ -87,30 +209,84 @@ def species_filter(
     coordimer_weight,
     species_logging_decision_tree=Terminal.DISCARD,
     generate_unfiltered_mol_pictures=False,
+    question_profile_file=None,
+    num_workers=1,
+    mol_entry_arrays_dir=None,
 ):
 
     """
     run each molecule through the species decision tree and then choose the lowest weight
     coordimer based on the coordimer_weight function.
+
+    if question_profile_file is set, both decision trees are profiled
+    (see question_profile.py) and the profile is written there as json,
+    with a text table next to it.
+
+    if num_workers is more than 1, building the molecule entries and
+    running them through the decision trees is done by a pool of that
+    many processes (all cores if it is None). Results come back in
+    input order and the report is written by this process, so the
+    report and the entries in the mol_entries pickle are the same as for
+    a serial run. Unfiltered mol pictures show the entries before the
+    decision trees ran, so if they are requested, this process builds
+    its own copy of the entries to draw.
+
+    if mol_entry_arrays_dir is given, the filtered entries are also
+    exported there as MolEntryArrays (see mol_entry_arrays.py).
     """
 
     log_message("starting species filter")
     log_message("loading molecule entries from json")
 
     if "has_props" in dataset_entries[0].keys():
-        mol_entries_unfiltered = [MoleculeEntry.from_mp_doc(e) for e in dataset_entries]
+        from_entry = MoleculeEntry.from_mp_doc
         log_message("MP doc entries passed")
     else:
         log_message("dataset entries passed")
-        mol_entries_unfiltered = [
-            MoleculeEntry.from_dataset_entry(e) for e in dataset_entries
-        ]
+        from_entry = MoleculeEntry.from_dataset_entry
+
+    if question_profile_file is not None:
+        question_profile = QuestionProfile()
+    else:
+        question_profile = None
+
+    def pool_results():
+        with Pool(
+                num_workers,
+                initializer=initialize_species_worker,
+                initargs=(
+                    from_entry,
+                    species_decision_tree,
+                    species_logging_decision_tree,
+                    question_profile is not None)) as p:
+
+            results = []
+            for (mol, keep, logged_pathway, mol_profile) in p.imap(
+                    filter_species, dataset_entries, chunksize=16):
+                if mol_profile is not None:
+                    question_profile.merge(mol_profile)
+                results.append((mol, keep, logged_pathway))
+
+        return results
+
+    if num_workers == 1:
+        results = None
+        mol_entries_unfiltered = [from_entry(e) for e in dataset_entries]
+        picture_entries = mol_entries_unfiltered
+    else:
+        log_message("building molecule entries and applying local filters")
+        results = pool_results()
+        mol_entries_unfiltered = [mol for (mol, _, _) in results]
+        if generate_unfiltered_mol_pictures:
+            picture_entries = [from_entry(e) for e in dataset_entries]
+        else:
+            picture_entries = mol_entries_unfiltered
 
     log_message("found " + str(len(mol_entries_unfiltered)) + " molecule entries")
     log_message("generating unfiltered mol pictures")
 
     report_generator = ReportGenerator(
-        mol_entries_unfiltered,
+        picture_entries,
         species_report,
         mol_pictures_folder_name="mol_pictures_unfiltered",
         rebuild_mol_pictures=generate_unfiltered_mol_pictures,
@@ -121,21 +297,29 @@ def species_filter(
     log_message("applying local filters")
     mol_entries_filtered = []
 
+    if results is None:
+        # lazy, so that each molecule is logged as it is filtered
+        results = (
+            (mol,)
+            + apply_local_filters(
+                mol,
+                species_decision_tree,
+                species_logging_decision_tree,
+                question_profile)
+            for mol in mol_entries_unfiltered)
+
     # note: it is important here that we are applying the local filters before
     # the non local ones. We remove some molecules which are lower energy
     # than other more realistic lithomers.
 
-    for i, mol in enumerate(mol_entries_unfiltered):
+    for i, (mol, keep, logged_pathway) in enumerate(results):
         log_message("filtering " + mol.entry_id)
-        decision_pathway = []
-        if run_decision_tree(mol, species_decision_tree, decision_pathway):
+        if keep:
             mol_entries_filtered.append(mol)
 
-        if run_decision_tree(mol, species_logging_decision_tree):
+        if logged_pathway is not None:
 
-            report_generator.emit_verbatim(
-                "\n".join([str(f) for f in decision_pathway])
-            )
+            report_generator.emit_verbatim(logged_pathway)
 
             report_generator.emit_text("number: " + str(i))
             report_generator.emit_text("entry id: " + mol.entry_id)
@@ -158,6 +342,10 @@ def species_filter(
 
     report_generator.finished()
 
+    if question_profile is not None:
+        log_message("writing question profile")
+        question_profile.dump(question_profile_file)
+
     # python doesn't have shared memory. That means that every worker during
     # reaction filtering must maintain its own copy of the molecules.
     # for this reason, it is good to remove attributes that are only used
@@ -178,11 +366,27 @@ def species_filter(
         return lowest_energy_coordimer
 
     mol_entries = []
+    isomorphism_counts = {"checks" : 0, "avoided" : 0}
 
     for tag_group in sort_into_tags(mol_entries_filtered).values():
-        for iso_group in groupby(really_covalent_isomorphic, tag_group):
+        # single molecule tags need no isomorphism checks, so don't
+        # compute their invariants
+        if len(tag_group) > 1:
+            key = isomorphism_invariant
+        else:
+            key = None
+
+        for iso_group in groupby(
+                really_covalent_isomorphic,
+                tag_group,
+                key,
+                isomorphism_counts):
             mol_entries.append(collapse_isomorphism_group(iso_group))
 
+    log_message(
+        str(isomorphism_counts["checks"]) + " isomorphism checks, " +
+        str(isomorphism_counts["avoided"]) + " avoided by invariants")
+
     log_message("assigning indices")
 
     for i, e in enumerate(mol_entries):
@@ -196,13 +400,20 @@ def species_filter(
     with open(mol_entries_pickle_location, "wb") as f:
         pickle.dump(mol_entries, f)
 
+    if mol_entry_arrays_dir is not None:
+        log_message("creating molecule entry arrays")
+        write_mol_entry_arrays(mol_entries, mol_entry_arrays_dir)
+
     log_message("species filtering finished. " + str(len(mol_entries)) + " species")
 
     return mol_entries
 
 
 def add_electron_species(
-    mol_entries, mol_entries_pickle_location, electron_free_energy
+    mol_entries,
+    mol_entries_pickle_location,
+    electron_free_energy,
+    mol_entry_arrays_dir=None,
 ):
     e_site = Site(
         DummySpecies("E", oxidation_state=None, properties=None), [0.0, 0.0, 0.0]
@@ -229,4 +440,6 @@ def add_electron_species(
     mol_entries.append(electron_entry)
     with open(mol_entries_pickle_location, "wb") as f:
         pickle.dump(mol_entries, f)
+    if mol_entry_arrays_dir is not None:
+        write_mol_entry_arrays(mol_entries, mol_entry_arrays_dir)
     return mol_entries
@@ -1,12 +1,12 @@
 from HiPRGen.mol_entry import MoleculeEntry, FragmentComplex
 import networkx as nx
 from networkx.algorithms.graph_hashing import weisfeiler_lehman_graph_hash
-import copy
 from functools import partial
 from HiPRGen.constants import li_ec, Terminal, mg_g2, mg_thf, m_formulas, metals
 import numpy as np
 from monty.json import MSONable
 from itertools import combinations
+from contextlib import contextmanager
 
 """
 species decision tree:
@@ -29,9 +29,25 @@ Once a Terminal node is reached, it tells us whether to keep or discard the spec
 """
 
 
-def run_decision_tree(mol_entry, decision_tree, decision_pathway=None):
+def run_decision_tree(
+        mol_entry,
+        decision_tree,
+        decision_pathway=None,
+        profile=None,
+        tree_name="species decision tree"):
+    """
+    if profile is a QuestionProfile, the questions asked are recorded
+    in it under tree_name.
+    """
+    if profile is not None:
+        node = profile.walk(
+            tree_name,
+            decision_tree,
+            lambda question: question(mol_entry),
+            decision_pathway)
 
-    node = decision_tree
+    else:
+        node = decision_tree
 
     while type(node) == list:
         next_node = None
@@ -144,6 +160,49 @@ class add_unbroken_fragment(MSONable):  #aka adds unfragmented molecule as a "fr
         return False
 
 
+@contextmanager
+def edges_removed(graph, edges):
+    """
+    temporarily remove edges (u, v, key) from a multigraph. Breaking
+    bonds this way on one working copy of a covalent graph is much
+    cheaper than deep copying the graph for every bond. Removing and
+    adding an edge back can change the order of the adjacency lists of
+    the working copy, which doesn't change its components or hashes.
+    """
+    removed = [(u, v, key, graph.edges[u, v, key]) for (u, v, key) in edges]
+    for (u, v, key, _) in removed:
+        graph.remove_edge(u, v, key)
+
+    try:
+        yield graph
+    finally:
+        for (u, v, key, data) in reversed(removed):
+            graph.add_edge(u, v, key=key, **data)
+
+
+def fragment_hashes(graph, removed_edges, hash_memo):
+    """
+    the hashes of the connected components of graph, which is a
+    covalent graph with removed_edges taken out. A component's
+    subgraph is determined by its nodes and the removed edges inside
+    it, so hashes are memoized on those.
+    """
+    hashes = []
+    for c in nx.algorithms.components.connected_components(graph):
+        key = (
+            frozenset(c),
+            frozenset(edge for edge in removed_edges
+                      if edge[0] in c and edge[1] in c))
+
+        if key not in hash_memo:
+            hash_memo[key] = weisfeiler_lehman_graph_hash(
+                graph.subgraph(c), node_attr="specie")
+
+        hashes.append(hash_memo[key])
+
+    return hashes
+
+
 class add_single_bond_fragments(MSONable): #called for all species that have passed through filtration
     def __init__(self, allow_ring_opening=True):
         self.allow_ring_opening = allow_ring_opening
@@ -153,36 +212,29 @@ class add_single_bond_fragments(MSONable): #called for all species that have pas
         if mol.formula in m_formulas:
             return False
 
-        for edge in mol.covalent_graph.edges: #iterates through each bond in a molecule graph by iterating through a list of tuples
-            fragment_hashes = []
-            h = copy.deepcopy(mol.covalent_graph)
-            h.remove_edge(*edge) #"breaks a bond" in the molecule graph
-            connected_components = nx.algorithms.components.connected_components(h) #generates a set of nodes for each "fragment"
-            for c in connected_components:
-
-                subgraph = h.subgraph(c) #generates a subgraph from one set of nodes (this is a fragment graph)
-
-                fragment_hash = weisfeiler_lehman_graph_hash( #saves the hash of this graph
-                    subgraph, node_attr="specie"
-                )
+        h = mol.covalent_graph.copy() #working copy which bonds are broken in and restored
+        hash_memo = {}
 
-                fragment_hashes.append(fragment_hash) #adds each fragment hash to the fragment hash list
+        for edge in mol.covalent_graph.edges: #iterates through each bond in a molecule graph by iterating through a list of tuples
+            with edges_removed(h, [edge]): #"breaks a bond" in the molecule graph
+                # the hash of each connected component ("fragment")
+                hashes = fragment_hashes(h, [edge], hash_memo)
 
             equivalent_fragments_already_found = False
             for fragment_complex in mol.fragment_data:
-                if len(fragment_hashes) == len(fragment_complex.fragment_hashes):
-                    if set(fragment_hashes) == set(fragment_complex.fragment_hashes):
+                if len(hashes) == len(fragment_complex.fragment_hashes):
+                    if set(hashes) == set(fragment_complex.fragment_hashes):
                         equivalent_fragments_already_found = True
 
             if not equivalent_fragments_already_found:
 
-                if len(fragment_hashes) == 1 and not self.allow_ring_opening:
+                if len(hashes) == 1 and not self.allow_ring_opening:
                     pass
                 else:
 
-                    fragment_complex = FragmentComplex(                         #saves a FragmentComplex object after both fragment_hashes have been
-                        len(fragment_hashes), 1, [edge[0:2]], fragment_hashes   #added to the list of fragments with len(fragments) fragments, 1 bond broken, the identity
-                    )                                                           #of the bond broken (as a list containing one tuple), and the list of fragment hashes
+                    fragment_complex = FragmentComplex(         #saves a FragmentComplex object after both hashes have been
+                        len(hashes), 1, [edge[0:2]], hashes     #added to the list of fragments with len(fragments) fragments, 1 bond broken, the identity
+                    )                                           #of the bond broken (as a list containing one tuple), and the list of fragment hashes
 
                     mol.fragment_data.append(fragment_complex) #append the above FragmentComplex object to the molecule's fragment_data list
 
@@ -211,17 +263,19 @@ class covalent_ring_fragments(MSONable):
         pass
 
     def __call__(self, mol):
-        # maps edge to graph with that edge removed
+        # working copy which bonds are broken in and restored
+        h = mol.covalent_graph.copy()
+        hash_memo = {}
+
+        # maps edges whose removal leaves the graph connected to their nodes
         ring_edges = {}
 
         for edge in mol.covalent_graph.edges:
-            h = copy.deepcopy(mol.covalent_graph)
-            h.remove_edge(*edge)
-            if nx.is_connected(h):
-                ring_edges[edge] = {
-                    "modified_graph": h,
-                    "node_set": set([edge[0], edge[1]]),
-                }
+            with edges_removed(h, [edge]):
+                if nx.is_connected(h):
+                    ring_edges[edge] = {
+                        "node_set": set([edge[0], edge[1]]),
+                    }
 
         for ring_edge_1, ring_edge_2 in combinations(ring_edges, 2):
 
@@ -242,33 +296,21 @@ class covalent_ring_fragments(MSONable):
                         one_bond_away = True
 
                 if one_bond_away:
-                    h = copy.deepcopy(ring_edges[ring_edge_1]["modified_graph"])
-                    h.remove_edge(*ring_edge_2)
-                    if nx.is_connected(h):
-                        continue
-                    else:
-                        fragments = []
-                        connected_components = (
-                            nx.algorithms.components.connected_components(h)
-                        )
-                        for c in connected_components:
-
-                            subgraph = h.subgraph(c)
-
-                            fragment_hash = weisfeiler_lehman_graph_hash(
-                                subgraph, node_attr="specie"
-                            )
-
-                            fragments.append(fragment_hash)
-
-                        fragment_complex = FragmentComplex(
-                            len(fragments),
-                            2,
-                            [ring_edge_1[0:2], ring_edge_2[0:2]],
-                            fragments,
-                        )
-
-                        mol.ring_fragment_data.append(fragment_complex)
+                    with edges_removed(h, [ring_edge_1, ring_edge_2]):
+                        if nx.is_connected(h):
+                            continue
+                        else:
+                            fragments = fragment_hashes(
+                                h, [ring_edge_1, ring_edge_2], hash_memo)
+
+                    fragment_complex = FragmentComplex(
+                        len(fragments),
+                        2,
+                        [ring_edge_1[0:2], ring_edge_2[0:2]],
+                        fragments,
+                    )
+
+                    mol.ring_fragment_data.append(fragment_complex)
 
         return False
 
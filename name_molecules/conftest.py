@@ -0,0 +1 @@
+# lets the tests import HiPRGen from this directory
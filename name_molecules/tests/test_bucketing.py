@@ -0,0 +1,45 @@
+import sqlite3
+from collections import namedtuple
+from HiPRGen.bucketing import bucket, BucketArrays
+
+Species = namedtuple("Species", ["ind", "species"])
+
+
+def species_list():
+    # lots of C2H2, a few others, and some singletons which get pruned
+    species = [["C", "C", "H", "H"]] * 9 + [["C", "H"]] * 3 + [["O"], ["N", "N"], ["Li"]]
+    return [Species(i, s) for i, s in enumerate(species)]
+
+
+def test_group_counts_with_pruning(tmp_path):
+    bucket_db = str(tmp_path / "bucket.sqlite")
+    group_size = 4
+    bucket(
+        species_list(),
+        bucket_db,
+        group_size=group_size,
+        prune_singletons=True,
+        bucket_arrays_dir=str(tmp_path / "bucket_arrays"))
+
+    con = sqlite3.connect(bucket_db)
+    group_counts = dict(con.execute("SELECT * FROM group_counts"))
+    complexes = dict(con.execute(
+        "SELECT composition_id, COUNT(*) FROM complexes GROUP BY composition_id"))
+    max_group_id = dict(con.execute(
+        "SELECT composition_id, MAX(group_id) FROM complexes GROUP BY composition_id"))
+
+    assert set(group_counts) == set(complexes)
+    assert any(count > 1 for count in group_counts.values())
+    for composition_id, count in group_counts.items():
+        # a composition whose size is a multiple of group_size has an
+        # empty last group
+        empty_groups = 1 if complexes[composition_id] % group_size == 0 else 0
+        assert count == max_group_id[composition_id] + 1 + empty_groups
+
+    bucket_arrays = BucketArrays.load(str(tmp_path / "bucket_arrays"))
+    assert bucket_arrays.group_counts() == sorted(group_counts.items())
+    for composition_id, count in group_counts.items():
+        size = sum(
+            bucket_arrays.group_size(composition_id, group_id)
+            for group_id in range(count))
+        assert size == complexes[composition_id]
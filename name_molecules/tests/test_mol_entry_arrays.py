@@ -0,0 +1,117 @@
+import pickle
+import sqlite3
+from types import SimpleNamespace
+import networkx as nx
+import pytest
+from HiPRGen.mol_entry_arrays import write_mol_entry_arrays
+from HiPRGen.network_loader import NetworkLoader
+
+# mc_analysis draws networks with cairo
+pytest.importorskip("cairo")
+from HiPRGen.mc_analysis import redox_report
+
+
+def mol_entry(ind, charge, energy, electron_affinity, ionization_energy,
+              enthalpy=0.1, entropy=0.001):
+    covalent_graph = nx.MultiGraph()
+    covalent_graph.add_nodes_from([0, 1])
+    covalent_graph.add_edge(0, 1)
+    if enthalpy is not None and entropy is not None:
+        free_energy = energy + enthalpy - 298.15 * entropy
+    else:
+        free_energy = None
+
+    return SimpleNamespace(
+        ind=ind,
+        entry_id="entry_" + str(ind),
+        formula="C1 O1",
+        species=["C", "O"],
+        charge=charge,
+        spin_multiplicity=1,
+        num_atoms=2,
+        energy=energy,
+        enthalpy=enthalpy,
+        entropy=entropy,
+        free_energy=free_energy,
+        electron_affinity=electron_affinity,
+        ionization_energy=ionization_energy,
+        solvation_correction=None,
+        covalent_graph=covalent_graph,
+        fragment_data=[],
+        covalent_hash="hash_" + str(ind),
+        total_hash="hash_" + str(ind))
+
+
+def write_network(path, number_of_species, reactions):
+    con = sqlite3.connect(path)
+    con.execute("CREATE TABLE metadata (number_of_species, number_of_reactions)")
+    con.execute("INSERT INTO metadata VALUES (?, ?)",
+                (number_of_species, len(reactions)))
+    con.execute("""
+        CREATE TABLE reactions (
+            reaction_id INTEGER NOT NULL PRIMARY KEY,
+            number_of_reactants INTEGER NOT NULL,
+            number_of_products INTEGER NOT NULL,
+            reactant_1 INTEGER NOT NULL,
+            reactant_2 INTEGER NOT NULL,
+            product_1 INTEGER NOT NULL,
+            product_2 INTEGER NOT NULL,
+            rate REAL NOT NULL,
+            dG REAL NOT NULL,
+            dG_barrier REAL NOT NULL,
+            is_redox INTEGER NOT NULL)""")
+    con.executemany(
+        "INSERT INTO reactions VALUES (?,?,?,?,?,?,?,?,?,?,?)",
+        [(i,) + reaction for i, reaction in enumerate(reactions)])
+    con.commit()
+    con.close()
+
+
+def test_redox_report_from_mol_entry_arrays(tmp_path):
+    mol_entries = [
+        mol_entry(0, 0, -10.0, 1.2, None),
+        mol_entry(1, -1, -11.5, None, 0.8),
+        mol_entry(2, 1, -9.0, 0.5, 2.0),
+        mol_entry(3, 0, -8.0, None, None, enthalpy=None, entropy=None)]
+
+    mol_entries_pickle = str(tmp_path / "mol_entries.pickle")
+    with open(mol_entries_pickle, "wb") as f:
+        pickle.dump(mol_entries, f)
+
+    mol_entry_arrays_dir = str(tmp_path / "mol_entry_arrays")
+    write_mol_entry_arrays(mol_entries, mol_entry_arrays_dir)
+
+    network_database = str(tmp_path / "rn.sqlite")
+    write_network(network_database, len(mol_entries), [
+        (1, 1, 0, -1, 1, -1, 1.0, -1.5, 0.0, 1),
+        (1, 1, 0, -1, 2, -1, 1.0, 1.0, 0.0, 1),
+        (2, 1, 0, 1, 3, -1, 1.0, 0.5, 0.0, 0)])
+
+    params = {"electron_free_energy": -1.4}
+
+    pickle_loader = NetworkLoader(network_database, mol_entries_pickle)
+    redox_report(pickle_loader, str(tmp_path / "pickle.tex"), params)
+
+    arrays_loader = NetworkLoader(
+        network_database, None, mol_entry_arrays_dir=mol_entry_arrays_dir)
+    redox_report(arrays_loader, str(tmp_path / "arrays.tex"), params)
+
+    with open(tmp_path / "pickle.tex") as f:
+        pickle_report = f.read()
+    with open(tmp_path / "arrays.tex") as f:
+        arrays_report = f.read()
+
+    assert "marcus barrier" in arrays_report
+    assert arrays_report == pickle_report
+
+    # missing values come back as None, like on a MoleculeEntry
+    for i, mol in enumerate(mol_entries):
+        record = arrays_loader.mol_entries[i]
+        for name in ["enthalpy", "entropy", "free_energy",
+                     "electron_affinity", "ionization_energy",
+                     "solvation_correction"]:
+            value = getattr(mol, name)
+            if value is None:
+                assert getattr(record, name) is None
+            else:
+                assert abs(getattr(record, name) - value) < 1e-12
@@ -0,0 +1,99 @@
+import pickle
+import random
+import sqlite3
+from HiPRGen.network_loader import NetworkLoader
+
+
+def write_network(path, number_of_species):
+    # the tally doesn't look at mol_entries
+    with open(path + ".mol_entries.pickle", "wb") as f:
+        pickle.dump([], f)
+
+    con = sqlite3.connect(path)
+    con.execute("CREATE TABLE metadata (number_of_species, number_of_reactions)")
+    con.execute("INSERT INTO metadata VALUES (?, ?)", (number_of_species, 0))
+    con.commit()
+    con.close()
+
+
+def write_initial_state(path, seeds, number_of_species, rng):
+    con = sqlite3.connect(path)
+    con.execute(
+        "CREATE TABLE initial_state (species_id INTEGER NOT NULL PRIMARY KEY, "
+        "count INTEGER NOT NULL)")
+    con.execute(
+        "CREATE TABLE trajectories (seed INTEGER NOT NULL, step INTEGER NOT NULL, "
+        "reaction_id INTEGER NOT NULL, time REAL NOT NULL)")
+    con.executemany(
+        "INSERT INTO initial_state VALUES (?, ?)",
+        [(i, 1) for i in range(number_of_species)])
+
+    rows = []
+    for seed in seeds:
+        for step in range(rng.randint(5, 40)):
+            rows.append((seed, step, rng.randrange(60), 0.1 * step))
+
+    # the rows of a seed are neither contiguous nor in step order
+    rng.shuffle(rows)
+    con.executemany("INSERT INTO trajectories VALUES (?, ?, ?, ?)", rows)
+    con.commit()
+    con.close()
+
+
+def walk_tally(network_loader):
+    tally = {}
+    for seed in network_loader.trajectories:
+        for reaction_id in network_loader.trajectory_reaction_ids(seed).tolist():
+            tally[reaction_id] = tally.get(reaction_id, 0) + 1
+    return tally
+
+
+def test_reaction_tally_matches_trajectories(tmp_path):
+    rng = random.Random(3)
+    network_database = str(tmp_path / "rn.sqlite")
+    database_0 = str(tmp_path / "initial_state_0.sqlite")
+    database_1 = str(tmp_path / "initial_state_1.sqlite")
+    mol_entries_pickle = network_database + ".mol_entries.pickle"
+    write_network(network_database, 4)
+    write_initial_state(database_0, [5, 2, 9, 7], 4, rng)
+    write_initial_state(database_1, [11, 3, 8], 4, rng)
+
+    network_loader = NetworkLoader(
+        network_database, mol_entries_pickle, database_0, trajectory_store=True)
+    network_loader.load_trajectories()
+
+    tally = network_loader.load_reaction_tally()
+    assert list(tally.items()) == list(walk_tally(network_loader).items())
+
+    network_loader.set_initial_state_db(database_1)
+    assert network_loader.reaction_tally is None
+    network_loader.load_trajectories()
+
+    tally = network_loader.load_reaction_tally()
+    assert list(tally.items()) == list(walk_tally(network_loader).items())
+    assert sum(tally.values()) == network_loader.trajectories.reaction_ids.shape[0]
+
+
+def test_reaction_tally_without_trajectories(tmp_path):
+    rng = random.Random(4)
+    network_database = str(tmp_path / "rn.sqlite")
+    database_0 = str(tmp_path / "initial_state_0.sqlite")
+    database_1 = str(tmp_path / "initial_state_1.sqlite")
+    mol_entries_pickle = network_database + ".mol_entries.pickle"
+    write_network(network_database, 4)
+    write_initial_state(database_0, [1, 2], 4, rng)
+    write_initial_state(database_1, [3, 4], 4, rng)
+
+    reference = NetworkLoader(
+        network_database, mol_entries_pickle, database_0, trajectory_store=True)
+    reference.load_trajectories()
+    reference.set_initial_state_db(database_1)
+    reference.load_trajectories()
+
+    network_loader = NetworkLoader(
+        network_database, mol_entries_pickle, database_0)
+    network_loader.load_reaction_tally()
+    network_loader.set_initial_state_db(database_1)
+    tally = network_loader.load_reaction_tally()
+
+    assert list(tally.items()) == list(walk_tally(reference).items())